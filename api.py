@@ -1,40 +1,163 @@
 import os
 import json
+import hmac
+import logging
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
 from pathlib import Path
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
-from telegram import Bot
+from telegram import Bot, Update
 from bot import (
     DATA_DIR,
-    ORDERS_FILE,
-    ADMINS_FILE,
-    PENDING_FILE,
-    PROD_FILE,
-    read_json,
-    write_json,
-    create_order,
-    clear_cart,
-    _interprocess_lock,
-    _products_lock_path,
+    create_order_once,
+    find_pending_order,
+    settle_paid_order,
+    notify_admins_order_paid,
+    build_application,
+    ensure_data_files,
+    run_migrations,
+    setup_logging,
+    hold_process_lock,
+    LockTimeout,
+    run_blocking,
+    iter_orders_export,
+    ORDER_STATUSES,
+    shop_day_start,
+    updates_mode,
 )
 
 BASE_DIR = Path(__file__).resolve().parent
 # Load .env relative to this file to avoid cwd-dependent failures on servers
 load_dotenv(dotenv_path=BASE_DIR / ".env")
 TOKEN = os.getenv("TOKEN")
-app = FastAPI()
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or ""
+# GET /orders/export is enabled only when EXPORT_TOKEN is set
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN") or ""
+# BOT_UPDATES_MODE=api: Telegram updates arrive on POST /telegram/webhook and run through bot.py's handlers
+_tg_app = None
+_tg_lock = None
+log = logging.getLogger("bot.api")
 
-def read_pending():
-    try:
-        return json.loads(Path(PENDING_FILE).read_text(encoding="utf-8"))
-    except Exception:
-        return []
 
-def write_pending(data):
-    Path(PENDING_FILE).write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+async def _start_telegram() -> None:
+    global _tg_app, _tg_lock
+    if not TOKEN or not WEBHOOK_SECRET:
+        log.error("BOT_UPDATES_MODE=api needs TOKEN and TELEGRAM_WEBHOOK_SECRET; Telegram endpoint disabled")
+        return
+    # Only one worker may run the bot: per-chat ordering, broadcasts and reconcile are per process
+    _tg_lock = hold_process_lock(DATA_DIR / ".lock_telegram_app")
+    if _tg_lock is None:
+        log.info("Telegram updates are handled by another api.py worker")
+        return
+    ensure_data_files()
+    await run_blocking(run_migrations)
+    tg = build_application()
+    await tg.initialize()
+    if tg.post_init:
+        await tg.post_init(tg)
+    await tg.start()
+    webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL")
+    if webhook_url:
+        await tg.bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET)
+    _tg_app = tg
+
+
+async def _stop_telegram() -> None:
+    global _tg_app, _tg_lock
+    if _tg_app is not None:
+        await _tg_app.stop()
+        await _tg_app.shutdown()
+        _tg_app = None
+    if _tg_lock is not None:
+        _tg_lock.close()
+        _tg_lock = None
+
+
+@asynccontextmanager
+async def _lifespan(_app):
+    setup_logging()
+    if updates_mode() == "api":
+        await _start_telegram()
+    yield
+    await _stop_telegram()
+
+
+app = FastAPI(lifespan=_lifespan)
+_bot = None
+
+
+def _get_bot() -> Bot:
+    # one Bot (and HTTP connection pool) per worker instead of one per message
+    global _bot
+    if _tg_app is not None:
+        return _tg_app.bot
+    if _bot is None:
+        _bot = Bot(token=TOKEN)
+    return _bot
+
+
+async def _notify_order_paid(order: dict, events: list, user_id: int | None) -> None:
+    bot = _get_bot()
+    if user_id:
+        try:
+            await bot.send_message(
+                chat_id=user_id,
+                text=(
+                    f"✅ Оплата заказа #{order['number']} прошла успешно\n\n"
+                    "📦 Заказ оформлен. Ожидайте, когда администратор начнет обработку.\n"
+                    "Когда появится ссылка для отслеживания — мы сообщим.\n\n"
+                    "Вы можете смотреть статус в разделе «📦 Мои заказы»."
+                ),
+            )
+        except Exception:
+            pass
+    await notify_admins_order_paid(bot, order, events)
+
+
+def _complete_paid_order(order_id: int, user_id: int | None):
+    """Turn a paid pending order into an order.
+
+    Returns (order, stock events), (None, []) for a repeated notification and None for an unknown
+    pending order. Every store touched here is updated in its own locked transaction, so this is safe to run in
+    several uvicorn workers at once (`--workers N`). It blocks on those locks, so it runs in a worker thread.
+    """
+    pending = find_pending_order(order_id)
+    if not pending:
+        return None
+    # create real order
+    class U:
+        def __init__(self, uid, username):
+            self.id = uid
+            self.username = username
+            self.first_name = None
+            self.last_name = None
+    user = U(user_id, None)
+    items = pending.get("items", [])
+    address = pending.get("address", "")
+    delivery = pending.get("delivery")
+    order, created = create_order_once(
+        user,
+        items,
+        address,
+        delivery,
+        number=pending.get("number"),
+        payment_id=pending.get("payment_id"),
+        created_at=pending.get("created_at"),
+    )
+    # stock, cart, then the pending entry. A LockTimeout here keeps the pending entry and reaches the
+    # webhook's 503, so YooKassa redelivers and the retry settles it (stock is taken once per order).
+    # Admins get the stock alerts in the order digest.
+    events = settle_paid_order(order, pending)
+    if not created:
+        # Duplicate delivery (YooKassa retry or a concurrent worker) - the order already exists
+        return None, []
+    return order, events
+
 
 @app.post("/yookassa/webhook")
-async def yookassa_webhook(request: Request):
+async def yookassa_webhook(request: Request, background: BackgroundTasks):
     data = await request.json()
     event = data.get("event")
     if event == "payment.succeeded":
@@ -46,146 +169,67 @@ async def yookassa_webhook(request: Request):
         except Exception:
             return {"status": "ignored"}
         user_id = int(meta.get("user_id")) if meta.get("user_id") else None
-        pend = read_pending()
-        pending = next((p for p in pend if int(p.get("id", 0)) == order_id), None)
-        if not pending:
-            return {"status": "ignored"}
-        # create real order
-        class U:
-            def __init__(self, uid, username):
-                self.id = uid
-                self.username = username
-                self.first_name = None
-                self.last_name = None
-        user = U(user_id, None)
-        items = pending.get("items", [])
-        address = pending.get("address", "")
-        delivery = pending.get("delivery")
-        order = create_order(
-            user,
-            items,
-            address,
-            delivery,
-            number=pending.get("number"),
-            payment_id=pending.get("payment_id"),
-            created_at=pending.get("created_at"),
-        )
-        # decrease stock and alert admins if low/out-of-stock (skip if already reserved)
-        try:
-            events = []
-            if pending.get("reserved"):
-                prods_all = read_json(PROD_FILE)
-                prods_by_id = {int(p.get("id")): p for p in prods_all if p.get("id") is not None}
-                seen = set()
-                for it in order.get("items", []):
-                    try:
-                        pid = int(it.get("product_id", 0))
-                    except Exception:
-                        continue
-                    if pid in seen:
-                        continue
-                    seen.add(pid)
-                    p = prods_by_id.get(pid)
-                    if not p:
-                        continue
-                    new_stock = int(p.get("stock", 0) or 0)
-                    if new_stock == 0:
-                        events.append(("out", p.copy()))
-                    elif new_stock <= 3:
-                        events.append(("low", p.copy()))
-            else:
-                with _interprocess_lock(_products_lock_path()):
-                    prods_all = read_json(PROD_FILE)
-                    for it in order.get("items", []):
-                        for p in prods_all:
-                            if int(p.get("id", 0)) == int(it.get("product_id", 0)):
-                                old_stock = int(p.get("stock", 0) or 0)
-                                p["stock"] = max(0, old_stock - int(it.get("qty", 1)))
-                                new_stock = int(p.get("stock", 0) or 0)
-                                if new_stock == 0:
-                                    events.append(("out", p.copy()))
-                                elif new_stock <= 3 and old_stock > 3:
-                                    events.append(("low", p.copy()))
-                                break
-                    write_json(PROD_FILE, prods_all)
-            if TOKEN:
-                try:
-                    bot = Bot(token=TOKEN)
-                    admins = read_json(ADMINS_FILE)
-                    for kind, prod_event in events:
-                        for aid in admins:
-                            try:
-                                if kind == "out":
-                                    await bot.send_message(chat_id=aid, text=(
-                                        "⛔ Товар закончился\n\n"
-                                        f"💊 {prod_event.get('name','-')}\n"
-                                        f"🆔 ID: {prod_event.get('id')}"
-                                    ))
-                                else:
-                                    await bot.send_message(chat_id=aid, text=(
-                                        "⚠️ Мало товара\n\n"
-                                        f"💊 {prod_event.get('name','-')}\n"
-                                        f"📦 Осталось: {prod_event.get('stock', 0)} шт\n"
-                                        f"🆔 ID: {prod_event.get('id')}"
-                                    ))
-                            except Exception:
-                                pass
-                except Exception:
-                    pass
-        except Exception:
-            pass
-        # clear cart on successful payment if checkout was from cart
         try:
-            if pending.get("type") == "cart" and user_id:
-                clear_cart(user_id)
-        except Exception:
-            pass
-        # remove from pending
-        pend = [p for p in pend if int(p.get("id", 0)) != order_id]
-        write_pending(pend)
-        # notify user
-        if TOKEN and user_id:
-            try:
-                bot = Bot(token=TOKEN)
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        f"✅ Оплата заказа #{order['number']} прошла успешно\n\n"
-                        "📦 Заказ оформлен. Ожидайте, когда администратор начнет обработку.\n"
-                        "Когда появится ссылка для отслеживания — мы сообщим.\n\n"
-                        "Вы можете смотреть статус в разделе «📦 Мои заказы»."
-                    ),
-                )
-            except Exception:
-                pass
-
-        # notify admins about new order
+            done = await run_blocking(_complete_paid_order, order_id, user_id)
+        except LockTimeout as e:
+            # data files are busy; a 5xx makes YooKassa deliver the notification again later
+            log.error("payment webhook postponed: %s", e, extra={"order_id": order_id})
+            return JSONResponse({"status": "busy"}, status_code=503)
+        if done is None:
+            return {"status": "ignored"}
+        order, events = done
+        if order is None:
+            return {"status": "ok"}
+        # user confirmation and the admin digest are sent after the response is returned
         if TOKEN:
-            try:
-                bot = Bot(token=TOKEN)
-                admins = read_json(ADMINS_FILE)
-                items = order.get("items", []) or []
-                lines = []
-                for it in items[:10]:
-                    lines.append(f"• {it.get('name','-')} × {it.get('qty',1)}")
-                if len(items) > 10:
-                    lines.append(f"… ещё {len(items) - 10} поз.")
-                delivery = order.get("delivery") or "-"
-                text = (
-                    "🆕 Новый оплаченный заказ\n\n"
-                    f"🧾 Заказ #{order.get('number')}\n"
-                    f"💰 Сумма: {order.get('total', 0)} ₽\n"
-                    f"🚚 Доставка: {delivery}\n"
-                    f"📍 Адрес: {order.get('address','-')}\n\n"
-                    f"👤 Клиент: @{order.get('username','')} (ID {order.get('user_id')})\n\n"
-                    "📦 Товары:\n" + ("\n".join(lines) if lines else "• -")
-                )
-                for aid in admins:
-                    try:
-                        await bot.send_message(chat_id=aid, text=text)
-                    except Exception:
-                        pass
-            except Exception:
-                pass
+            background.add_task(_notify_order_paid, order, events, user_id)
         return {"status": "ok"}
     return {"status": "ignored"}
+
+
+def _record_update(path: str, data: dict) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+
+@app.post("/telegram/webhook")
+async def telegram_webhook(request: Request):
+    """Telegram update intake for BOT_UPDATES_MODE=api: queue the update and answer right away."""
+    if _tg_app is None:
+        # not enabled here, or another worker owns the bot; Telegram retries on 5xx
+        return JSONResponse({"status": "unavailable"}, status_code=503)
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    data = await request.json()
+    record_path = os.getenv("TELEGRAM_RECORD_UPDATES")
+    if record_path:
+        # raw updates for replay_updates.py; the file write stays off the event loop
+        await run_blocking(_record_update, record_path, data)
+    await _tg_app.update_queue.put(Update.de_json(data, _tg_app.bot))
+    return {"status": "ok"}
+
+
+@app.get("/orders/export")
+async def export_orders(request: Request, format: str = "csv", date_from: date | None = None,
+                        date_to: date | None = None, status: str | None = None):
+    """Orders flattened to one row per line item, streamed as CSV or JSONL while orders.json is being read.
+
+    date_from/date_to are inclusive days (YYYY-MM-DD, in SHOP_TZ); the X-Export-Token header must match EXPORT_TOKEN.
+    """
+    if not EXPORT_TOKEN:
+        return JSONResponse({"status": "disabled"}, status_code=404)
+    if not hmac.compare_digest(request.headers.get("X-Export-Token", ""), EXPORT_TOKEN):
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    if format not in ("csv", "jsonl") or (status and status not in ORDER_STATUSES):
+        return JSONResponse({"status": "bad request"}, status_code=400)
+    since = shop_day_start(date_from) if date_from else None
+    until = shop_day_start(date_to + timedelta(days=1)) if date_to else None
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    filename = "orders" + (f"_{status}" if status else "") + f".{format}"
+    # a sync generator: Starlette iterates it in a worker thread, chunk by chunk
+    return StreamingResponse(
+        iter_orders_export(format, since, until, status),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,160 @@
+"""Benchmark: concurrent YooKassa webhooks against api.py running with several uvicorn workers.
+
+Seeds a scratch data directory with pending orders, starts `uvicorn api:app --workers N`
+against it, fires every `payment.succeeded` webhook (each one delivered twice, like a
+YooKassa retry) with bounded concurrency, then checks that no order was lost or duplicated
+and that stock was decremented exactly once per order.
+
+    python bench_webhooks.py --workers 4 --orders 300 --concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _seed(data_dir: Path, orders: int, stock: int) -> None:
+    data_dir.mkdir(parents=True, exist_ok=True)
+    products = [{"id": 1, "category_id": 1, "name": "Bench product", "price": 100, "stock": stock}]
+    pending = []
+    for i in range(1, orders + 1):
+        pending.append({
+            "id": i,
+            "number": 1000 + i,
+            "user_id": 100000 + i,
+            "username": f"bench{i}",
+            "items": [{"product_id": 1, "name": "Bench product", "qty": 1, "price": 100}],
+            "total": 100,
+            "address": "-",
+            "delivery": "Яндекс",
+            "status": "new",
+            "created_at": time.time(),
+            "client": {},
+            "type": "cart" if i % 2 else "single",
+            "payment_id": f"bench-{i}",
+        })
+    for name, data in (
+        ("products.json", products),
+        ("pending_orders.json", pending),
+        ("orders.json", []),
+        ("carts.json", []),
+        ("admins.json", []),
+        ("profiles.json", {}),
+    ):
+        (data_dir / name).write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+
+async def _wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("api server did not start in time")
+
+
+async def _fire(url: str, orders: int, concurrency: int) -> tuple[int, int, float]:
+    sem = asyncio.Semaphore(concurrency)
+    ok = 0
+    errors = 0
+
+    async def one(client, order_id):
+        nonlocal ok, errors
+        body = {
+            "event": "payment.succeeded",
+            "object": {"metadata": {"order_id": order_id, "user_id": 100000 + order_id}},
+        }
+        async with sem:
+            try:
+                r = await client.post(url, json=body)
+                if r.status_code == 200:
+                    ok += 1
+                else:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+
+    # every webhook is delivered twice to exercise idempotency across workers
+    ids = [i for i in range(1, orders + 1)] * 2
+    started = time.perf_counter()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        await asyncio.gather(*(one(client, i) for i in ids))
+    return ok, errors, time.perf_counter() - started
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--orders", type=int, default=300)
+    ap.add_argument("--concurrency", type=int, default=64)
+    args = ap.parse_args()
+
+    initial_stock = args.orders + 50
+    with tempfile.TemporaryDirectory(prefix="bench_webhooks_") as tmp:
+        data_dir = Path(tmp) / "data"
+        _seed(data_dir, args.orders, initial_stock)
+        port = _free_port()
+        env = dict(os.environ, BOT_DATA_DIR=str(data_dir), TOKEN="")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=BASE_DIR,
+            env=env,
+        )
+        try:
+            base = f"http://127.0.0.1:{port}"
+            asyncio.run(_wait_ready(base + "/docs"))
+            ok, errors, elapsed = asyncio.run(_fire(base + "/yookassa/webhook", args.orders, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+        orders = json.loads((data_dir / "orders.json").read_text(encoding="utf-8"))
+        pending = json.loads((data_dir / "pending_orders.json").read_text(encoding="utf-8"))
+        # stock lives in the per-product counter once the api has migrated the data directory
+        counter = data_dir / "stock" / "1.json"
+        if counter.exists():
+            stock = json.loads(counter.read_text(encoding="utf-8"))["stock"]
+        else:
+            stock = json.loads((data_dir / "products.json").read_text(encoding="utf-8"))[0]["stock"]
+
+    numbers = [o.get("number") for o in orders]
+    sent = args.orders * 2
+    print(f"workers={args.workers} webhooks={sent} concurrency={args.concurrency}")
+    print(f"elapsed={elapsed:.2f}s throughput={sent / elapsed:.1f} req/s ok={ok} errors={errors}")
+    print(f"orders={len(orders)} unique={len(set(numbers))} pending_left={len(pending)} "
+          f"stock={stock} expected_stock={initial_stock - args.orders}")
+
+    failed = (
+        errors
+        or len(orders) != args.orders
+        or len(set(numbers)) != args.orders
+        or pending
+        or stock != initial_stock - args.orders
+    )
+    print("FAIL" if failed else "OK: no order lost or duplicated")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
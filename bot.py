@@ -2,11 +2,30 @@ from dotenv import load_dotenv
 import os
 import json
 from pathlib import Path
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, KeyboardButton
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultsButton, InputMediaPhoto, InputTextMessageContent, KeyboardButton
+from telegram.ext import ApplicationBuilder, BasePersistence, BaseUpdateProcessor, CommandHandler, ContextTypes, CallbackQueryHandler, InlineQueryHandler, MessageHandler, PersistenceInput, TypeHandler, filters
 import asyncio
-from telegram.error import BadRequest
+import bisect
+import contextvars
+import copy
+import csv
+import functools
+import heapq
+import inspect
+import io
+import logging
+import queue
+import random
+import re
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
 import uuid
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 try:
     from yookassa import Payment, Configuration
 except Exception:
@@ -19,11 +38,20 @@ load_dotenv(dotenv_path=BASE_DIR / ".env")
 
 TOKEN = os.getenv("TOKEN")
 
+# Days in stats, reports, search and exports start at midnight in the shop's timezone, not the server's
+try:
+    SHOP_TZ = ZoneInfo(os.getenv("SHOP_TZ") or "Europe/Moscow")
+except (ZoneInfoNotFoundError, ValueError):
+    # no tz database (Windows without the tzdata package): Moscow has been UTC+3 all year since 2014
+    from datetime import timezone
+    SHOP_TZ = timezone(timedelta(hours=3), "MSK")
+
 # Список админов (ID из вашего сообщения)
 ADMINS = {8133757512, 5815094886}
 
 # Use a path relative to this file so running from a different CWD still works.
-DATA_DIR = BASE_DIR / "data"
+# BOT_DATA_DIR overrides it (e.g. to point several processes or a benchmark at a scratch copy).
+DATA_DIR = Path(os.getenv("BOT_DATA_DIR") or (BASE_DIR / "data"))
 CATS_FILE = DATA_DIR / "categories.json"
 PROD_FILE = DATA_DIR / "products.json"
 CART_FILE = DATA_DIR / "carts.json"
@@ -37,6 +65,140 @@ ADDR_FILE = DATA_DIR / "addresses.json"
 PROFILE_FILE = DATA_DIR / "profiles.json"
 PENDING_FILE = DATA_DIR / "pending_orders.json"
 WAIT_NOTIFY_FILE = DATA_DIR / "notify.json"
+# Users whose chats are unreachable (blocked the bot / deleted): {user_id: {"reason", "at"}}
+DEAD_FILE = DATA_DIR / "dead_recipients.json"
+# Recipient lists of broadcast jobs (one file per job, removed when the job finishes)
+BROADCAST_JOBS_DIR = DATA_DIR / "broadcast_jobs"
+# Per-user/per-chat user_data and chat_data (checkout state, product drafts), see JsonSessionPersistence
+SESSIONS_DIR = DATA_DIR / "sessions"
+# Version of the data file layout, advanced by run_migrations: {"version": N, "applied": [...]}
+SCHEMA_FILE = DATA_DIR / "schema.json"
+# Stock counters, one file per product: {"stock": n, "version": v}; products.json "stock" is only the seed
+STOCK_DIR = DATA_DIR / "stock"
+# Every stock change as one JSON line: {"ts", "product_id", "delta", "stock", "version", "reason", "ref"}
+STOCK_LEDGER_FILE = DATA_DIR / "stock_ledger.jsonl"
+
+log = logging.getLogger("bot")
+_log_updates = logging.getLogger("bot.updates")
+
+# LogRecord attributes that are not extra=... fields
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, any extra= fields (user_id, route, latency_ms...), exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS:
+                out[key] = value
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread; if it falls behind and the queue is full, drops them (log.dropped)."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # keep extra fields and the traceback as text; formatting happens on the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.inc("log.dropped")
+
+
+# update_id of the update being handled in this task, set by bind_update_log before any other handler
+_LOG_UPDATE_ID: contextvars.ContextVar[int | None] = contextvars.ContextVar("log_update_id", default=None)
+
+
+class _DebugSampler(logging.Filter):
+    """Keep the DEBUG records of only a share of updates, all of an update's or none; other levels always pass.
+
+    The decision is a hash of the update_id, so every line of a sampled update is kept. DEBUG records
+    emitted outside an update (background loops) are sampled one by one.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        update_id = _LOG_UPDATE_ID.get()
+        if update_id is None:
+            return random.random() < self.rate
+        # multiplicative hash spreads consecutive update ids over [0, 1)
+        return (update_id * 2654435761 % 2**32) / 2**32 < self.rate
+
+
+async def bind_update_log(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Tag this update's log records with its update_id (each update is processed in its own task)."""
+    _LOG_UPDATE_ID.set(update.update_id)
+
+
+_LOG_LISTENER: QueueListener | None = None
+
+
+def setup_logging() -> None:
+    """Send all logging through a bounded queue to a thread writing to stderr, so handlers never wait on I/O.
+
+    LOG_LEVEL: default level (INFO). LOG_LEVELS: per-logger levels, e.g. "bot.updates=DEBUG,httpx=INFO".
+    LOG_DEBUG_SAMPLE: share of updates whose DEBUG records are kept (0.05). LOG_FORMAT=text: plain lines instead of JSON.
+    """
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        return
+    out = logging.StreamHandler()
+    if (os.getenv("LOG_FORMAT") or "json").lower() == "text":
+        out.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        out.setFormatter(JsonLogFormatter())
+    q: queue.Queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    handler = _NonBlockingQueueHandler(q)
+    handler.addFilter(_DebugSampler(float(os.getenv("LOG_DEBUG_SAMPLE", "0.05"))))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel((os.getenv("LOG_LEVEL") or "INFO").upper())
+    # httpx logs every Bot API request at INFO
+    levels = {"httpx": "WARNING", "telegram": "WARNING"}
+    for item in (os.getenv("LOG_LEVELS") or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    _LOG_LISTENER = QueueListener(q, out)
+    _LOG_LISTENER.start()
+    import atexit
+    atexit.register(_LOG_LISTENER.stop)
+
+
+_LOG_SLOW_MS = float(os.getenv("LOG_SLOW_MS", "1000"))
+
+
+def _log_update(route: str, user_id, started: float, failed: bool) -> None:
+    """Per-update line: DEBUG (sampled) normally, INFO if slower than LOG_SLOW_MS, ERROR if the handler raised."""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if failed:
+        level = logging.ERROR
+    elif elapsed_ms >= _LOG_SLOW_MS:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    if _log_updates.isEnabledFor(level):
+        _log_updates.log(level, "handler failed" if failed else "update", extra={"user_id": user_id, "route": route, "latency_ms": round(elapsed_ms, 1)})
 
 
 def ensure_data_files():
@@ -99,48 +261,42 @@ def subscribe_notify(user_id: int, product_id: int) -> bool:
     return True
 
 
-async def notify_users_product_available(context: ContextTypes.DEFAULT_TYPE, product_id: int, product_name: str | None = None) -> None:
-    """Notify and clear subscriptions when product becomes available again."""
+async def notify_users_product_available(context: ContextTypes.DEFAULT_TYPE, product_id: int, product_name: str | None = None) -> dict | None:
+    """Notify and clear subscriptions when product becomes available again; returns the fanout_send counts.
+
+    Long for many subscribers: run it with start_fanout, not inline in a handler.
+    """
     ensure_data_files()
     data = _read_wait_notify_map()
     key = str(int(product_id))
     users = data.get(key)
     if not isinstance(users, list) or not users:
-        return
+        return None
+    # Clear subscriptions up front, even if delivery fails for some users, to avoid infinite growth;
+    # users who subscribe while this fan-out runs stay subscribed for the next restock
+    data.pop(key, None)
+    _write_wait_notify_map(data)
 
     msg = "🎉 Товар снова в наличии!"
     if product_name:
         msg = msg + f"\n\n{product_name}"
 
-    delivered = 0
-    for uid in list(users):
-        try:
-            await context.bot.send_message(chat_id=int(uid), text=msg)
-            delivered += 1
-        except Exception:
-            pass
+    async def send_one(uid):
+        await context.bot.send_message(chat_id=uid, text=msg)
 
-    # Admin log
-    try:
-        admins = read_json(ADMINS_FILE)
-    except Exception:
-        admins = []
-    if admins:
-        name_line = f"\nТовар: {product_name}" if product_name else ""
-        admin_text = (
-            f"📢 Уведомления о поступлении отправлены: {delivered} пользователям"
-            f"\nID товара: {product_id}"
-            f"{name_line}"
-        )
-        for aid in admins:
-            try:
-                await context.bot.send_message(chat_id=int(aid), text=admin_text)
-            except Exception:
-                pass
+    stats = await fanout_send(list(users), send_one)
+    log.info("restock fan-out done", extra={"product_id": product_id, **_fanout_counts(stats)})
 
-    # Clear subscriptions even if delivery failed for some users to avoid infinite growth
-    data.pop(key, None)
-    _write_wait_notify_map(data)
+    # Admin log
+    name_line = f"\nТовар: {product_name}" if product_name else ""
+    admin_text = (
+        f"📢 Уведомления о поступлении отправлены: {stats['sent']} пользователям"
+        f"\nID товара: {product_id}"
+        f"{name_line}"
+        f"\n{_fanout_report(stats)}"
+    )
+    await send_to_admins(context.bot, admin_text)
+    return stats
 
 
 def read_json(path: Path, default=None):
@@ -151,7 +307,96 @@ def read_json(path: Path, default=None):
 
 
 def write_json(path: Path, data):
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    # Write to a temp file and atomically swap it in, so readers in other
+    # processes (api.py workers, reconcile_once.py) never see a half-written file.
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+    finally:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _file_version(path: Path):
+    """Cheap change marker for a data file: (inode, mtime_ns, size); None if missing.
+
+    write_json replaces files atomically, so every write produces a new inode.
+    """
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+_JSON_CACHE: dict[Path, tuple] = {}
+
+
+def _read_json_cached(path: Path, default=None):
+    """read_json that re-parses only when the file changed. The result is shared: do not mutate it."""
+    ver = _file_version(path)
+    hit = _JSON_CACHE.get(path)
+    if hit is not None and hit[0] == ver and ver is not None:
+        return hit[1]
+    data = read_json(path, default=default)
+    _JSON_CACHE[path] = (ver, data)
+    return data
+
+
+def _catalog_version():
+    """Changes whenever categories.json or products.json is rewritten (by this or any other process)."""
+    return (_file_version(CATS_FILE), _file_version(PROD_FILE))
+
+
+class _RenderCache:
+    """LRU of rendered catalog screens keyed by (view, arguments), valid for one catalog version.
+
+    Keyboards are immutable TelegramObjects, so a cached (text, markup) can be sent any number of times.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, maxsize)
+        self.version = None
+        self.entries: OrderedDict = OrderedDict()
+
+    def get_or_render(self, key: tuple, render):
+        version = _catalog_version()
+        if version != self.version or None in version:
+            # a catalog write makes every entry stale
+            self.entries.clear()
+            self.version = version
+        hit = self.entries.get(key)
+        if hit is not None:
+            self.entries.move_to_end(key)
+            METRICS.inc("render_cache.hit")
+            return hit
+        METRICS.inc("render_cache.miss")
+        result = render()
+        self.entries[key] = result
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return result
+
+
+_RENDER_CACHE = _RenderCache(int(os.getenv("RENDER_CACHE_SIZE", "256")))
+
+
+def catalog_view(view: str):
+    """Memoize a catalog screen renderer in _RENDER_CACHE until categories/products change."""
+    def decorator(fn):
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (view, *bound.arguments.values())
+            return _RENDER_CACHE.get_or_render(key, lambda: fn(*args, **kwargs))
+        return wrapper
+    return decorator
 
 
 def get_next_id(items):
@@ -195,44 +440,185 @@ def _products_lock_path() -> Path:
     return DATA_DIR / ".lock_products"
 
 
-def _interprocess_lock(lock_path: Path):
-    """Simple cross-platform interprocess lock using a lock file."""
-    from contextlib import contextmanager
+def _categories_lock_path() -> Path:
+    # taken before the products lock when both are needed
+    return DATA_DIR / ".lock_categories"
 
-    @contextmanager
-    def _lock():
-        lock_path.parent.mkdir(parents=True, exist_ok=True)
-        f = open(lock_path, "a+b")
+
+def _orders_lock_path() -> Path:
+    return DATA_DIR / ".lock_orders"
+
+
+def _pending_lock_path() -> Path:
+    return DATA_DIR / ".lock_pending"
+
+
+def _broadcasts_lock_path() -> Path:
+    return DATA_DIR / ".lock_broadcasts"
+
+
+def _dead_lock_path() -> Path:
+    return DATA_DIR / ".lock_dead"
+
+
+def get_dead_recipients() -> dict:
+    data = _read_json_cached(DEAD_FILE, default={})
+    return data if isinstance(data, dict) else {}
+
+
+def mark_recipients_dead(user_ids, reason: str = "blocked") -> None:
+    """Remember chats that answered Forbidden / chat not found so fan-outs stop retrying them."""
+    ids = [str(int(u)) for u in user_ids]
+    if not ids:
+        return
+    now = time.time()
+    with _json_transaction(DEAD_FILE, _dead_lock_path(), default={}) as data:
+        for uid in ids:
+            data[uid] = {"reason": reason, "at": now}
+
+
+def revive_recipient(user_id: int) -> bool:
+    """Re-enable a user who wrote to the bot again. Cheap no-op for users that are not marked dead."""
+    if str(int(user_id)) not in get_dead_recipients():
+        return False
+    with _json_transaction(DEAD_FILE, _dead_lock_path(), default={}) as data:
+        return data.pop(str(int(user_id)), None) is not None
+
+
+class LockTimeout(TimeoutError):
+    """An interprocess lock was not acquired within its timeout; the guarded change was not made."""
+
+
+# Seconds to wait for a data-file lock before giving up with LockTimeout
+LOCK_TIMEOUT = float(os.getenv("LOCK_TIMEOUT", "10"))
+
+
+def _try_lock(f) -> bool:
+    """Non-blocking exclusive lock on an open lock file: False if another holder has it, raises on real errors."""
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    except PermissionError:
+        # msvcrt reports a held region as EACCES
+        if os.name == "nt":
+            return False
+        raise
+    except OSError as e:
+        if os.name == "nt" and e.errno in (13, 36):
+            return False
+        raise
+    return True
+
+
+def _unlock(f) -> None:
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    except OSError:
+        # closing the file releases the lock anyway
+        pass
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+@contextmanager
+def _interprocess_lock(lock_path: Path, timeout: float | None = None):
+    """Exclusive lock on lock_path shared by every process (bot.py, api.py workers) and thread.
+
+    Polls a non-blocking lock with a growing pause (1 ms .. 50 ms) and raises LockTimeout after
+    `timeout` seconds (LOCK_TIMEOUT by default) instead of running the block unlocked. Wait and
+    hold times go to METRICS as lock.<name>.wait / .hold (".lock_products" -> products). Waiting blocks the calling
+    thread, so async code runs locking functions through run_blocking.
+    """
+    name = lock_path.name.lstrip(".").removeprefix("lock_")
+    timeout = LOCK_TIMEOUT if timeout is None else timeout
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(lock_path, "a+b")
+    try:
+        started = time.perf_counter()
+        if not _try_lock(f):
+            METRICS.inc(f"lock.{name}.contended")
+            if _on_event_loop():
+                # every update of this process is stalled until the lock is ours
+                METRICS.inc(f"lock.{name}.loop_waits")
+            pause = 0.001
+            while not _try_lock(f):
+                if time.perf_counter() - started >= timeout:
+                    METRICS.inc(f"lock.{name}.timeouts")
+                    log.error("lock timeout", extra={"lock": name, "timeout_s": timeout})
+                    raise LockTimeout(f"{lock_path.name} is still held after {timeout:g}s")
+                time.sleep(pause)
+                pause = min(pause * 2, 0.05)
+        acquired = time.perf_counter()
+        METRICS.observe(f"lock.{name}.wait", acquired - started)
         try:
-            try:
-                if os.name == "nt":
-                    import msvcrt
-                    f.seek(0)
-                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
-                else:
-                    import fcntl
-                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            except Exception:
-                # If locking fails, continue without a hard lock (best-effort)
-                pass
             yield
         finally:
-            try:
-                if os.name == "nt":
-                    import msvcrt
-                    f.seek(0)
-                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
-                else:
-                    import fcntl
-                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            except Exception:
-                pass
-            try:
-                f.close()
-            except Exception:
-                pass
+            _unlock(f)
+            METRICS.observe(f"lock.{name}.hold", time.perf_counter() - acquired)
+    finally:
+        f.close()
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Call a sync function that takes interprocess locks (or does other file I/O) in a worker thread.
+
+    Waiting for a lock that api.py holds then stalls only that call, not every chat served by the event loop.
+    """
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+def hold_process_lock(lock_path: Path):
+    """Try to take an exclusive lock for the lifetime of this process.
 
-    return _lock()
+    Returns the open lock file (keep a reference; closing it releases the lock) or None if
+    another process already holds it. Used to elect a single owner for singleton work.
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(lock_path, "a+b")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+@contextmanager
+def _json_transaction(path: Path, lock_path: Path, default=None):
+    """Read-modify-write a JSON store under an interprocess lock.
+
+    Mutate the yielded object in place; it is written back atomically when the
+    block exits normally (nothing is written if the block raises).
+    """
+    with _interprocess_lock(lock_path):
+        data = read_json(path, default=default)
+        yield data
+        write_json(path, data)
 
 
 def _normalize_cart_items(items, prods_by_id: dict[int, dict] | None = None):
@@ -281,22 +667,28 @@ def _read_cart_data() -> list:
     return data if isinstance(data, list) else []
 
 
+def _is_normalized_cart(items) -> bool:
+    return isinstance(items, list) and all(
+        isinstance(it, dict) and isinstance(it.get("product_id"), int) and "qty" in it and "price" in it for it in items
+    )
+
+
 def get_cart_items(user_id: int) -> list[dict]:
-    """Return cart items for user in normalized new format. Migrates legacy format on read."""
-    with _interprocess_lock(_cart_lock_path()):
-        data = _read_cart_data()
-        rec = next((r for r in data if int(r.get("user_id", 0)) == int(user_id)), None)
-        if not rec:
-            return []
-        items_raw = rec.get("items", [])
-        prods = read_json(PROD_FILE, default=[])
-        prods_by_id = {int(p.get("id")): p for p in prods if p.get("id") is not None}
-        items_norm = _normalize_cart_items(items_raw, prods_by_id=prods_by_id)
-        # Write back if migrated/normalized
-        if items_norm != items_raw:
-            rec["items"] = items_norm
-            write_json(CART_FILE, data)
-        return items_norm
+    """Return cart items for user as {product_id, qty, price} dicts.
+
+    Read-only and lock-free: carts.json is replaced atomically and migrated to this format at
+    startup (run_migrations), so nothing is normalized or written back here.
+    """
+    data = _read_json_cached(CART_FILE, default=[])
+    rec = next((r for r in data if isinstance(r, dict) and int(r.get("user_id", 0)) == int(user_id)), None)
+    if not rec:
+        return []
+    items = rec.get("items", [])
+    if not _is_normalized_cart(items):
+        # not migrated yet (e.g. a tool run before the bot): normalize in memory only
+        return _normalize_cart_items(items, prods_by_id=_catalog_index()["by_id"])
+    # copies: the parsed file is shared by every reader
+    return [dict(it) for it in items]
 
 
 def is_in_cart(user_id: int, prod_id: int) -> bool:
@@ -330,9 +722,7 @@ def add_to_cart(user_id: int, prod_id: int, qty: int = 1, price=0):
             rec = {"user_id": int(user_id), "items": []}
             data.append(rec)
 
-        prods = read_json(PROD_FILE, default=[])
-        prods_by_id = {int(p.get("id")): p for p in prods if p.get("id") is not None}
-        items_norm = _normalize_cart_items(rec.get("items", []), prods_by_id=prods_by_id)
+        items_norm = _normalize_cart_items(rec.get("items", []), prods_by_id=_catalog_index()["by_id"])
 
         found = False
         for it in items_norm:
@@ -377,9 +767,7 @@ def remove_from_cart(user_id: int, prod_id: int):
         changed = False
         for r in data:
             if int(r.get("user_id", 0)) == int(user_id):
-                prods = read_json(PROD_FILE, default=[])
-                prods_by_id = {int(p.get("id")): p for p in prods if p.get("id") is not None}
-                items_norm = _normalize_cart_items(r.get("items", []), prods_by_id=prods_by_id)
+                items_norm = _normalize_cart_items(r.get("items", []), prods_by_id=_catalog_index()["by_id"])
                 new_items = [it for it in items_norm if int(it.get("product_id", 0)) != pid]
                 if new_items != items_norm:
                     r["items"] = new_items
@@ -389,211 +777,743 @@ def remove_from_cart(user_id: int, prod_id: int):
             write_json(CART_FILE, data)
 
 
-def _reserve_stock_for_pending(pending: dict) -> tuple[bool, str | None]:
-    """Reserve stock (decrement from products) for a pending order atomically under a file lock."""
-    try:
-        items = pending.get("items", []) or []
-    except Exception:
-        items = []
-    if not items:
-        return False, "Пустой заказ"
+# Saved addresses used to be a plain list per user; they now are {delivery: [pvz, ...]}.
+# Addresses from the old list (not tied to a delivery service) are kept under this key.
+LEGACY_ADDRESSES_KEY = "_addresses"
 
-    with _interprocess_lock(_products_lock_path()):
-        prods_all = read_json(PROD_FILE, default=[])
-        prods_by_id = {int(p.get("id")): p for p in prods_all if p.get("id") is not None}
 
-        # validate
-        for it in items:
-            try:
-                pid = int(it.get("product_id"))
-                qty = int(it.get("qty", 1) or 1)
-            except Exception:
-                return False, "Некорректные товары"
-            if qty < 1:
-                qty = 1
-            prod = prods_by_id.get(pid)
-            if not prod:
-                return False, "Один из товаров удалён"
-            stock = int(prod.get("stock", 0) or 0)
-            if stock < qty:
-                name = (prod.get("name") or f"#{pid}").strip()
-                return False, f"Недостаточно товара: {name} (доступно {stock})"
+def _migrate_carts() -> bool:
+    """Cart items: legacy bare product ids and partial dicts -> {product_id, qty, price}."""
+    with _interprocess_lock(_cart_lock_path()):
+        data = _read_cart_data()
+        prods_by_id = _catalog_index()["by_id"]
+        out = []
+        for rec in data:
+            if not isinstance(rec, dict):
+                continue
+            items = rec.get("items", [])
+            if not _is_normalized_cart(items):
+                rec = {**rec, "items": _normalize_cart_items(items, prods_by_id=prods_by_id)}
+            out.append(rec)
+        if out == data:
+            return False
+        write_json(CART_FILE, out)
+        return True
+
+
+def _migrate_addresses() -> bool:
+    """Saved addresses: legacy list per user -> {delivery: [...]} with the list under LEGACY_ADDRESSES_KEY."""
+    with _interprocess_lock(DATA_DIR / ".lock_addresses"):
+        data = read_json(ADDR_FILE, default={})
+        if not isinstance(data, dict):
+            return False
+        changed = False
+        for uid, raw in list(data.items()):
+            if isinstance(raw, list):
+                data[uid] = {LEGACY_ADDRESSES_KEY: raw} if raw else {}
+                changed = True
+        if changed:
+            write_json(ADDR_FILE, data)
+        return changed
 
-        # apply
-        for it in items:
-            pid = int(it.get("product_id"))
-            qty = int(it.get("qty", 1) or 1)
-            prod = prods_by_id.get(pid)
-            prod["stock"] = max(0, int(prod.get("stock", 0) or 0) - qty)
 
-        write_json(PROD_FILE, prods_all)
+def _stock_path(prod_id: int) -> Path:
+    return STOCK_DIR / f"{int(prod_id)}.json"
 
-    # mark reserved on pending
-    try:
-        from time import time
-        pending["reserved"] = True
-        pending["reserved_at"] = time()
-    except Exception:
-        pass
-    return True, None
 
+def _stock_lock_path(prod_id: int) -> Path:
+    return STOCK_DIR / f".lock_{int(prod_id)}"
 
-def _release_stock_for_pending(pending: dict) -> None:
-    """Release previously reserved stock back to products (best-effort)."""
-    try:
-        if not pending.get("reserved"):
-            return
-        items = pending.get("items", []) or []
-    except Exception:
-        return
-    if not items:
-        return
-    with _interprocess_lock(_products_lock_path()):
-        prods_all = read_json(PROD_FILE, default=[])
-        prods_by_id = {int(p.get("id")): p for p in prods_all if p.get("id") is not None}
-        for it in items:
-            try:
-                pid = int(it.get("product_id"))
-                qty = int(it.get("qty", 1) or 1)
-            except Exception:
-                continue
-            prod = prods_by_id.get(pid)
-            if not prod:
-                continue
-            prod["stock"] = int(prod.get("stock", 0) or 0) + max(1, qty)
-        write_json(PROD_FILE, prods_all)
 
+def _read_stock_counter(prod_id: int, cached: bool = True) -> dict | None:
+    path = _stock_path(prod_id)
+    data = _read_json_cached(path, default={}) if cached else read_json(path, default={})
+    return data if isinstance(data, dict) and "version" in data else None
 
-def add_to_fav(user_id: int, prod_id: int):
-    data = read_json(FAV_FILE)
-    rec = next((r for r in data if r.get("user_id") == user_id), None)
-    if not rec:
-        rec = {"user_id": user_id, "items": []}
-        data.append(rec)
-    if prod_id not in rec["items"]:
-        rec["items"].append(prod_id)
-    write_json(FAV_FILE, data)
 
+def product_stock(prod: dict) -> int:
+    """Current stock of a product: its ledger counter, or the products.json seed if it has none yet."""
+    counter = _read_stock_counter(prod.get("id")) if prod.get("id") is not None else None
+    if counter is not None:
+        return int(counter.get("stock", 0))
+    return int(prod.get("stock", 0) or 0)
 
-def get_favs(user_id: int):
-    data = read_json(FAV_FILE)
-    rec = next((r for r in data if r.get("user_id") == user_id), None)
-    return rec["items"] if rec else []
 
+_STOCK_LEVELS: dict = {"files": {}, "levels": {}}
 
-def clear_favs(user_id: int):
-    data = read_json(FAV_FILE)
-    data = [r for r in data if r.get("user_id") != user_id]
-    write_json(FAV_FILE, data)
 
+def stock_levels() -> dict:
+    """{product_id: stock} of every counter, for ranking many products at once.
 
-def is_admin(user_id: int) -> bool:
-    # read admins from persistent file
-    try:
-        admins = read_json(ADMINS_FILE)
-        # ensure ints
-        admins_int = [int(x) for x in admins]
-        return int(user_id) in admins_int
-    except Exception:
-        return user_id in ADMINS
+    Stats every counter but re-reads only those whose (inode, mtime, size) changed; each write
+    renames a new file in, so the inode alone catches it. Shared: do not mutate.
+    """
+    if not STOCK_DIR.exists():
+        return {}
+    old_files, old_levels = _STOCK_LEVELS["files"], _STOCK_LEVELS["levels"]
+    files = {}
+    levels = {}
+    for entry in os.scandir(STOCK_DIR):
+        name = entry.name
+        if not name.endswith(".json") or not name[:-5].isdigit():
+            continue
+        st = entry.stat()
+        pid = int(name[:-5])
+        files[pid] = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if old_files.get(pid) == files[pid] and pid in old_levels:
+            levels[pid] = old_levels[pid]
+        else:
+            data = read_json(Path(entry.path), default={})
+            levels[pid] = int(data.get("stock", 0)) if isinstance(data, dict) else 0
+    if files != old_files:
+        _STOCK_LEVELS.update(files=files, levels=levels)
+    return _STOCK_LEVELS["levels"]
 
 
-def read_orders():
-    return read_json(ORDERS_FILE)
+def _append_stock_ledger(entries: list[dict]) -> None:
+    # one small O_APPEND write per call, so lines from concurrent processes never interleave
+    with open(STOCK_LEDGER_FILE, "a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries))
 
 
-def write_orders(data):
-    write_json(ORDERS_FILE, data)
+# Seconds an applied operation key stays in its counter (see adjust_stock); longer than any pending order lives
+STOCK_OP_TTL = float(os.getenv("STOCK_OP_TTL", str(14 * 86400)))
 
 
-def get_orders_counts():
-    orders = read_orders()
-    counts = {"new": 0, "processing": 0, "done": 0, "cancelled": 0}
-    for o in orders:
-        st = o.get("status", "new")
-        if st == "new":
-            counts["new"] += 1
-        elif st == "processing":
-            counts["processing"] += 1
-        elif st == "done":
-            counts["done"] += 1
-        elif st == "cancelled":
-            counts["cancelled"] += 1
-    return counts
+def _cas_stock(prod_id: int, expected_version: int, stock: int, ops: dict | None = None) -> bool:
+    """Write {stock, ops, expected_version + 1} if the counter is still at expected_version (0: no counter yet).
 
+    Only this compare-and-write runs under the product's own lock; reading and deciding happen outside it,
+    so checkouts of different products never wait for each other.
+    """
+    with _interprocess_lock(_stock_lock_path(prod_id)):
+        current = _read_stock_counter(prod_id, cached=False)
+        if (current["version"] if current else 0) != expected_version:
+            return False
+        data = {"stock": stock, "version": expected_version + 1}
+        if ops:
+            data["ops"] = ops
+        write_json(_stock_path(prod_id), data)
+    return True
 
-def format_dt(ts: float):
-    from datetime import datetime
-    try:
-        return datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M")
-    except Exception:
-        return "-"
 
+def _open_stock_counter(prod_id: int, stock: int) -> bool:
+    """Create a product's counter at `stock` with an "init" ledger entry; False if it already exists."""
+    STOCK_DIR.mkdir(parents=True, exist_ok=True)
+    if not _cas_stock(prod_id, 0, stock):
+        return False
+    _append_stock_ledger([{"ts": time.time(), "product_id": int(prod_id), "delta": stock, "stock": stock,
+                           "version": 1, "reason": "init", "ref": None}])
+    return True
 
-def create_order(
-    user,
-    items,
-    address_text: str,
-    delivery_method: str = None,
-    *,
-    number: int | None = None,
-    payment_id: str | None = None,
-    created_at: float | None = None,
-):
-    """Create and persist an order.
 
-    `user` is a telegram-like User object, `items` is list of dicts with keys: product_id, name, qty, price.
-    If `number` is provided, it will be preserved (useful to match the payment description/order number).
+def adjust_stock(
+    prod_id: int,
+    delta: int,
+    reason: str,
+    ref=None,
+    *,
+    allow_short: bool = True,
+    op: str | None = None,
+    undo: str | None = None,
+) -> tuple[bool, int]:
+    """Add delta to a product's stock with optimistic retries and record it in the ledger.
+
+    Returns (applied, stock after). A decrement that would go below zero is clamped to zero, or
+    refused with (False, current stock) when allow_short is False. A product with no counter gets
+    one opened at its products.json seed first, so a product's ledger deltas always sum to its stock.
+
+    `op` names the change in the counter itself, atomically with it: repeating an op that is
+    already there changes nothing and returns (True, stock), so a retried step never counts twice.
+    `undo` reverses such an op: it applies only while that op is recorded and removes it, otherwise
+    it returns (False, stock). Op keys expire after STOCK_OP_TTL seconds.
     """
-    orders = read_orders()
-    new_id = get_next_id(orders)
-    order_number = int(number) if number is not None else (1000 + len(orders) + 1)
-    total = sum((it.get("price", 0) * it.get("qty", 1)) for it in items)
-    from time import time
-    now = time()
-    created_ts = float(created_at) if created_at is not None else now
-    # attach stored client profile if present
-    profiles = read_profiles()
-    profile = profiles.get(str(user.id), {})
-    order = {
-        "id": new_id,
-        "number": order_number,
-        "user_id": int(user.id),
-        "username": user.username or "",
-        "full_name": f"{user.first_name or ''} {user.last_name or ''}".strip(),
-        "items": items,
-        "total": total,
-        "address": address_text,
-        "delivery": delivery_method,
-        "status": "new",
-        "tracking_link": None,
-        "created_at": created_ts,
-        "updated_at": now,
-        "client": {
-            "first_name": profile.get("first_name"),
-            "last_name": profile.get("last_name"),
-            "phone": profile.get("phone"),
-        },
-    }
-    if payment_id:
-        order["payment_id"] = str(payment_id)
-    orders.append(order)
-    write_orders(orders)
-    return order
+    prod_id = int(prod_id)
+    while True:
+        current = _read_stock_counter(prod_id, cached=False)
+        if current is None:
+            seed = _catalog_index()["by_id"].get(prod_id) or {}
+            _open_stock_counter(prod_id, int(seed.get("stock", 0) or 0))
+            continue
+        version, stock = int(current["version"]), int(current.get("stock", 0))
+        ops = current.get("ops") or {}
+        if op is not None and op in ops:
+            return True, stock
+        if undo is not None and undo not in ops:
+            return False, stock
+        if stock + delta < 0 and not allow_short:
+            return False, stock
+        new_stock = max(0, stock + delta)
+        now = time.time()
+        new_ops = {k: ts for k, ts in ops.items() if k != undo and now - ts < STOCK_OP_TTL}
+        if op is not None:
+            new_ops[op] = now
+        if _cas_stock(prod_id, version, new_stock, new_ops):
+            break
+        METRICS.inc("stock.cas_retries")
+    _append_stock_ledger([{
+        "ts": now,
+        "product_id": prod_id,
+        "delta": new_stock - stock,
+        "stock": new_stock,
+        "version": version + 1,
+        "reason": reason,
+        "ref": ref,
+    }])
+    return True, new_stock
+
+
+def drop_stock(prod_id: int) -> None:
+    """Remove a deleted product's counter, so a product that later reuses the id starts from its own seed."""
+    prod_id = int(prod_id)
+    with _interprocess_lock(_stock_lock_path(prod_id)):
+        current = _read_stock_counter(prod_id, cached=False)
+        if current is None:
+            return
+        _stock_path(prod_id).unlink(missing_ok=True)
+    stock = int(current.get("stock", 0))
+    _append_stock_ledger([{"ts": time.time(), "product_id": prod_id, "delta": -stock, "stock": 0,
+                           "version": int(current["version"]) + 1, "reason": "delete", "ref": None}])
+
+
+def _migrate_stock() -> bool:
+    """Stock: products.json "stock" fields -> per-product counters in stock/, with an "init" ledger entry each."""
+    STOCK_DIR.mkdir(parents=True, exist_ok=True)
+    changed = False
+    for p in _read_json_cached(PROD_FILE, default=[]):
+        pid = p.get("id")
+        if pid is None or _read_stock_counter(pid, cached=False) is not None:
+            continue
+        changed = _open_stock_counter(pid, int(p.get("stock", 0) or 0)) or changed
+    return changed
 
 
-def find_order(order_id: int):
-    orders = read_orders()
-    return next((o for o in orders if o.get("id") == order_id), None)
+# (version, description, migration); append only, never renumber
+_MIGRATIONS = [
+    (1, "carts: normalized items", _migrate_carts),
+    (2, "addresses: per-delivery dict", _migrate_addresses),
+    (3, "stock: per-product counters and ledger", _migrate_stock),
+]
+
+
+def run_migrations() -> list[int]:
+    """Bring data files to the current layout once; returns the versions applied now.
+
+    Runs at startup (bot.py, api.py). The interprocess lock makes concurrent starters wait and
+    then find the work done; SCHEMA_FILE is advanced after every step, so a crash resumes there.
+    """
+    applied = []
+    with _interprocess_lock(DATA_DIR / ".lock_schema"):
+        schema = read_json(SCHEMA_FILE, default={})
+        version = int(schema.get("version", 0)) if isinstance(schema, dict) else 0
+        for ver, desc, migrate in _MIGRATIONS:
+            if ver <= version:
+                continue
+            changed = migrate()
+            log.info("data migration", extra={"version": ver, "description": desc, "changed": changed})
+            version = ver
+            write_json(SCHEMA_FILE, {"version": version, "applied_at": time.time()})
+            applied.append(ver)
+    return applied
+
+
+def _pending_stock_items(pending: dict) -> list[tuple[int, int]] | None:
+    """[(product_id, qty)] of a pending order, quantities of repeated products summed; None if malformed."""
+    qty_by_pid: dict[int, int] = {}
+    for it in pending.get("items", []) or []:
+        try:
+            pid = int(it.get("product_id"))
+            qty = int(it.get("qty", 1) or 1)
+        except Exception:
+            return None
+        qty_by_pid[pid] = qty_by_pid.get(pid, 0) + max(1, qty)
+    return sorted(qty_by_pid.items())
+
+
+def _reserve_op(ref) -> str:
+    return f"reserve:{ref}"
+
+
+def _undo_reservation(items: list[tuple[int, int]], ref, reason: str) -> None:
+    """Give back whatever part of the reservation `ref` the counters still hold; safe to repeat."""
+    for pid, qty in items:
+        adjust_stock(pid, qty, reason, ref, undo=_reserve_op(ref))
+
+
+def _reserve_stock_for_pending(pending: dict) -> tuple[bool, str | None]:
+    """Reserve stock for a pending order: all items or none.
+
+    Each product's counter is decremented on its own (see adjust_stock), tagged with the pending's
+    reserve op, so the counters themselves record what was taken. If one product is short, or any
+    step fails (LockTimeout, I/O), the taken ones are given back with "rollback" ledger entries.
+    """
+    items = _pending_stock_items(pending)
+    if items is None:
+        return False, "Некорректные товары"
+    if not items:
+        return False, "Пустой заказ"
+    ref = pending.get("number") or pending.get("id")
+    for pid, _ in items:
+        if find_product(pid) is None:
+            return False, "Один из товаров удалён"
+    try:
+        for pid, qty in items:
+            ok, stock = adjust_stock(pid, -qty, "reserve", ref, allow_short=False, op=_reserve_op(ref))
+            if not ok:
+                _undo_reservation(items, ref, "rollback")
+                name = ((find_product(pid) or {}).get("name") or f"#{pid}").strip()
+                return False, f"Недостаточно товара: {name} (доступно {stock})"
+    except Exception:
+        log.exception("stock reservation failed", extra={"order": ref})
+        try:
+            _undo_reservation(items, ref, "rollback")
+        except Exception:
+            # the counters still carry the reserve op: releasing this pending later gives it back
+            log.exception("stock rollback failed", extra={"order": ref})
+        return False, "Не удалось зарезервировать товар, попробуйте ещё раз"
+
+    # mark reserved on pending
+    pending["reserved"] = True
+    pending["reserved_at"] = time.time()
+    return True, None
+
+
+def _release_stock_for_pending(pending: dict) -> None:
+    """Give reserved stock back.
+
+    Only what the counters still record as reserved for this pending is returned, so this is safe
+    to repeat and also undoes a reservation that stopped halfway.
+    """
+    items = [(pid, qty) for pid, qty in _pending_stock_items(pending) or [] if find_product(pid) is not None]
+    _undo_reservation(items, pending.get("number") or pending.get("id"), "release")
+
+
+# Catalog writers. Each one is a read-modify-write under the categories/products lock, so admin edits,
+# stock reservations (bot.py) and payment webhooks (api.py) never overwrite each other's changes.
+# write_json publishes every new version with an atomic rename, so readers take no lock: they always
+# get a whole file, old or new (see _catalog_index for reading both files consistently).
+
+def add_category(name: str, parent_id: int | None = None) -> dict:
+    with _json_transaction(CATS_FILE, _categories_lock_path()) as cats:
+        item = {"id": get_next_id(cats), "name": name}
+        if parent_id is not None:
+            item["parent_id"] = parent_id
+        cats.append(item)
+    return item
+
+
+def rename_category(cat_id: int, name: str) -> bool:
+    with _json_transaction(CATS_FILE, _categories_lock_path()) as cats:
+        for c in cats:
+            if c["id"] == cat_id:
+                c["name"] = name
+                return True
+    return False
+
+
+def delete_category_tree(cat_id: int) -> None:
+    """Delete a category, its subcategories and every product in them."""
+    with _json_transaction(CATS_FILE, _categories_lock_path()) as cats:
+        doomed = {cat_id}
+        grew = True
+        while grew:
+            children = {c["id"] for c in cats if c.get("parent_id") in doomed}
+            grew = not children <= doomed
+            doomed |= children
+        # products go first: a reader between the two writes sees an empty category, never orphans
+        with _json_transaction(PROD_FILE, _products_lock_path()) as prods:
+            dropped = [p["id"] for p in prods if p.get("category_id") in doomed and p.get("id") is not None]
+            prods[:] = [p for p in prods if p.get("category_id") not in doomed]
+        cats[:] = [c for c in cats if c["id"] not in doomed]
+    for pid in dropped:
+        drop_stock(pid)
+
+
+def add_product(prod: dict) -> dict:
+    """Append a new product with the next free id and open its stock counter; returns it."""
+    with _json_transaction(PROD_FILE, _products_lock_path()) as prods:
+        prod["id"] = get_next_id(prods)
+        prods.append(prod)
+    # a counter left by an earlier product with this id must not carry over
+    drop_stock(prod["id"])
+    _open_stock_counter(prod["id"], int(prod.get("stock", 0) or 0))
+    return prod
+
+
+def update_product(prod_id: int, **fields) -> dict | None:
+    """Set fields on one product; returns a copy of the updated product or None if it does not exist."""
+    with _json_transaction(PROD_FILE, _products_lock_path()) as prods:
+        for p in prods:
+            if p.get("id") == prod_id:
+                p.update(fields)
+                return dict(p)
+    return None
+
+
+def restock_product(prod_id: int, qty: int) -> dict | None:
+    """Add qty to the product's stock counter; returns a copy of the product with its new stock, or None."""
+    prod = find_product(prod_id)
+    if prod is None:
+        return None
+    _, stock = adjust_stock(prod_id, qty, "restock")
+    return {**prod, "stock": stock}
+
+
+def delete_product(prod_id: int) -> dict | None:
+    """Remove a product; returns it, or None if it did not exist."""
+    with _json_transaction(PROD_FILE, _products_lock_path()) as prods:
+        for i, p in enumerate(prods):
+            if p.get("id") == prod_id:
+                removed = prods.pop(i)
+                break
+        else:
+            return None
+    drop_stock(prod_id)
+    return removed
+
+
+def add_to_fav(user_id: int, prod_id: int):
+    data = read_json(FAV_FILE)
+    rec = next((r for r in data if r.get("user_id") == user_id), None)
+    if not rec:
+        rec = {"user_id": user_id, "items": []}
+        data.append(rec)
+    if prod_id not in rec["items"]:
+        rec["items"].append(prod_id)
+    write_json(FAV_FILE, data)
+
+
+def get_favs(user_id: int):
+    data = read_json(FAV_FILE)
+    rec = next((r for r in data if r.get("user_id") == user_id), None)
+    return rec["items"] if rec else []
+
+
+def clear_favs(user_id: int):
+    data = read_json(FAV_FILE)
+    data = [r for r in data if r.get("user_id") != user_id]
+    write_json(FAV_FILE, data)
+
+
+def get_admin_ids() -> list[int]:
+    """Admin ids from admins.json; parsed again only when the file changes."""
+    return [int(x) for x in _read_json_cached(ADMINS_FILE, default=[])]
+
+
+def is_admin(user_id: int) -> bool:
+    # read admins from persistent file
+    try:
+        return int(user_id) in get_admin_ids()
+    except Exception:
+        return user_id in ADMINS
+
+
+class UserSnapshot:
+    """What a product card needs to know about one user: cart and favorite product ids, admin role.
+
+    Each part is read on first use, from the version-cached carts/favs/admins files (no lock, and
+    no cart migration write), and kept for the rest of the update. Handlers that change the cart
+    or favorites call invalidate() so a card rendered afterwards sees the change.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = int(user_id)
+        self._cart_ids: frozenset | None = None
+        self._fav_ids: frozenset | None = None
+        self._is_admin: bool | None = None
+
+    @property
+    def cart_ids(self) -> frozenset:
+        if self._cart_ids is None:
+            ids = set()
+            data = _read_json_cached(CART_FILE, default=[])
+            rec = next((r for r in data if isinstance(r, dict) and int(r.get("user_id", 0)) == self.user_id), None)
+            for it in (rec or {}).get("items") or []:
+                # new format {product_id, qty, price} or legacy bare product ids
+                raw = (it.get("product_id") if it.get("product_id") is not None else it.get("id")) if isinstance(it, dict) else it
+                try:
+                    ids.add(int(raw))
+                except Exception:
+                    pass
+            self._cart_ids = frozenset(ids)
+        return self._cart_ids
+
+    @property
+    def fav_ids(self) -> frozenset:
+        if self._fav_ids is None:
+            data = _read_json_cached(FAV_FILE, default=[])
+            rec = next((r for r in data if r.get("user_id") == self.user_id), None)
+            self._fav_ids = frozenset(rec["items"] if rec else [])
+        return self._fav_ids
+
+    @property
+    def is_admin(self) -> bool:
+        if self._is_admin is None:
+            self._is_admin = is_admin(self.user_id)
+        return self._is_admin
+
+    def in_cart(self, prod_id) -> bool:
+        try:
+            return int(prod_id) in self.cart_ids
+        except Exception:
+            return False
+
+    def in_favs(self, prod_id) -> bool:
+        return prod_id in self.fav_ids
+
+    def invalidate(self) -> None:
+        self._cart_ids = None
+        self._fav_ids = None
+
+
+def user_snapshot(context, user_id: int) -> UserSnapshot:
+    """The UserSnapshot of user_id for the update being handled (one per CallbackContext)."""
+    snap = getattr(context, "_user_snapshot", None)
+    if snap is None or snap.user_id != int(user_id):
+        snap = UserSnapshot(user_id)
+        try:
+            context._user_snapshot = snap
+        except Exception:
+            pass
+    return snap
+
+
+def read_orders():
+    return read_json(ORDERS_FILE)
+
+
+def write_orders(data):
+    write_json(ORDERS_FILE, data)
+
+
+def get_orders_counts():
+    by_status = _orders_index()["by_status"]
+    return {st: len(by_status.get(st, [])) for st in ("new", "processing", "done", "cancelled")}
+
+
+def format_dt(ts: float):
+    try:
+        return datetime.fromtimestamp(ts, SHOP_TZ).strftime("%d.%m.%Y %H:%M")
+    except Exception:
+        return "-"
+
+
+def shop_today() -> date:
+    return datetime.now(SHOP_TZ).date()
+
+
+def shop_day_start(day: date) -> float:
+    """Timestamp of midnight of `day` in SHOP_TZ."""
+    return datetime.combine(day, datetime.min.time(), tzinfo=SHOP_TZ).timestamp()
+
+
+class _RevenueIndex:
+    """Revenue of non-cancelled orders in daily buckets (days in SHOP_TZ), stored as prefix sums.
+
+    Shop totals for any [start, end] day range are two array lookups. Per-product sums keep a
+    cumulative list over the days that product sold on, so each product costs one bisect per bound.
+    """
+
+    def __init__(self, orders):
+        days: dict = defaultdict(lambda: [0.0, 0])
+        per_product: dict = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+        self.names: dict = {}
+        for o in orders:
+            if o.get("status") == "cancelled":
+                continue
+            try:
+                day = datetime.fromtimestamp(float(o.get("created_at") or 0), SHOP_TZ).date().toordinal()
+            except (TypeError, ValueError, OverflowError, OSError):
+                continue
+            bucket = days[day]
+            bucket[0] += float(o.get("total", 0) or 0)
+            bucket[1] += 1
+            for it in o.get("items", []):
+                pid = it.get("product_id")
+                try:
+                    qty = int(it.get("qty", 1))
+                    price = float(it.get("price", 0) or 0)
+                except (TypeError, ValueError):
+                    continue
+                sold = per_product[pid][day]
+                sold[0] += qty
+                sold[1] += qty * price
+                self.names[pid] = (it.get("name") or f"#{pid}").strip()
+        self.first = min(days) if days else shop_today().toordinal()
+        last = max(days) if days else self.first
+        # revenue[i] / orders[i]: sums over days first .. first + i - 1
+        self.revenue = [0.0]
+        self.orders = [0]
+        for day in range(self.first, last + 1):
+            bucket = days.get(day)
+            self.revenue.append(self.revenue[-1] + (bucket[0] if bucket else 0.0))
+            self.orders.append(self.orders[-1] + (bucket[1] if bucket else 0))
+        # product_id -> (sorted days, cumulative qty, cumulative revenue), each cumulative list starting with 0
+        self.products: dict = {}
+        for pid, by_day in per_product.items():
+            sold_days = sorted(by_day)
+            qty, rev = [0], [0.0]
+            for day in sold_days:
+                qty.append(qty[-1] + by_day[day][0])
+                rev.append(rev[-1] + by_day[day][1])
+            self.products[pid] = (sold_days, qty, rev)
+
+    def _bounds(self, start: date, end: date) -> tuple[int, int]:
+        n = len(self.revenue) - 1
+        lo = min(max(start.toordinal() - self.first, 0), n)
+        hi = min(max(end.toordinal() - self.first + 1, 0), n)
+        return lo, max(lo, hi)
+
+    def totals(self, start: date, end: date) -> tuple[float, int]:
+        """(revenue, orders) for the days start..end inclusive."""
+        lo, hi = self._bounds(start, end)
+        return self.revenue[hi] - self.revenue[lo], self.orders[hi] - self.orders[lo]
+
+    def by_product(self, start: date, end: date) -> dict:
+        """{product_id: (qty, revenue)} for products sold during start..end inclusive."""
+        a, b = start.toordinal(), end.toordinal()
+        out = {}
+        for pid, (sold_days, qty, rev) in self.products.items():
+            lo = bisect.bisect_left(sold_days, a)
+            hi = bisect.bisect_right(sold_days, b)
+            if hi > lo:
+                out[pid] = (qty[hi] - qty[lo], rev[hi] - rev[lo])
+        return out
+
+
+_REVENUE_INDEX: tuple = (None, None)
+
+
+def revenue_index() -> _RevenueIndex:
+    """_RevenueIndex over orders.json, rebuilt only when the file changes."""
+    global _REVENUE_INDEX
+    ver = _file_version(ORDERS_FILE)
+    if ver is None or _REVENUE_INDEX[0] != ver:
+        _REVENUE_INDEX = (ver, _RevenueIndex(_read_json_cached(ORDERS_FILE, default=[])))
+    return _REVENUE_INDEX[1]
+
+
+def revenue_report(start: date, end: date) -> dict:
+    """Revenue for the days start..end (inclusive, SHOP_TZ) with per-product and per-category breakdowns.
+
+    Products are grouped into categories by the current catalog; products no longer in it go to category None.
+    """
+    idx = revenue_index()
+    revenue, orders = idx.totals(start, end)
+    products = []
+    categories: dict = defaultdict(float)
+    for pid, (qty, rev) in idx.by_product(start, end).items():
+        prod = find_product(pid)
+        name = (prod.get("name") or "").strip().splitlines()[0] if prod and prod.get("name") else idx.names.get(pid, f"#{pid}")
+        products.append((pid, name, qty, rev))
+        categories[prod.get("category_id") if prod else None] += rev
+    products.sort(key=lambda p: p[3], reverse=True)
+    return {
+        "start": start,
+        "end": end,
+        "revenue": revenue,
+        "orders": orders,
+        "products": products,
+        "categories": sorted(categories.items(), key=lambda c: c[1], reverse=True),
+    }
+
+
+def create_order(
+    user,
+    items,
+    address_text: str,
+    delivery_method: str = None,
+    *,
+    number: int | None = None,
+    payment_id: str | None = None,
+    created_at: float | None = None,
+):
+    """Create and persist an order.
+
+    `user` is a telegram-like User object, `items` is list of dicts with keys: product_id, name, qty, price.
+    If `number` is provided, it will be preserved (useful to match the payment description/order number).
+    """
+    order, _ = create_order_once(
+        user,
+        items,
+        address_text,
+        delivery_method,
+        number=number,
+        payment_id=payment_id,
+        created_at=created_at,
+    )
+    return order
+
+
+def create_order_once(
+    user,
+    items,
+    address_text: str,
+    delivery_method: str = None,
+    *,
+    number: int | None = None,
+    payment_id: str | None = None,
+    created_at: float | None = None,
+) -> tuple[dict, bool]:
+    """Idempotent variant of `create_order`. Returns (order, created).
+
+    Runs as one transaction on orders.json, so concurrent finalizers (api.py workers,
+    the polling fallback, reconcile) cannot lose each other's appends. If an order with
+    the same `number` or `payment_id` already exists, it is returned with created=False.
+    """
+    from time import time
+    now = time()
+    created_ts = float(created_at) if created_at is not None else now
+    total = sum((it.get("price", 0) * it.get("qty", 1)) for it in items)
+    # attach stored client profile if present
+    profiles = read_profiles()
+    profile = profiles.get(str(user.id), {})
+    with _json_transaction(ORDERS_FILE, _orders_lock_path()) as orders:
+        for o in orders:
+            if number is not None and o.get("number") == int(number):
+                return o, False
+            if payment_id and str(o.get("payment_id")) == str(payment_id):
+                return o, False
+        new_id = get_next_id(orders)
+        order_number = int(number) if number is not None else (1000 + len(orders) + 1)
+        order = {
+            "id": new_id,
+            "number": order_number,
+            "user_id": int(user.id),
+            "username": user.username or "",
+            "full_name": f"{user.first_name or ''} {user.last_name or ''}".strip(),
+            "items": items,
+            "total": total,
+            "address": address_text,
+            "delivery": delivery_method,
+            "status": "new",
+            "tracking_link": None,
+            "created_at": created_ts,
+            "updated_at": now,
+            "client": {
+                "first_name": profile.get("first_name"),
+                "last_name": profile.get("last_name"),
+                "phone": profile.get("phone"),
+            },
+        }
+        if payment_id:
+            order["payment_id"] = str(payment_id)
+        orders.append(order)
+    return order, True
+
+
+def find_order(order_id: int):
+    """Order by id from the orders index (orders.json is re-read only after it changed); a private copy."""
+    order = _orders_index()["by_id"].get(order_id)
+    return copy.deepcopy(order) if order is not None else None
 
 
 def update_order(order):
-    orders = read_orders()
-    for i, o in enumerate(orders):
-        if o.get("id") == order.get("id"):
-            orders[i] = order
-            write_orders(orders)
-            return True
+    with _json_transaction(ORDERS_FILE, _orders_lock_path()) as orders:
+        for i, o in enumerate(orders):
+            if o.get("id") == order.get("id"):
+                orders[i] = order
+                return True
     return False
 
 
@@ -608,47 +1528,18 @@ def _orders_by_created_date():
 
 
 def compute_stats_summary():
-    from datetime import datetime, timedelta
-    orders = read_orders()
-    # exclude cancelled for revenue
-    non_cancel = [o for o in orders if o.get("status") != "cancelled"]
-    total_orders = len(orders)
-    total_revenue = sum(o.get("total", 0) for o in non_cancel)
-
-    now = datetime.now()
-    today = now.date()
-    yesterday = (now - timedelta(days=1)).date()
-    last7_from = (now - timedelta(days=6)).date()  # inclusive 7 days
-
-    def sum_for_date(target_date):
-        s = 0
-        for o in non_cancel:
-            try:
-                d = datetime.fromtimestamp(o.get("created_at", 0)).date()
-                if d == target_date:
-                    s += o.get("total", 0)
-            except Exception:
-                pass
-        return s
-
-    today_sum = sum_for_date(today)
-    yesterday_sum = sum_for_date(yesterday)
-    last7_sum = 0
-    for o in non_cancel:
-        try:
-            d = datetime.fromtimestamp(o.get("created_at", 0)).date()
-            if d >= last7_from:
-                last7_sum += o.get("total", 0)
-        except Exception:
-            pass
-
+    # revenue excludes cancelled orders; every figure is a prefix-sum lookup in revenue_index
+    idx = revenue_index()
+    counts = get_orders_counts()
+    today = shop_today()
+    yesterday = today - timedelta(days=1)
     return {
-        "total_orders": total_orders,
-        "total_revenue": total_revenue,
-        "today": today_sum,
-        "yesterday": yesterday_sum,
-        "last7": last7_sum,
-        "counts": get_orders_counts(),
+        "total_orders": sum(len(v) for v in _orders_index()["by_status"].values()),
+        "total_revenue": idx.totals(date.min, date.max)[0],
+        "today": idx.totals(today, today)[0],
+        "yesterday": idx.totals(yesterday, yesterday)[0],
+        "last7": idx.totals(today - timedelta(days=6), today)[0],  # inclusive 7 days
+        "counts": counts,
     }
 
 
@@ -705,7 +1596,7 @@ def read_notifications():
 
 
 def write_notifications(cfg):
-    NOTIF_FILE.write_text(json.dumps(cfg, ensure_ascii=False, indent=2), encoding="utf-8")
+    write_json(NOTIF_FILE, cfg)
 
 
 def get_recipients_list():
@@ -738,7 +1629,7 @@ def get_recipients_list():
             pass
     # exclude admins
     try:
-        adm = set(int(x) for x in read_json(ADMINS_FILE))
+        adm = set(get_admin_ids())
     except Exception:
         adm = set()
     users = users - adm
@@ -753,36 +1644,64 @@ def write_users(data):
     write_json(USERS_FILE, data)
 
 
+_KNOWN_USERS: tuple = (None, frozenset())
+
+
+def _known_user_ids() -> frozenset:
+    """users.json as a set, rebuilt only when the file changes."""
+    global _KNOWN_USERS
+    ver = _file_version(USERS_FILE)
+    if ver is None or _KNOWN_USERS[0] != ver:
+        ids = set()
+        for x in read_users() or []:
+            try:
+                ids.add(int(x))
+            except Exception:
+                pass
+        _KNOWN_USERS = (ver, frozenset(ids))
+    return _KNOWN_USERS[1]
+
+
 def add_user_if_new(user_id: int):
     try:
-        data = read_users()
-        # normalize to ints
-        ids = []
-        try:
-            ids = [int(x) for x in data]
-        except Exception:
+        if int(user_id) in _known_user_ids():
+            return False
+        with _json_transaction(USERS_FILE, DATA_DIR / ".lock_users", default=[]) as data:
+            # normalize to ints
             ids = []
-        if int(user_id) not in ids:
-            ids.append(int(user_id))
-            write_users(ids)
-            return True
+            try:
+                ids = [int(x) for x in data]
+            except Exception:
+                ids = []
+            if int(user_id) not in ids:
+                data[:] = ids + [int(user_id)]
+                return True
     except Exception:
         pass
     return False
 
 
 def save_broadcast_record(entry):
-    data = read_broadcasts()
-    data.append(entry)
-    write_broadcasts(data)
+    with _json_transaction(BROADS_FILE, _broadcasts_lock_path()) as data:
+        data.append(entry)
 
 
 def read_addresses():
     return read_json(ADDR_FILE, default={})
 
 
+def _legacy_addresses(addrs: dict, uid: str) -> list:
+    """A user's addresses saved before per-delivery PVZ lists (see LEGACY_ADDRESSES_KEY)."""
+    raw = addrs.get(uid)
+    if isinstance(raw, list):
+        return raw
+    if isinstance(raw, dict):
+        return raw.setdefault(LEGACY_ADDRESSES_KEY, [])
+    return []
+
+
 def write_addresses(data):
-    ADDR_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    write_json(ADDR_FILE, data)
 
 
 def read_profiles():
@@ -790,7 +1709,7 @@ def read_profiles():
 
 
 def write_profiles(data):
-    PROFILE_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    write_json(PROFILE_FILE, data)
 
 
 def read_pending_orders():
@@ -798,49 +1717,76 @@ def read_pending_orders():
 
 
 def write_pending_orders(data):
-    write_json(PENDING_FILE, data)
+    with _interprocess_lock(_pending_lock_path()):
+        write_json(PENDING_FILE, data)
+
+
+def find_pending_order(pending_id: int):
+    return next((p for p in read_pending_orders() if int(p.get("id", 0)) == int(pending_id)), None)
+
+
+def update_pending_order(pending_id: int, **fields) -> bool:
+    """Set fields on one pending order in a single locked transaction."""
+    with _json_transaction(PENDING_FILE, _pending_lock_path()) as pend:
+        for po in pend:
+            if int(po.get("id", 0)) == int(pending_id):
+                po.update(fields)
+                return True
+    return False
 
 
-def next_order_number():
+def remove_pending_order(pending_id: int | None = None, *, payment_id: str | None = None) -> bool:
+    """Remove a pending order by id or payment_id. Returns True if something was removed."""
+    with _json_transaction(PENDING_FILE, _pending_lock_path()) as pend:
+        before = len(pend)
+        pend[:] = [
+            p for p in pend
+            if not (
+                (pending_id is not None and int(p.get("id", 0)) == int(pending_id))
+                or (payment_id and str(p.get("payment_id")) == str(payment_id))
+            )
+        ]
+        return len(pend) != before
+
+
+def next_order_number(pend: list | None = None):
     # number independent sequence including pending
     orders = read_orders()
-    pend = read_pending_orders()
+    if pend is None:
+        pend = read_pending_orders()
     all_numbers = [o.get("number", 0) for o in orders + pend]
     return max(all_numbers, default=1000) + 1
 
 
 def create_pending_order(user, items, address_text: str, delivery_method: str | None, order_type: str | None = None):
     total = sum((it.get("price", 0) * it.get("qty", 1)) for it in items)
-    pend = read_pending_orders()
-    new_id = get_next_id(pend)
-    number = next_order_number()
     from time import time
     now = time()
     profiles = read_profiles()
     profile = profiles.get(str(user.id), {})
-    pending = {
-        "id": new_id,
-        "number": number,
-        "user_id": int(user.id),
-        "username": user.username or "",
-        "full_name": f"{user.first_name or ''} {user.last_name or ''}".strip(),
-        "items": items,
-        "total": total,
-        "address": address_text,
-        "delivery": delivery_method,
-        "status": "new",  # awaiting payment
-        "created_at": now,
-        "client": {
-            "first_name": profile.get("first_name"),
-            "last_name": profile.get("last_name"),
-            "phone": profile.get("phone"),
-        },
-        # preserve checkout source to allow cart cleanup on success
-        "type": order_type,
-        "payment_id": None,
-    }
-    pend.append(pending)
-    write_pending_orders(pend)
+    with _json_transaction(PENDING_FILE, _pending_lock_path()) as pend:
+        pending = {
+            "id": get_next_id(pend),
+            "number": next_order_number(pend),
+            "user_id": int(user.id),
+            "username": user.username or "",
+            "full_name": f"{user.first_name or ''} {user.last_name or ''}".strip(),
+            "items": items,
+            "total": total,
+            "address": address_text,
+            "delivery": delivery_method,
+            "status": "new",  # awaiting payment
+            "created_at": now,
+            "client": {
+                "first_name": profile.get("first_name"),
+                "last_name": profile.get("last_name"),
+                "phone": profile.get("phone"),
+            },
+            # preserve checkout source to allow cart cleanup on success
+            "type": order_type,
+            "payment_id": None,
+        }
+        pend.append(pending)
     return pending
 
 
@@ -973,46 +1919,59 @@ def create_yookassa_payment(order_like):
     return payment.confirmation.confirmation_url, payment.id
 
 
-async def notify_admin_low_stock(context: ContextTypes.DEFAULT_TYPE, product: dict):
-    text = (
-        "⚠️ *Мало товара*\n\n"
-        f"{(product.get('name') or '-').strip()}\n"
-        f"📦 Осталось: {product.get('stock', 0)} шт\n"
-        f"🆔 ID: {product.get('id')}"
-    )
-    admins = read_json(ADMINS_FILE)
-    for aid in admins:
+def _apply_order_stock(order: dict, reserved: bool) -> list[tuple[str, dict]]:
+    """Take a paid order's items out of stock and return the resulting ("out"|"low", product) events.
+
+    Reserved pendings already had their stock decremented at payment creation, so only the
+    current levels are inspected. Otherwise each product is decremented once under the order's
+    sale op, so running this again for the same order takes nothing more. At most one event per product.
+    """
+    events: dict[int, tuple[str, dict]] = {}
+    ref = order.get("number") or order.get("id")
+    qty_by_pid: dict[int, int] = {}
+    for it in order.get("items", []):
         try:
-            await context.bot.send_message(chat_id=aid, text=text, parse_mode="Markdown")
+            pid = int(it.get("product_id", 0))
+            qty = int(it.get("qty", 1))
         except Exception:
-            pass
-
-
-async def notify_admin_out_of_stock(context: ContextTypes.DEFAULT_TYPE, product: dict):
-    text = (
-        "⛔ *Товар закончился*\n\n"
-        f"{(product.get('name') or '-').strip()}\n"
-        f"🆔 ID: {product.get('id')}"
-    )
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Пополнить товар", callback_data=f"admin_restock:{product.get('id')}")]
-    ])
-    admins = read_json(ADMINS_FILE)
-    for aid in admins:
+            continue
+        qty_by_pid[pid] = qty_by_pid.get(pid, 0) + qty
+    for pid, qty in qty_by_pid.items():
+        p = find_product(pid)
+        if not p:
+            continue
+        if reserved:
+            new_stock = product_stock(p)
+            crossed_low = True
+        else:
+            _, new_stock = adjust_stock(pid, -qty, "sale", ref, op=f"sale:{ref}" if ref is not None else None)
+            crossed_low = new_stock + qty > 3
+        if new_stock == 0:
+            events[pid] = ("out", {**p, "stock": new_stock})
+        elif new_stock <= 3 and crossed_low:
+            events[pid] = ("low", {**p, "stock": new_stock})
+    return list(events.values())
+
+
+def settle_paid_order(order: dict, pending: dict) -> list[tuple[str, dict]]:
+    """Finish a paid pending order whose order already exists: take the stock, clear the cart, drop the pending.
+
+    The pending entry goes last, so if a step raises (LockTimeout) it stays and the next attempt -
+    webhook redelivery, polling or reconcile - settles it again; stock is taken once per order
+    however often this runs. Returns the stock events of _apply_order_stock.
+    """
+    events = _apply_order_stock(order, pending.get("reserved"))
+    if pending.get("type") == "cart" and pending.get("user_id"):
         try:
-            await context.bot.send_message(chat_id=aid, text=text, reply_markup=keyboard, parse_mode="Markdown")
+            clear_cart(int(pending["user_id"]))
         except Exception:
-            pass
+            log.exception("clearing a paid cart failed", extra={"order": order.get("number")})
+    remove_pending_order(pending.get("id"))
+    return events
 
 
-async def notify_admin_new_order(context: ContextTypes.DEFAULT_TYPE, order: dict):
-    """Notify admins that a new paid order was created."""
-    try:
-        admins = read_json(ADMINS_FILE)
-    except Exception:
-        admins = []
-    if not admins:
-        return
+def _admin_order_digest(order: dict, events: list) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Single admin message for a paid order: order summary plus every stock alert it caused."""
     items = order.get("items", []) or []
     lines = []
     for it in items[:10]:
@@ -1021,7 +1980,7 @@ async def notify_admin_new_order(context: ContextTypes.DEFAULT_TYPE, order: dict
         lines.append(f"… ещё {len(items) - 10} поз.")
     delivery = order.get("delivery") or "-"
     text = (
-        "🆕 *Новый оплаченный заказ*\n\n"
+        "🆕 Новый оплаченный заказ\n\n"
         f"🧾 Заказ #{order.get('number')}\n"
         f"💰 Сумма: {order.get('total', 0)} ₽\n"
         f"🚚 Доставка: {delivery}\n"
@@ -1029,38 +1988,434 @@ async def notify_admin_new_order(context: ContextTypes.DEFAULT_TYPE, order: dict
         f"👤 Клиент: @{order.get('username','')} (ID {order.get('user_id')})\n\n"
         "📦 Товары:\n" + ("\n".join(lines) if lines else "• -")
     )
-    for aid in admins:
-        try:
-            await context.bot.send_message(chat_id=aid, text=text, parse_mode="Markdown")
-        except Exception:
-            pass
+    out = [p for kind, p in events if kind == "out"]
+    low = [p for kind, p in events if kind == "low"]
+    if out:
+        text += "\n\n⛔ Товар закончился:\n" + "\n".join(
+            f"• {(p.get('name') or '-').strip()} (ID {p.get('id')})" for p in out
+        )
+    if low:
+        text += "\n\n⚠️ Мало товара:\n" + "\n".join(
+            f"• {(p.get('name') or '-').strip()} — осталось {p.get('stock', 0)} шт (ID {p.get('id')})" for p in low
+        )
+    markup = None
+    if out:
+        markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"➕ Пополнить: {(p.get('name') or '-').strip()[:30]}", callback_data=f"admin_restock:{p.get('id')}")]
+            for p in out[:8]
+        ])
+    return text, markup
 
 
-async def do_send_broadcast(context, text: str, photo: str | None, recipients: list):
-    delivered = 0
-    bot = context.bot
-    for uid in recipients:
+async def send_to_admins(bot, text: str, reply_markup=None) -> dict:
+    """Send one message to every admin concurrently (shares the fan-out rate limit)."""
+    try:
+        admins = get_admin_ids()
+    except Exception:
+        admins = []
+
+    async def send_one(aid):
+        await bot.send_message(chat_id=aid, text=text, reply_markup=reply_markup)
+
+    return await fanout_send(admins, send_one)
+
+
+async def notify_admins_order_paid(bot, order: dict, events: list) -> None:
+    text, markup = _admin_order_digest(order, events)
+    try:
+        await send_to_admins(bot, text, reply_markup=markup)
+    except Exception as e:
+        log.warning("admin alert failed: %s", e, extra={"order": order.get("number")})
+
+
+_ADMIN_ALERT_TASKS: set[asyncio.Task] = set()
+
+
+def dispatch_admin_order_alerts(bot, order: dict, events: list) -> None:
+    """Schedule the admin digest for a paid order without making the caller wait for it."""
+    task = asyncio.create_task(notify_admins_order_paid(bot, order, events))
+    _ADMIN_ALERT_TASKS.add(task)
+    task.add_done_callback(_ADMIN_ALERT_TASKS.discard)
+
+
+class _TokenBucket:
+    """Async token bucket shared by all fan-outs of this process (Telegram counts per bot, not per job)."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(0.1, float(rate))
+        self.capacity = max(1.0, float(capacity or rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for `seconds` (used when Telegram answers RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + float(seconds))
+        self._tokens = 0.0
+        # refill restarts when the pause ends, not from the last send before it
+        self._updated = self._paused_until
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_SEND_BUCKET: _TokenBucket | None = None
+_CHAT_LAST_SEND: dict[int, float] = {}
+
+
+def _send_bucket() -> _TokenBucket:
+    global _SEND_BUCKET
+    if _SEND_BUCKET is None:
+        _SEND_BUCKET = _TokenBucket(float(os.getenv("BROADCAST_RATE", "30")))
+    return _SEND_BUCKET
+
+
+async def _wait_chat_slot(chat_id: int) -> None:
+    """Keep at least BROADCAST_CHAT_INTERVAL seconds between messages to the same chat."""
+    interval = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1"))
+    now = time.monotonic()
+    last = _CHAT_LAST_SEND.get(chat_id, 0.0)
+    _CHAT_LAST_SEND[chat_id] = max(now, last + interval)
+    if last + interval > now:
+        await asyncio.sleep(last + interval - now)
+    if len(_CHAT_LAST_SEND) > 100_000:
+        cutoff = time.monotonic() - interval
+        for cid in [c for c, ts in _CHAT_LAST_SEND.items() if ts < cutoff]:
+            _CHAT_LAST_SEND.pop(cid, None)
+
+
+def _is_dead_chat_error(err: Exception) -> bool:
+    if isinstance(err, Forbidden):
+        return True
+    if isinstance(err, BadRequest):
+        msg = str(err).lower()
+        return "chat not found" in msg or "user is deactivated" in msg or "peer_id_invalid" in msg
+    return False
+
+
+async def fanout_send(recipients, send_one, concurrency: int | None = None) -> dict:
+    """Send to many chats with bounded concurrency under the global rate limit.
+
+    `send_one(chat_id)` is a coroutine function doing the actual Bot API call. RetryAfter
+    pauses every sender for the requested time and the message is retried. Returns counters:
+    sent, blocked (bot blocked / chat gone), failed, throttled (RetryAfter hits), skipped
+    (already known dead, not contacted) and `blocked_ids` with the chats that turned out to be
+    dead - those are remembered in dead_recipients.json and skipped by later fan-outs.
+    """
+    if concurrency is None:
+        concurrency = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+    max_retries = int(os.getenv("BROADCAST_MAX_RETRIES", "5"))
+    bucket = _send_bucket()
+    stats = {"sent": 0, "blocked": 0, "failed": 0, "throttled": 0, "skipped": 0, "blocked_ids": []}
+    recipients = list(recipients)
+    dead = get_dead_recipients()
+    if dead:
+        alive = [uid for uid in recipients if str(uid) not in dead]
+        stats["skipped"] = len(recipients) - len(alive)
+        recipients = alive
+    it = iter(recipients)
+
+    async def worker():
+        for chat_id in it:
+            try:
+                chat_id = int(chat_id)
+            except Exception:
+                stats["failed"] += 1
+                continue
+            attempt = 0
+            while True:
+                await bucket.acquire()
+                await _wait_chat_slot(chat_id)
+                try:
+                    await send_one(chat_id)
+                    stats["sent"] += 1
+                    break
+                except RetryAfter as e:
+                    stats["throttled"] += 1
+                    retry_after = e.retry_after
+                    if not isinstance(retry_after, (int, float)):
+                        retry_after = retry_after.total_seconds()
+                    bucket.pause(float(retry_after) + 0.5)
+                except Exception as e:
+                    if _is_dead_chat_error(e):
+                        stats["blocked"] += 1
+                        stats["blocked_ids"].append(chat_id)
+                        break
+                    # BadRequest is a NetworkError subclass in PTB but retrying it is pointless
+                    transient = isinstance(e, (TimedOut, NetworkError)) and not isinstance(e, BadRequest)
+                    if not transient or attempt >= max_retries:
+                        stats["failed"] += 1
+                        break
+                    await asyncio.sleep(min(30, 2 ** attempt))
+                attempt += 1
+                if attempt > max_retries:
+                    stats["failed"] += 1
+                    break
+
+    if recipients:
+        await asyncio.gather(*(worker() for _ in range(max(1, min(int(concurrency), len(recipients))))))
+    if stats["blocked_ids"]:
         try:
-            if photo:
-                await bot.send_photo(chat_id=uid, photo=photo, caption=text)
-            else:
-                await bot.send_message(chat_id=uid, text=text)
-            delivered += 1
-        except Exception:
-            # skip users who blocked bot
-            continue
-    return delivered
+            await run_blocking(mark_recipients_dead, stats["blocked_ids"])
+        except Exception as e:
+            log.warning("mark_recipients_dead failed: %s", e)
+    return stats
+
 
+def _broadcast_sender(bot, text: str, photo: str | None):
+    async def send_one(uid):
+        if photo:
+            await bot.send_photo(chat_id=uid, photo=photo, caption=text)
+        else:
+            await bot.send_message(chat_id=uid, text=text)
+    return send_one
+
+
+async def do_send_broadcast(context, text: str, photo: str | None, recipients: list) -> dict:
+    return await fanout_send(recipients, _broadcast_sender(context.bot, text, photo))
+
+
+def _broadcast_job_path(job_id: int) -> Path:
+    return BROADCAST_JOBS_DIR / f"job_{int(job_id)}.json"
+
+
+def create_broadcast_job(text: str, photo: str | None, recipients: list, job_type: str = "manual") -> dict:
+    """Persist a broadcast as a resumable job: history record in broadcasts.json + recipient list file."""
+    with _json_transaction(BROADS_FILE, _broadcasts_lock_path()) as data:
+        job = {
+            "id": get_next_id(data),
+            "type": job_type,
+            "text": text,
+            "photo": photo,
+            "recipients": len(recipients),
+            "cursor": 0,
+            "status": "running",
+            "delivered": 0,
+            "blocked": 0,
+            "failed": 0,
+            "throttled": 0,
+            "skipped": 0,
+            "created_at": time.time(),
+        }
+        BROADCAST_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        write_json(_broadcast_job_path(job["id"]), [int(u) for u in recipients])
+        data.append(job)
+    return job
+
+
+def update_broadcast_job(job_id: int, **fields) -> dict | None:
+    with _json_transaction(BROADS_FILE, _broadcasts_lock_path()) as data:
+        for b in data:
+            if b.get("id") == job_id:
+                b.update(fields)
+                return dict(b)
+    return None
+
+
+def find_broadcast_job(job_id: int) -> dict | None:
+    return next((b for b in read_broadcasts() if b.get("id") == job_id), None)
+
+
+class _BroadcastControl:
+    """In-process pause/cancel switches for a running broadcast job."""
+
+    def __init__(self):
+        self.resume = asyncio.Event()
+        self.resume.set()
+        self.cancelled = False
+
+
+_BROADCAST_CONTROLS: dict[int, _BroadcastControl] = {}
+_BROADCAST_TASKS: dict[int, asyncio.Task] = {}
+
+
+def _broadcast_progress_view(job: dict, rate: float | None = None) -> tuple[str, InlineKeyboardMarkup | None]:
+    total = int(job.get("recipients", 0) or 0)
+    done = int(job.get("cursor", 0) or 0)
+    status = job.get("status")
+    title = {
+        "running": "📤 Рассылка идёт",
+        "paused": "⏸ Рассылка на паузе",
+        "cancelled": "⛔ Рассылка отменена",
+        "done": "✅ Рассылка завершена",
+    }.get(status, "📢 Рассылка")
+    lines = [
+        f"{title} (#{job.get('id')})",
+        "",
+        f"Отправлено: {done} из {total}",
+        f"✅ Доставлено: {job.get('delivered', 0)}",
+        f"🚫 Заблокировали бота: {job.get('blocked', 0)}",
+        f"⚠️ Ошибок: {job.get('failed', 0)}",
+        f"⏳ Ограничений Telegram: {job.get('throttled', 0)}",
+    ]
+    if job.get("skipped"):
+        lines.append(f"⏭ Пропущено (бот заблокирован ранее): {job.get('skipped')}")
+    if status == "running" and rate:
+        eta = int((total - done) / rate) if rate > 0 else 0
+        lines.append(f"\n🚀 Скорость: {rate:.1f} сообщ/с\n🕒 Осталось: ~{eta // 60} мин {eta % 60} с")
+    jid = job.get("id")
+    if status == "running":
+        markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("⏸ Пауза", callback_data=f"bcast_pause:{jid}"),
+            InlineKeyboardButton("⛔ Отменить", callback_data=f"bcast_cancel:{jid}"),
+        ]])
+    elif status == "paused":
+        markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("▶️ Продолжить", callback_data=f"bcast_resume:{jid}"),
+            InlineKeyboardButton("⛔ Отменить", callback_data=f"bcast_cancel:{jid}"),
+        ]])
+    else:
+        markup = None
+    return "\n".join(lines), markup
+
+
+async def _show_broadcast_progress(bot, job: dict, rate: float | None = None) -> None:
+    chat_id = job.get("progress_chat")
+    msg_id = job.get("progress_msg")
+    if not chat_id or not msg_id:
+        return
+    text, markup = _broadcast_progress_view(job, rate)
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=text, reply_markup=markup)
+    except Exception:
+        # "message is not modified" or the admin deleted the message - progress is best-effort
+        pass
+
+
+async def run_broadcast_job(bot, job_id: int) -> dict | None:
+    """Send a broadcast job from its saved cursor, checkpointing every BROADCAST_CHECKPOINT_EVERY sends.
+
+    After a crash/restart at most one checkpoint window is re-sent. Progress is reported by
+    editing the job's progress message; pause/cancel are honoured between windows.
+    """
+    job = find_broadcast_job(job_id)
+    if not job or job.get("status") != "running":
+        return job
+    recipients = read_json(_broadcast_job_path(job_id), default=[])
+    every = max(1, int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "100")))
+    progress_every = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+    send_one = _broadcast_sender(bot, job.get("text", ""), job.get("photo"))
+    control = _BROADCAST_CONTROLS.setdefault(job_id, _BroadcastControl())
+
+    cursor = int(job.get("cursor", 0) or 0)
+    started, started_cursor, last_progress = time.monotonic(), cursor, 0.0
+    while cursor < len(recipients) and not control.cancelled:
+        if not control.resume.is_set():
+            job = await run_blocking(update_broadcast_job, job_id, status="paused") or job
+            await _show_broadcast_progress(bot, job)
+            await control.resume.wait()
+            if control.cancelled:
+                break
+            job = await run_blocking(update_broadcast_job, job_id, status="running") or job
+            started, started_cursor = time.monotonic(), cursor
+        chunk = recipients[cursor:cursor + every]
+        stats = await fanout_send(chunk, send_one)
+        cursor += len(chunk)
+        job["cursor"] = cursor
+        for key, src in (("delivered", "sent"), ("blocked", "blocked"), ("failed", "failed"), ("throttled", "throttled"), ("skipped", "skipped")):
+            job[key] = int(job.get(key, 0) or 0) + stats[src]
+        job = await run_blocking(
+            update_broadcast_job,
+            job_id,
+            cursor=cursor,
+            delivered=job["delivered"],
+            blocked=job["blocked"],
+            failed=job["failed"],
+            throttled=job["throttled"],
+            skipped=job["skipped"],
+        ) or job
+        now = time.monotonic()
+        if now - last_progress >= progress_every:
+            last_progress = now
+            rate = (cursor - started_cursor) / max(0.001, now - started)
+            await _show_broadcast_progress(bot, job, rate)
+
+    job = await run_blocking(
+        update_broadcast_job, job_id, status="cancelled" if control.cancelled else "done", finished_at=time.time()
+    ) or job
+    try:
+        _broadcast_job_path(job_id).unlink()
+    except FileNotFoundError:
+        pass
+    _BROADCAST_CONTROLS.pop(job_id, None)
+    await _show_broadcast_progress(bot, job)
+    return job
+
+
+def start_broadcast_job(bot, job_id: int) -> bool:
+    """Run a job as a background task (no-op if it is already running in this process)."""
+    task = _BROADCAST_TASKS.get(job_id)
+    if task and not task.done():
+        return False
+    task = asyncio.create_task(run_broadcast_job(bot, job_id))
+    _BROADCAST_TASKS[job_id] = task
+    task.add_done_callback(lambda _t, jid=job_id: _BROADCAST_TASKS.pop(jid, None))
+    return True
+
+
+async def resume_broadcast_jobs(app) -> None:
+    """Restart broadcast jobs that were interrupted by a restart or crash (paused ones wait for the admin)."""
+    for job in read_broadcasts():
+        if job.get("status") == "running":
+            start_broadcast_job(app.bot, int(job.get("id")))
+
+
+_FANOUT_TASKS: set[asyncio.Task] = set()
 
-async def notify_new_product(context: ContextTypes.DEFAULT_TYPE, product: dict):
-    """Notify all users about a newly added product using notifications settings."""
+
+def _fanout_counts(stats: dict) -> dict:
+    return {k: stats[k] for k in ("sent", "blocked", "failed", "throttled", "skipped")}
+
+
+def _fanout_report(stats: dict) -> str:
+    return (
+        f"✅ Доставлено: {stats['sent']} · 🚫 Заблокировали: {stats['blocked']} · ❌ Ошибки: {stats['failed']}"
+        f"\n⏭ Пропущено: {stats['skipped']} · ⏳ RetryAfter: {stats['throttled']}"
+    )
+
+
+def start_fanout(coro, name: str) -> asyncio.Task:
+    """Run a one-off fan-out (product notifications) as a background task.
+
+    A handler that awaited it would hold its chat's slot in ChatOrderedUpdateProcessor for the
+    whole send - about half an hour for 50k users at BROADCAST_RATE=30.
+    """
+    task = asyncio.create_task(coro, name=name)
+    _FANOUT_TASKS.add(task)
+
+    def done(t: asyncio.Task) -> None:
+        _FANOUT_TASKS.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            log.error("fan-out failed", exc_info=t.exception(), extra={"fanout": name})
+
+    task.add_done_callback(done)
+    return task
+
+
+async def notify_new_product(context: ContextTypes.DEFAULT_TYPE, product: dict) -> dict | None:
+    """Notify all users about a newly added product using notifications settings; returns the fanout_send counts.
+
+    Long for many users: run it with start_fanout, not inline in a handler.
+    """
     try:
         cfg = read_notifications()
     except Exception:
         cfg = {}
     np = cfg.get("new_product", {})
     if not np.get("enabled"):
-        return
+        return None
     template = np.get(
         "template",
         "🆕 Появился новый товар!\n\n{name}\n💰 Цена: {price}\n\n👇 Нажмите, чтобы посмотреть",
@@ -1078,12 +2433,16 @@ async def notify_new_product(context: ContextTypes.DEFAULT_TYPE, product: dict):
 
     recipients = get_recipients_list()
     bot = context.bot
-    for uid in recipients:
-        try:
-            await bot.send_message(chat_id=uid, text=text, reply_markup=keyboard)
-        except Exception:
-            # ignore users who blocked the bot or errors
-            pass
+
+    async def send_one(uid):
+        await bot.send_message(chat_id=uid, text=text, reply_markup=keyboard)
+
+    stats = await fanout_send(recipients, send_one)
+    log.info("new product fan-out done", extra={"product_id": product.get("id"), **_fanout_counts(stats)})
+    await send_to_admins(
+        bot, f"📢 Уведомление о новом товаре «{product.get('name', 'Товар')}» разослано\n{_fanout_report(stats)}"
+    )
+    return stats
 
 
 def admin_keyboard():
@@ -1104,11 +2463,31 @@ def user_main_keyboard():
     return ReplyKeyboardMarkup([["📂 Каталоги", "🛒 Корзина"], ["⭐ Избранное", "📦 Мои заказы"], ["ℹ️ О магазине"]], resize_keyboard=True)
 
 
+async def revive_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs before every other handler: keeps dead_recipients.json in sync with what users do.
+
+    Blocking the bot in a private chat marks the user dead right away; any other update from
+    a user (a message, a button, unblocking) puts them back into fan-outs.
+    """
+    user = update.effective_user
+    if not user:
+        return
+    try:
+        member = update.my_chat_member
+        if member and member.chat.type == "private" and member.new_chat_member.status == "kicked":
+            await run_blocking(mark_recipients_dead, [user.id])
+        elif str(user.id) in get_dead_recipients():
+            await run_blocking(revive_recipient, user.id)
+    except Exception as e:
+        log.warning("revive_handler failed: %s", e, extra={"user_id": user.id})
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     # ensure we track this user for broadcasts
     try:
-        add_user_if_new(user_id)
+        if int(user_id) not in _known_user_ids():
+            await run_blocking(add_user_if_new, user_id)
     except Exception:
         pass
     text = (
@@ -1124,528 +2503,644 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(text, reply_markup=user_main_keyboard())
 
 
-async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = update.message.text
-    user_id = update.effective_user.id
-    try:
-        print(f"MSG from {user_id}: text={text}")
-    except Exception:
-        print("MSG received: (unable to read user/text)")
-    # track user activity for broadcasts
-    try:
-        add_user_if_new(user_id)
-    except Exception:
-        pass
-    # allow user to cancel any in-progress operation via text
-    if text in ("Отмена", "❌ Отмена", "/cancel"):
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        await update.message.reply_text("Отменено.")
-        return
-    # user menu: handle these texts for all users (admins too)
-    t = text.strip()
-    if t == "📂 Каталоги":
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        await show_user_categories(update, context)
-        return
-    if t == "🛒 Корзина":
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        await show_user_cart(update, context)
-        return
-    if t == "⭐ Избранное":
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        await show_user_favorites(update, context)
-        return
-    if t == "📦 Мои заказы":
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        await show_user_orders(update, context)
-        return
-    if t == "ℹ️ О магазине":
-        text_info = (
-            "🏪 *Информация о магазине*\n\n"
-            "Мы — онлайн-магазин.\n"
-            "Работаем через Telegram-бота.\n\n"
-            "📦 Что умеет бот:\n"
-            "• Просмотр каталога товаров\n"
-            "• Добавление в корзину и избранное\n"
-            "• Оформление заказа\n"
-            "• Выбор доставки\n"
-            "• Просмотр статуса заказов\n\n"
-            "📞 Поддержка:\n"
-            "Если возникли вопросы — напишите в поддержку:\n"
-            "👉 @asudarew\n\n"
-            "⏰ Поддержка отвечает в рабочее время"
-        )
-        await update.message.reply_text(text_info, parse_mode="Markdown")
-        return
-    # allow entering product name even if we're in photos-collecting state
-    state = context.user_data.get("state")
-    if state and state.startswith("addprod_photos:"):
-        _, cat_id = state.split(":")
-        cat_id = int(cat_id)
-        newp = context.user_data.get("new_product") or {"photos": [], "category_id": cat_id}
-        newp["name"] = text.strip()
-        newp["category_id"] = cat_id
-        context.user_data["new_product"] = newp
-        context.user_data["state"] = f"addprod_desc:{cat_id}"
-        await update.message.reply_text("✅ Название добавлено\n✏️ Введите описание товара")
-        return
-    if text == "🛠 Админ панель" and is_admin(user_id):
-        await update.message.reply_text("Вы в админ-панели:", reply_markup=admin_menu_keyboard())
-        return
+class _Histogram:
+    """Latency histogram with fixed bucket bounds (seconds)."""
 
-    if text == "📂 Каталог" and is_admin(user_id):
-        await show_categories(update, context)
-        return
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
 
-    if text == "📦 Заказы" and is_admin(user_id):
-        await show_orders_admin(update, context)
-        return
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
 
-    if text == "📊 Статистика" and is_admin(user_id):
-        await show_stats_admin(update, context)
-        return
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
 
-    # Settings removed from admin menu
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation (max for the overflow bucket)."""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return 0.0
 
-    if text == "📢 Рассылка" and is_admin(user_id):
-        await show_broadcast_menu(update, context)
-        return
 
-    if text == "🔙 Выйти из админки" and is_admin(user_id):
-        await update.message.reply_text("Вы вышли из админки.", reply_markup=admin_keyboard())
-        return
+class Metrics:
+    """In-process counters and latency histograms. Per process, reset on restart; see /metrics."""
 
-    # user-facing catalogs/cart/favs/orders handled above for all users
+    def __init__(self):
+        self.counters: dict[str, int] = defaultdict(int)
+        self.histograms: dict[str, _Histogram] = defaultdict(_Histogram)
 
-    if text == "🔙 Назад" and is_admin(user_id):
-        await update.message.reply_text("Возврат.", reply_markup=admin_keyboard())
-        return
+    def inc(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
 
-    state = context.user_data.get("state")
-    if state == "adding_category":
-        name = text.strip()
-        cats = read_json(CATS_FILE)
-        new_id = get_next_id(cats)
-        parent = context.user_data.pop("parent_cat", None)
-        item = {"id": new_id, "name": name}
-        if parent is not None:
-            item["parent_id"] = parent
-        cats.append(item)
-        write_json(CATS_FILE, cats)
-        await update.message.reply_text(f"✅ Каталог «{name}» успешно создан")
-        context.user_data.pop("state", None)
-        # if created as subcategory, reopen parent view, otherwise show root categories
-        if parent is not None:
-                await show_category(update.message, context, parent)
-        else:
-            await show_categories(update, context)
-        return
+    def observe(self, name: str, seconds: float) -> None:
+        self.histograms[name].observe(seconds)
 
-    if state == "adding_admin":
-        text_id = text.strip()
-        try:
-            aid = int(text_id)
-        except ValueError:
-            await update.message.reply_text("Неверный ID. Введите numeric ID пользователя.")
-            return
-        add_admin(aid)
-        context.user_data.pop("state", None)
-        await update.message.reply_text(f"✅ Админ {aid} добавлен.")
-        await update.message.reply_text("Вы в админ-панели:", reply_markup=admin_menu_keyboard())
-        return
+    def render(self, prefix: str = "") -> str:
+        lines = []
+        for name in sorted(self.histograms):
+            if not name.startswith(prefix):
+                continue
+            h = self.histograms[name]
+            lines.append(
+                f"{name}: n={h.count} avg={h.total / h.count * 1000:.1f}ms "
+                f"p50≤{h.quantile(0.5) * 1000:.0f}ms p95≤{h.quantile(0.95) * 1000:.0f}ms max={h.max * 1000:.0f}ms"
+            )
+        for name in sorted(self.counters):
+            if name.startswith(prefix):
+                lines.append(f"{name}: {self.counters[name]}")
+        return "\n".join(lines)
 
-    if state and state.startswith("admin_adding_tracking:"):
-        _, oid = state.split(":",1)
-        try:
-            oid = int(oid)
-        except Exception:
-            context.user_data.pop("state", None)
-            await update.message.reply_text("Неверный идентификатор заказа.")
-            return
-        link = text.strip()
-        order = find_order(oid)
-        if not order:
-            context.user_data.pop("state", None)
-            await update.message.reply_text("Заказ не найден")
-            return
-        order['tracking_link'] = link
-        from time import time
-        order['updated_at'] = time()
-        update_order(order)
-        context.user_data.pop("state", None)
-        await update.message.reply_text(f"✅ Ссылка для отслеживания сохранена для заказа #{order.get('number')}")
-        # notify customer
+
+METRICS = Metrics()
+
+
+class TextStateRouter:
+    """Routes plain-text messages: reply-keyboard labels by exact text, everything else by conversation state.
+
+    States are keyed by the part of context.user_data["state"] before the first ":" (so
+    "renaming_cat:5" routes to "renaming_cat" with arg "5"). Handlers are
+    `async def handler(update, context, text, arg)`. Resolution order matches the old if-chain:
+    user menu labels, states registered with overrides_menu=True, admin menu labels, states.
+    Timings go to METRICS as `text.menu.<handler>` / `text.state.<state>`.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self._labels: dict[str, tuple] = {}
+        self._states: dict[str, tuple] = {}
+        self._metrics = metrics
+
+    def label(self, *labels: str, role: str = "any"):
+        def register(handler):
+            for label in labels:
+                self._labels[label] = (handler, role)
+            return handler
+        return register
+
+    def state(self, name: str, role: str = "any", overrides_menu: bool = False):
+        def register(handler):
+            self._states[name] = (handler, role, overrides_menu)
+            return handler
+        return register
+
+    async def _run(self, metric: str, handler, update, context, text: str, arg: str) -> None:
+        started = time.perf_counter()
+        failed = False
         try:
-            await context.bot.send_message(chat_id=order.get('user_id'), text=f"В ваш заказ #{order.get('number')} добавлена ссылка для отслеживания:\n{link}")
+            await handler(update, context, text, arg)
         except Exception:
-            pass
-        return
+            failed = True
+            self._metrics.inc(f"{metric}.errors")
+            raise
+        finally:
+            self._metrics.observe(metric, time.perf_counter() - started)
+            _log_update(metric, update.effective_user.id if update.effective_user else None, started, failed)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        text = update.message.text
+        label = self._labels.get(text.strip())
+        if label and label[1] == "any":
+            await self._run(f"text.menu.{label[0].__name__}", label[0], update, context, text, "")
+            return True
+        state = context.user_data.get("state")
+        key, _, arg = (state or "").partition(":")
+        route = self._states.get(key) if state else None
+        if route and route[1] == "admin" and not is_admin(update.effective_user.id):
+            route = None
+        if route and route[2]:
+            await self._run(f"text.state.{key}", route[0], update, context, text, arg)
+            return True
+        if label and is_admin(update.effective_user.id):
+            await self._run(f"text.menu.{label[0].__name__}", label[0], update, context, text, "")
+            return True
+        if route:
+            await self._run(f"text.state.{key}", route[0], update, context, text, arg)
+            return True
+        self._metrics.inc("text.unrouted")
+        return False
 
-    if state == "removing_admin":
-        text_id = text.strip()
-        try:
-            aid = int(text_id)
-        except ValueError:
-            await update.message.reply_text("Неверный ID. Введите numeric ID пользователя.")
-            return
-        remove_admin(aid)
-        context.user_data.pop("state", None)
-        await update.message.reply_text(f"✅ Админ {aid} удалён (если был).")
-        await update.message.reply_text("Вы в админ-панели:", reply_markup=admin_menu_keyboard())
-        return
 
-    if state and state.startswith("renaming_cat:"):
-        _, cat_id = state.split(":")
-        cat_id = int(cat_id)
-        new_name = text.strip()
-        cats = read_json(CATS_FILE)
-        for c in cats:
-            if c["id"] == cat_id:
-                c["name"] = new_name
-                break
-        write_json(CATS_FILE, cats)
-        context.user_data.pop("state", None)
-        await update.message.reply_text(f"✅ Каталог переименован")
-        await show_category(update.message, context, cat_id)
-        return
+text_states = TextStateRouter(METRICS)
 
-    if state and state.startswith("addprod_name:"):
-        _, cat_id = state.split(":")
-        cat_id = int(cat_id)
-        # preserve photos if already present
-        newp = context.user_data.get("new_product") or {"photos": [], "category_id": cat_id}
-        newp["name"] = text.strip()
-        newp["category_id"] = cat_id
-        context.user_data["new_product"] = newp
-        context.user_data["state"] = f"addprod_desc:{cat_id}"
-        await update.message.reply_text("✅ Название добавлено\n✏️ Введите описание товара")
-        return
 
-    if state and state.startswith("addprod_desc:"):
-        _, cat_id = state.split(":")
-        context.user_data["new_product"]["description"] = text.strip()
-        context.user_data["state"] = f"addprod_price:{cat_id}"
-        await update.message.reply_text("💲 Введите цену (числом)")
-        return
+# allow user to cancel any in-progress operation via text
+@text_states.label("Отмена", "❌ Отмена", "/cancel")
+async def _menu_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await update.message.reply_text("Отменено.")
 
-    # Profile collection flow: first name, last name, phone
-    if state == "profile_first_name":
-        profiles = read_profiles()
-        uid = str(update.effective_user.id)
-        profiles.setdefault(uid, {})
-        profiles[uid]["first_name"] = update.message.text.strip()
-        write_profiles(profiles)
-        context.user_data["state"] = "profile_last_name"
-        await update.message.reply_text("👤 Введите *фамилию*:", parse_mode="Markdown")
-        return
 
-    if state == "profile_last_name":
-        profiles = read_profiles()
-        uid = str(update.effective_user.id)
-        profiles.setdefault(uid, {})
-        profiles[uid]["last_name"] = update.message.text.strip()
-        write_profiles(profiles)
-        context.user_data["state"] = "profile_phone"
-        keyboard = ReplyKeyboardMarkup([[KeyboardButton("📞 Отправить номер", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
-        await update.message.reply_text("📞 Отправьте номер телефона кнопкой ниже\nили введите вручную:", reply_markup=keyboard)
-        return
-
-    if state == "profile_phone":
-        profiles = read_profiles()
-        uid = str(update.effective_user.id)
-        # accept manual entry if present
-        phone = update.message.text.strip() if update.message and update.message.text else None
-        if phone:
-            profiles.setdefault(uid, {})
-            profiles[uid]["phone"] = phone
-            write_profiles(profiles)
-            context.user_data.pop("state", None)
-            await update.message.reply_text("✅ Данные сохранены\n\n🔒 Ваши данные используются только для оформления заказа", reply_markup=user_main_keyboard())
-            await show_delivery_selection_from_context(update, context)
-            return
+# user menu: handle these texts for all users (admins too)
+@text_states.label("📂 Каталоги")
+async def _menu_catalogs(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await show_user_categories(update, context)
 
-    # New PVZ input per delivery type
-    if state and state.startswith("pvz_input:"):
-        delivery = state.split(":", 1)[1]
-        pvz = update.message.text.strip()
-        addrs = read_addresses()
-        uid = str(update.effective_user.id)
-        raw = addrs.get(uid)
-        # migrate old list format to dict-per-delivery on first PVZ input
-        if raw is None:
-            addrs[uid] = {}
-        elif isinstance(raw, list):
-            addrs[uid] = {}
-        # ensure nested structure per delivery
-        addrs[uid].setdefault(delivery, [])
-        if pvz and pvz not in addrs[uid][delivery]:
-            addrs[uid][delivery].append(pvz)
-        write_addresses(addrs)
-        pending = context.user_data.get("pending_order", {})
-        pending["address"] = pvz
-        pending["delivery"] = delivery
-        context.user_data["pending_order"] = pending
-        context.user_data.pop("state", None)
-        await update.message.reply_text("✅ ПВЗ сохранён")
-        await finalize_order(update, context)
-        return
 
-    if state and state.startswith("addprod_price:"):
-        _, cat_id = state.split(":")
-        price_text = update.message.text.strip().replace(",", ".")
-        try:
-            price = int(float(price_text))
-        except ValueError:
-            await update.message.reply_text("Неверный формат цены. Введите число.")
-            return
-        context.user_data["new_product"]["price"] = price
-        context.user_data["state"] = "addprod_stock"
-        await update.message.reply_text(
-            "📦 Введите *доступное количество* товара:",
-            parse_mode="Markdown"
-        )
-        return
+@text_states.label("🛒 Корзина")
+async def _menu_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await show_user_cart(update, context)
 
-    if state == "addprod_stock":
-        try:
-            stock = int(update.message.text.strip())
-        except ValueError:
-            await update.message.reply_text("Неверный формат количества. Введите целое число.")
-            return
-        prod = context.user_data.get("new_product", {})
-        prod["stock"] = stock
-        prods = read_json(PROD_FILE)
-        new_id = get_next_id(prods)
-        prod["id"] = new_id
-        prods.append(prod)
-        write_json(PROD_FILE, prods)
-        context.user_data.pop("new_product", None)
-        context.user_data.pop("state", None)
-        await update.message.reply_text("✅ Товар добавлен")
-        try:
-            await notify_new_product(context, prod)
-        except Exception:
-            pass
-        # Notify subscribers if this product was previously awaited (rare but safe)
-        try:
-            if int(prod.get("stock", 0) or 0) > 0:
-                await notify_users_product_available(context, int(prod.get("id")), prod.get("name"))
-        except Exception:
-            pass
-        # show product card to admin
-        await send_product_card(update.message.chat_id, context, prod)
-        return
 
-    if state and state.startswith("editprod_name:"):
-        _, prod_id = state.split(":")
-        prod_id = int(prod_id)
-        new_name = text.strip()
-        prods = read_json(PROD_FILE)
-        for p in prods:
-            if p["id"] == prod_id:
-                p["name"] = new_name
-                cat_id = p["category_id"]
-                break
-        write_json(PROD_FILE, prods)
-        context.user_data.pop("state", None)
-        await update.message.reply_text("✅ Название обновлено")
-        # show updated product card
-        prod = next((p for p in prods if p["id"] == prod_id), None)
-        if prod:
-            await send_product_card(update.message.chat_id, context, prod)
-        return
+@text_states.label("⭐ Избранное")
+async def _menu_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await show_user_favorites(update, context)
 
-    if state and state.startswith("editprod_desc:"):
-        _, prod_id = state.split(":")
-        prod_id = int(prod_id)
-        new_desc = text.strip()
-        prods = read_json(PROD_FILE)
-        for p in prods:
-            if p["id"] == prod_id:
-                p["description"] = new_desc
-                cat_id = p["category_id"]
-                break
-        write_json(PROD_FILE, prods)
-        context.user_data.pop("state", None)
-        await update.message.reply_text("✅ Описание обновлено")
-        prod = next((p for p in prods if p["id"] == prod_id), None)
-        if prod:
-            await send_product_card(update.message.chat_id, context, prod)
+
+@text_states.label("📦 Мои заказы")
+async def _menu_my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await show_user_orders(update, context)
+
+
+@text_states.label("ℹ️ О магазине")
+async def _menu_about(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    text_info = (
+        "🏪 *Информация о магазине*\n\n"
+        "Мы — онлайн-магазин.\n"
+        "Работаем через Telegram-бота.\n\n"
+        "📦 Что умеет бот:\n"
+        "• Просмотр каталога товаров\n"
+        "• Добавление в корзину и избранное\n"
+        "• Оформление заказа\n"
+        "• Выбор доставки\n"
+        "• Просмотр статуса заказов\n\n"
+        "📞 Поддержка:\n"
+        "Если возникли вопросы — напишите в поддержку:\n"
+        "👉 @asudarew\n\n"
+        "⏰ Поддержка отвечает в рабочее время"
+    )
+    await update.message.reply_text(text_info, parse_mode="Markdown")
+
+
+@text_states.label("🛠 Админ панель", role="admin")
+async def _menu_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    await update.message.reply_text("Вы в админ-панели:", reply_markup=admin_menu_keyboard())
+
+
+@text_states.label("📂 Каталог", role="admin")
+async def _menu_admin_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    await show_categories(update, context)
+
+
+@text_states.label("📦 Заказы", role="admin")
+async def _menu_admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    await show_orders_admin(update, context)
+
+
+@text_states.label("📊 Статистика", role="admin")
+async def _menu_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    await show_stats_admin(update, context)
+
+
+@text_states.label("📢 Рассылка", role="admin")
+async def _menu_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    await show_broadcast_menu(update, context)
+
+
+@text_states.label("🔙 Выйти из админки", role="admin")
+async def _menu_admin_exit(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    await update.message.reply_text("Вы вышли из админки.", reply_markup=admin_keyboard())
+
+
+@text_states.label("🔙 Назад", role="admin")
+async def _menu_admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    await update.message.reply_text("Возврат.", reply_markup=admin_keyboard())
+
+
+@text_states.state("addprod_photos", role="admin", overrides_menu=True)
+async def _st_addprod_photos(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    cat_id = int(arg)
+    newp = context.user_data.get("new_product") or {"photos": [], "category_id": cat_id}
+    newp["name"] = text.strip()
+    newp["category_id"] = cat_id
+    context.user_data["new_product"] = newp
+    context.user_data["state"] = f"addprod_desc:{cat_id}"
+    await update.message.reply_text("✅ Название добавлено\n✏️ Введите описание товара")
+
+
+@text_states.state("order_search", role="admin")
+async def _st_order_search(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    context.user_data.pop("state", None)
+    await reply_order_search(update.message, text)
+
+
+@text_states.state("revenue_range", role="admin")
+async def _st_revenue_range(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    days = parse_day_range(text)
+    if days is None:
+        await update.message.reply_text("Не понял период. Пример: 01.05.2025-31.05.2025")
         return
+    context.user_data.pop("state", None)
+    await update.message.reply_text(revenue_report_text(*days), reply_markup=InlineKeyboardMarkup(_revenue_menu_rows()))
 
-    if state and state.startswith("editprod_price:"):
-        _, prod_id = state.split(":")
-        prod_id = int(prod_id)
-        price_text = text.strip().replace(",", ".")
-        try:
-            price = float(price_text)
-        except ValueError:
-            await update.message.reply_text("Неверный формат цены. Введите число.")
-            return
-        prods = read_json(PROD_FILE)
-        for p in prods:
-            if p["id"] == prod_id:
-                p["price"] = price
-                cat_id = p["category_id"]
-                break
-        write_json(PROD_FILE, prods)
+
+@text_states.state("adding_category", role="admin")
+async def _st_adding_category(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    name = text.strip()
+    parent = context.user_data.pop("parent_cat", None)
+    await run_blocking(add_category, name, parent)
+    await update.message.reply_text(f"✅ Каталог «{name}» успешно создан")
+    context.user_data.pop("state", None)
+    # if created as subcategory, reopen parent view, otherwise show root categories
+    if parent is not None:
+        await show_category(update.message, context, parent)
+    else:
+        await show_categories(update, context)
+
+
+@text_states.state("adding_admin", role="admin")
+async def _st_adding_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    text_id = text.strip()
+    try:
+        aid = int(text_id)
+    except ValueError:
+        await update.message.reply_text("Неверный ID. Введите numeric ID пользователя.")
+        return
+    add_admin(aid)
+    context.user_data.pop("state", None)
+    await update.message.reply_text(f"✅ Админ {aid} добавлен.")
+    await update.message.reply_text("Вы в админ-панели:", reply_markup=admin_menu_keyboard())
+
+
+@text_states.state("admin_adding_tracking", role="admin")
+async def _st_admin_adding_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    oid = arg
+    try:
+        oid = int(oid)
+    except Exception:
         context.user_data.pop("state", None)
-        await update.message.reply_text("✅ Цена обновлена")
-        prod = next((p for p in prods if p["id"] == prod_id), None)
-        if prod:
-            await send_product_card(update.message.chat_id, context, prod)
+        await update.message.reply_text("Неверный идентификатор заказа.")
+        return
+    link = text.strip()
+    order = find_order(oid)
+    if not order:
+        context.user_data.pop("state", None)
+        await update.message.reply_text("Заказ не найден")
         return
+    order['tracking_link'] = link
+    from time import time
+    order['updated_at'] = time()
+    await run_blocking(update_order, order)
+    context.user_data.pop("state", None)
+    await update.message.reply_text(f"✅ Ссылка для отслеживания сохранена для заказа #{order.get('number')}")
+    # notify customer
+    try:
+        await context.bot.send_message(chat_id=order.get('user_id'), text=f"В ваш заказ #{order.get('number')} добавлена ссылка для отслеживания:\n{link}")
+    except Exception:
+        pass
 
-    if state and state.startswith("admin_restock_input:"):
-        try:
-            prod_id = int(state.split(":")[1])
-        except Exception:
-            context.user_data.pop("state", None)
-            await update.message.reply_text("Ошибка: товар не найден")
-            return
-        try:
-            qty = int(update.message.text.strip())
-            if qty <= 0:
-                raise ValueError
-        except ValueError:
-            await update.message.reply_text("❌ Введите положительное целое число для пополнения.")
-            return
-        prods = read_json(PROD_FILE)
-        name = None
-        stock = None
-        for p in prods:
-            if p.get("id") == prod_id:
-                old_stock = int(p.get("stock", 0) or 0)
-                p["stock"] = old_stock + qty
-                name = p.get("name")
-                stock = p.get("stock")
-                break
-        write_json(PROD_FILE, prods)
+
+@text_states.state("removing_admin", role="admin")
+async def _st_removing_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    text_id = text.strip()
+    try:
+        aid = int(text_id)
+    except ValueError:
+        await update.message.reply_text("Неверный ID. Введите numeric ID пользователя.")
+        return
+    remove_admin(aid)
+    context.user_data.pop("state", None)
+    await update.message.reply_text(f"✅ Админ {aid} удалён (если был).")
+    await update.message.reply_text("Вы в админ-панели:", reply_markup=admin_menu_keyboard())
+
+
+@text_states.state("renaming_cat", role="admin")
+async def _st_renaming_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    cat_id = int(arg)
+    new_name = text.strip()
+    await run_blocking(rename_category, cat_id, new_name)
+    context.user_data.pop("state", None)
+    await update.message.reply_text("✅ Каталог переименован")
+    await show_category(update.message, context, cat_id)
+
+
+@text_states.state("addprod_name", role="admin")
+async def _st_addprod_name(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    cat_id = int(arg)
+    # preserve photos if already present
+    newp = context.user_data.get("new_product") or {"photos": [], "category_id": cat_id}
+    newp["name"] = text.strip()
+    newp["category_id"] = cat_id
+    context.user_data["new_product"] = newp
+    context.user_data["state"] = f"addprod_desc:{cat_id}"
+    await update.message.reply_text("✅ Название добавлено\n✏️ Введите описание товара")
+
+
+@text_states.state("addprod_desc", role="admin")
+async def _st_addprod_desc(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    cat_id = arg
+    context.user_data["new_product"]["description"] = text.strip()
+    context.user_data["state"] = f"addprod_price:{cat_id}"
+    await update.message.reply_text("💲 Введите цену (числом)")
+
+
+@text_states.state("profile_first_name")
+async def _st_profile_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    profiles = read_profiles()
+    uid = str(update.effective_user.id)
+    profiles.setdefault(uid, {})
+    profiles[uid]["first_name"] = update.message.text.strip()
+    write_profiles(profiles)
+    context.user_data["state"] = "profile_last_name"
+    await update.message.reply_text("👤 Введите *фамилию*:", parse_mode="Markdown")
+
+
+@text_states.state("profile_last_name")
+async def _st_profile_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    profiles = read_profiles()
+    uid = str(update.effective_user.id)
+    profiles.setdefault(uid, {})
+    profiles[uid]["last_name"] = update.message.text.strip()
+    write_profiles(profiles)
+    context.user_data["state"] = "profile_phone"
+    keyboard = ReplyKeyboardMarkup([[KeyboardButton("📞 Отправить номер", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text("📞 Отправьте номер телефона кнопкой ниже\nили введите вручную:", reply_markup=keyboard)
+
+
+@text_states.state("profile_phone")
+async def _st_profile_phone(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    profiles = read_profiles()
+    uid = str(update.effective_user.id)
+    # accept manual entry if present
+    phone = update.message.text.strip() if update.message and update.message.text else None
+    if phone:
+        profiles.setdefault(uid, {})
+        profiles[uid]["phone"] = phone
+        write_profiles(profiles)
         context.user_data.pop("state", None)
-        await update.message.reply_text(
-            f"✅ Товар *{name}* пополнен\n📦 В наличии: {stock} шт",
-            parse_mode="Markdown"
-        )
-        # show updated card if possible
-        prod = next((p for p in prods if p.get("id") == prod_id), None)
-        if prod:
-            await send_product_card(update.message.chat_id, context, prod)
+        await update.message.reply_text("✅ Данные сохранены\n\n🔒 Ваши данные используются только для оформления заказа", reply_markup=user_main_keyboard())
+        await show_delivery_selection_from_context(update, context)
 
-        # If product became available from 0 -> >0, notify subscribed users
-        try:
-            if int(old_stock) <= 0 and int(stock or 0) > 0:
-                await notify_users_product_available(context, int(prod_id), name)
-        except Exception:
-            pass
+
+@text_states.state("pvz_input")
+async def _st_pvz_input(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    delivery = arg
+    pvz = update.message.text.strip()
+    addrs = read_addresses()
+    uid = str(update.effective_user.id)
+    raw = addrs.get(uid)
+    # old list format (if not migrated yet) -> dict-per-delivery on first PVZ input
+    if raw is None:
+        addrs[uid] = {}
+    elif isinstance(raw, list):
+        addrs[uid] = {LEGACY_ADDRESSES_KEY: raw} if raw else {}
+    # ensure nested structure per delivery
+    addrs[uid].setdefault(delivery, [])
+    if pvz and pvz not in addrs[uid][delivery]:
+        addrs[uid][delivery].append(pvz)
+    write_addresses(addrs)
+    pending = context.user_data.get("pending_order", {})
+    pending["address"] = pvz
+    pending["delivery"] = delivery
+    context.user_data["pending_order"] = pending
+    context.user_data.pop("state", None)
+    await update.message.reply_text("✅ ПВЗ сохранён")
+    await finalize_order(update, context)
+
+
+@text_states.state("addprod_price", role="admin")
+async def _st_addprod_price(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    price_text = update.message.text.strip().replace(",", ".")
+    try:
+        price = int(float(price_text))
+    except ValueError:
+        await update.message.reply_text("Неверный формат цены. Введите число.")
         return
+    context.user_data["new_product"]["price"] = price
+    context.user_data["state"] = "addprod_stock"
+    await update.message.reply_text(
+        "📦 Введите *доступное количество* товара:",
+        parse_mode="Markdown"
+    )
 
-    if state == "broadcast_text":
-        # admin entered broadcast text
-        b = {"text": text.strip(), "photo": None}
-        context.user_data["broadcast"] = b
-        context.user_data["state"] = "broadcast_confirm"
-        recipients = get_recipients_list()
-        cnt = len(recipients)
-        # show preview (no photo yet)
-        keyboard = [
-            [InlineKeyboardButton("🚀 Отправить", callback_data="broadcast_send") , InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")],
-            [InlineKeyboardButton("➕ Добавить фото", callback_data="broadcast_add_photo")],
-        ]
-        await update.message.reply_text(f"📢 Предпросмотр рассылки:\n\n{b['text']}\n\nПолучателей: {cnt}", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@text_states.state("addprod_stock", role="admin")
+async def _st_addprod_stock(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    try:
+        stock = int(update.message.text.strip())
+    except ValueError:
+        await update.message.reply_text("Неверный формат количества. Введите целое число.")
         return
+    prod = context.user_data.get("new_product", {})
+    prod["stock"] = stock
+    prod = await run_blocking(add_product, prod)
+    context.user_data.pop("new_product", None)
+    context.user_data.pop("state", None)
+    await update.message.reply_text("✅ Товар добавлен")
+    # show product card to admin right away; the fan-outs run in the background and report to admins
+    await send_product_card(update.message.chat_id, context, prod)
+    start_fanout(notify_new_product(context, prod), f"new_product:{prod.get('id')}")
+    # Notify subscribers if this product was previously awaited (rare but safe)
+    if product_stock(prod) > 0:
+        start_fanout(
+            notify_users_product_available(context, int(prod.get("id")), prod.get("name")),
+            f"restock:{prod.get('id')}",
+        )
 
-    if state == "notif_edit_new_product":
-        # admin set new product notification template
-        tpl = text.strip()
-        cfg = read_notifications()
-        cfg.setdefault("new_product", {})["template"] = tpl
-        write_notifications(cfg)
-        context.user_data.pop("state", None)
-        await update.message.reply_text("✅ Шаблон сохранён.")
+
+@text_states.state("editprod_name", role="admin")
+async def _st_editprod_name(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    prod_id = int(arg)
+    new_name = text.strip()
+    prod = await run_blocking(update_product, prod_id, name=new_name)
+    context.user_data.pop("state", None)
+    await update.message.reply_text("✅ Название обновлено")
+    # show updated product card
+    if prod:
+        await send_product_card(update.message.chat_id, context, prod)
+
+
+@text_states.state("editprod_desc", role="admin")
+async def _st_editprod_desc(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    prod_id = int(arg)
+    new_desc = text.strip()
+    prod = await run_blocking(update_product, prod_id, description=new_desc)
+    context.user_data.pop("state", None)
+    await update.message.reply_text("✅ Описание обновлено")
+    if prod:
+        await send_product_card(update.message.chat_id, context, prod)
+
+
+@text_states.state("editprod_price", role="admin")
+async def _st_editprod_price(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    prod_id = int(arg)
+    price_text = text.strip().replace(",", ".")
+    try:
+        price = float(price_text)
+    except ValueError:
+        await update.message.reply_text("Неверный формат цены. Введите число.")
         return
+    prod = await run_blocking(update_product, prod_id, price=price)
+    context.user_data.pop("state", None)
+    await update.message.reply_text("✅ Цена обновлена")
+    if prod:
+        await send_product_card(update.message.chat_id, context, prod)
 
-    # ordering flow: single product or cart
-    if state and state.startswith("ordering_prod:"):
-        _, prod_id = state.split(":")
-        prod_id = int(prod_id)
-        # user provided address text -> save pending order and ask for delivery method
-        address = text.strip()
-        prods = read_json(PROD_FILE)
-        prod = next((p for p in prods if p.get("id") == prod_id), None)
-        if not prod:
-            await update.message.reply_text("Ошибка: товар не найден")
-            context.user_data.pop("state", None)
-            return
-        items = [{"product_id": prod_id, "name": prod.get("name"), "qty": 1, "price": prod.get("price", 0)}]
-        # store pending order until delivery method selected, then show delivery options
-        context.user_data["pending_order"] = {"type": "prod", "items": items, "address": address}
+
+@text_states.state("admin_restock_input", role="admin")
+async def _st_admin_restock_input(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    try:
+        prod_id = int(arg)
+    except Exception:
         context.user_data.pop("state", None)
-        await show_delivery_selection_from_context(update, context)
+        await update.message.reply_text("Ошибка: товар не найден")
+        return
+    try:
+        qty = int(update.message.text.strip())
+        if qty <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Введите положительное целое число для пополнения.")
         return
+    prod = await run_blocking(restock_product, prod_id, qty)
+    name = prod.get("name") if prod else None
+    stock = prod.get("stock") if prod else None
+    old_stock = int(stock) - qty if prod else None
+    context.user_data.pop("state", None)
+    await update.message.reply_text(
+        f"✅ Товар *{name}* пополнен\n📦 В наличии: {stock} шт",
+        parse_mode="Markdown"
+    )
+    # show updated card if possible
+    if prod:
+        await send_product_card(update.message.chat_id, context, prod)
+
+    # If product became available from 0 -> >0, notify subscribed users (in the background)
+    if prod and int(old_stock) <= 0 and int(stock or 0) > 0:
+        start_fanout(notify_users_product_available(context, int(prod_id), name), f"restock:{prod_id}")
+
+
+@text_states.state("broadcast_text", role="admin")
+async def _st_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    # admin entered broadcast text
+    b = {"text": text.strip(), "photo": None}
+    context.user_data["broadcast"] = b
+    context.user_data["state"] = "broadcast_confirm"
+    recipients = get_recipients_list()
+    cnt = len(recipients)
+    # show preview (no photo yet)
+    keyboard = [
+        [InlineKeyboardButton("🚀 Отправить", callback_data="broadcast_send") , InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")],
+        [InlineKeyboardButton("➕ Добавить фото", callback_data="broadcast_add_photo")],
+    ]
+    await update.message.reply_text(f"📢 Предпросмотр рассылки:\n\n{b['text']}\n\nПолучателей: {cnt}", reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+@text_states.state("notif_edit_new_product", role="admin")
+async def _st_notif_edit_new_product(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    # admin set new product notification template
+    tpl = text.strip()
+    cfg = read_notifications()
+    cfg.setdefault("new_product", {})["template"] = tpl
+    write_notifications(cfg)
+    context.user_data.pop("state", None)
+    await update.message.reply_text("✅ Шаблон сохранён.")
+
 
-    if state == "ordering_new_address":
-        # save new address and ask for delivery method
-        addr = text.strip()
-        uid = str(update.effective_user.id)
-        addrs = read_addresses()
-        user_addrs = addrs.get(uid, [])
-        if addr not in user_addrs:
-            user_addrs.append(addr)
-            addrs[uid] = user_addrs
-            write_addresses(addrs)
+@text_states.state("ordering_prod")
+async def _st_ordering_prod(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    prod_id = int(arg)
+    # user provided address text -> save pending order and ask for delivery method
+    address = text.strip()
+    prods = read_json(PROD_FILE)
+    prod = next((p for p in prods if p.get("id") == prod_id), None)
+    if not prod:
+        await update.message.reply_text("Ошибка: товар не найден")
         context.user_data.pop("state", None)
-        pending = context.user_data.get("pending_order")
-        if not pending:
-            await update.message.reply_text(f"✅ Адрес сохранён: {addr}")
-            return
-        # save address to pending order and ask for delivery method
-        pending["address"] = addr
-        context.user_data["pending_order"] = pending
-        await show_delivery_selection_from_context(update, context)
         return
+    items = [{"product_id": prod_id, "name": prod.get("name"), "qty": 1, "price": prod.get("price", 0)}]
+    # store pending order until delivery method selected, then show delivery options
+    context.user_data["pending_order"] = {"type": "prod", "items": items, "address": address}
+    context.user_data.pop("state", None)
+    await show_delivery_selection_from_context(update, context)
 
-    if state and state == "ordering_cart":
-        # save cart + address as pending and ask for delivery method
-        address = text.strip()
-        user = update.effective_user.id
-        cart_items = get_cart_items(user)
-        if not cart_items:
-            await update.message.reply_text("Ваша корзина пуста.")
-            context.user_data.pop("state", None)
-            return
-        prods = read_json(PROD_FILE)
-        prods_by_id = {int(p.get("id")): p for p in prods if p.get("id") is not None}
-        items = []
-        for ci in cart_items:
-            try:
-                pid = int(ci.get("product_id"))
-                qty = int(ci.get("qty", 1) or 1)
-            except Exception:
-                continue
-            p = prods_by_id.get(pid)
-            if not p:
-                await update.message.reply_text("❌ Один из товаров в корзине был удалён")
-                context.user_data.pop("state", None)
-                return
-            stock = int(p.get("stock", 0) or 0)
-            if stock <= 0 or qty > stock:
-                name = (p.get("name") or "-").strip()
-                await update.message.reply_text(f"❌ Недостаточно товара: {name}\nДоступно: {stock}")
-                context.user_data.pop("state", None)
-                return
-            price = ci.get("price")
-            if price is None:
-                price = p.get("price", 0)
-            items.append({"product_id": pid, "name": p.get('name'), "qty": qty, "price": price})
-        context.user_data["pending_order"] = {"type": "cart", "items": items, "address": address}
+
+@text_states.state("ordering_new_address")
+async def _st_ordering_new_address(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    # save new address and ask for delivery method
+    addr = text.strip()
+    uid = str(update.effective_user.id)
+    addrs = read_addresses()
+    if not isinstance(addrs.get(uid), dict):
+        addrs[uid] = {LEGACY_ADDRESSES_KEY: _legacy_addresses(addrs, uid)}
+    user_addrs = _legacy_addresses(addrs, uid)
+    if addr not in user_addrs:
+        user_addrs.append(addr)
+        write_addresses(addrs)
+    context.user_data.pop("state", None)
+    pending = context.user_data.get("pending_order")
+    if not pending:
+        await update.message.reply_text(f"✅ Адрес сохранён: {addr}")
+        return
+    # save address to pending order and ask for delivery method
+    pending["address"] = addr
+    context.user_data["pending_order"] = pending
+    await show_delivery_selection_from_context(update, context)
+
+
+@text_states.state("ordering_cart")
+async def _st_ordering_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, arg: str) -> None:
+    # save cart + address as pending and ask for delivery method
+    address = text.strip()
+    user = update.effective_user.id
+    cart_items = get_cart_items(user)
+    if not cart_items:
+        await update.message.reply_text("Ваша корзина пуста.")
         context.user_data.pop("state", None)
-        await show_delivery_selection_from_context(update, context)
         return
+    prods = read_json(PROD_FILE)
+    prods_by_id = {int(p.get("id")): p for p in prods if p.get("id") is not None}
+    items = []
+    for ci in cart_items:
+        try:
+            pid = int(ci.get("product_id"))
+            qty = int(ci.get("qty", 1) or 1)
+        except Exception:
+            continue
+        p = prods_by_id.get(pid)
+        if not p:
+            await update.message.reply_text("❌ Один из товаров в корзине был удалён")
+            context.user_data.pop("state", None)
+            return
+        stock = product_stock(p)
+        if stock <= 0 or qty > stock:
+            name = (p.get("name") or "-").strip()
+            await update.message.reply_text(f"❌ Недостаточно товара: {name}\nДоступно: {stock}")
+            context.user_data.pop("state", None)
+            return
+        price = ci.get("price")
+        if price is None:
+            price = p.get("price", 0)
+        items.append({"product_id": pid, "name": p.get('name'), "qty": qty, "price": price})
+    context.user_data["pending_order"] = {"type": "cart", "items": items, "address": address}
+    context.user_data.pop("state", None)
+    await show_delivery_selection_from_context(update, context)
+
+
+async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # track user activity for broadcasts (a set lookup unless the user is new)
+    try:
+        if update.effective_user.id not in _known_user_ids():
+            await run_blocking(add_user_if_new, update.effective_user.id)
+    except Exception:
+        pass
+    await text_states.dispatch(update, context)
 
 
 async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1660,10 +3155,10 @@ async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text(text, reply_markup=markup)
 
 
+@catalog_view("admin_cats")
 def get_categories_markup():
-    cats = read_json(CATS_FILE)
     # show only root categories (no parent_id)
-    root_cats = [c for c in cats if c.get("parent_id") is None]
+    root_cats = _catalog_index()["children"].get(None, [])
     text = "📂 Основные каталоги\nВыберите каталог или создайте новый"
     keyboard = []
     for c in root_cats:
@@ -1676,1059 +3171,1895 @@ def get_categories_markup():
 
 
 def get_cat_name(cat_id: int) -> str:
-    cats = read_json(CATS_FILE)
-    for c in cats:
-        if c["id"] == cat_id:
-            return c["name"]
-    return "-"
+    cat = _catalog_index()["cats"].get(cat_id)
+    return cat["name"] if cat else "-"
 
 
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    try:
-        print(f"CB from {query.from_user.id}: data={query.data}")
-    except Exception:
-        print("CB received: (unable to read user/data)")
-    await query.answer()
-    data = query.data
-    user_id = query.from_user.id
+_CATALOG_INDEX: tuple = (None, {})
 
-    # Admin safety: if some admin restock flow mistakenly uses user qty_* callbacks,
-    # interpret them as selecting a product for restock (not user quantity controls).
-    try:
-        if is_admin(user_id) and (data.startswith("qty_inc:") or data.startswith("qty_dec:")):
-            msg_text = ""
-            try:
-                msg_text = (query.message.text or query.message.caption or "")
-            except Exception:
-                msg_text = ""
-            low = (msg_text or "").lower()
-            if "пополн" in low and "выберите" in low:
-                prod_id = int(data.split(":", 1)[1])
-                context.user_data["state"] = f"admin_restock_input:{prod_id}"
-                await safe_edit_message(query, "➕ Введите количество для пополнения товара:")
-                return
-    except Exception:
-        pass
-    # Handle user-facing callbacks first (always), so user buttons work even if admin callbacks exist
-    if (
-        data.startswith("user_") or
-        data.startswith("notify:") or
-        data.startswith("use_address:") or
-        data.startswith("delivery:") or
-        data.startswith("delivery_select:") or
-        data.startswith("new_pvz:") or
-        data.startswith("use_pvz:") or
-        data.startswith("qty_inc:") or
-        data.startswith("qty_dec:") or
-        data in ("profile_ok", "edit_profile", "new_address", "user_clear_cart", "user_clear_favs", "user_back_to_cats", "user_back_to_menu") or
-        # handle admin-style back only for non-admin users to avoid kicking admins to user menu
-        ((data in ("back_admin", "back_to_cats", "back")) and not is_admin(user_id))
-    ):
-        # If an admin-style back callback is received by a non-admin user, map it to main menu
-        if data in ("back_admin", "back_to_cats", "back") and not is_admin(user_id):
-            context.user_data.pop("state", None)
-            context.user_data.pop("pending_order", None)
-            await safe_edit_message(query, "Главное меню", reply_markup=user_main_keyboard())
-            return
-        if data.startswith("user_cat:"):
-            cat_id = int(data.split(":", 1)[1])
-            # If this came from a product card's back button, delete the product message to avoid duplicate category messages
-            try:
-                lp_id = context.chat_data.get("last_product_msg_id")
-                lp_chat = context.chat_data.get("last_product_chat")
-                if lp_id and lp_chat and lp_id == query.message.message_id and lp_chat == query.message.chat_id:
-                    # leaving a product card -> reset per-product quantity selections
-                    context.user_data.pop("qty_map", None)
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                    context.chat_data.pop("last_product_msg_id", None)
-                    context.chat_data.pop("last_product_chat", None)
-                    return
-            except Exception:
-                pass
-            text, markup = get_user_category_markup(cat_id)
-            try:
-                await _cleanup_last_media(context, query.message.chat_id)
-            except Exception:
-                pass
-            await safe_edit_message(query, text, reply_markup=markup)
-            try:
-                context.chat_data["last_category_msg_id"] = query.message.message_id
-                context.chat_data["last_category_chat"] = query.message.chat_id
-            except Exception:
-                pass
-            return
 
-        if data == "user_back_to_cats":
-            # clear transient state when user goes back
-            context.user_data.pop("state", None)
-            context.user_data.pop("pending_order", None)
-            context.user_data.pop("qty_map", None)  # Clear quantity selections
-            text, markup = get_user_categories_markup()
-            try:
-                await _cleanup_last_media(context, query.message.chat_id)
-            except Exception:
-                pass
-            await safe_edit_message(query, text, reply_markup=markup)
-            return
-        if data == "user_back_to_menu":
-            context.user_data.pop("state", None)
-            context.user_data.pop("pending_order", None)
-            try:
-                await _cleanup_last_media(context, query.message.chat_id)
-            except Exception:
-                pass
-            if is_admin(user_id):
-                await safe_edit_message(query, "Главное меню", reply_markup=admin_keyboard())
-            else:
-                await safe_edit_message(query, "Главное меню", reply_markup=user_main_keyboard())
-            return
+def _catalog_index() -> dict:
+    """categories.json/products.json grouped for keyboards, rebuilt only when either file changes.
 
-        if data.startswith("user_order:"):
-            oid = int(data.split(":",1)[1])
-            order = find_order(oid)
-            if not order or int(order.get('user_id',0)) != int(user_id):
-                await safe_edit_message(query, "Заказ не найден")
-                return
-            # send product cards for each item (photo + caption) and track media IDs for cleanup
-            prods = read_json(PROD_FILE)
-            bot = context.bot
-            media_ids = []
-            for it in order.get('items', []):
-                pid = it.get('product_id')
-                p = next((x for x in prods if x.get('id') == pid), None)
-                title = it.get('name') or (p.get('name') if p else '-')
-                desc = p.get('description','-') if p else it.get('name','-')
-                price = it.get('price', 0)
-                qty = it.get('qty', 1)
-                caption = f"Название: {title}\n\nОписание:\n{desc}\n\nЦена: {price} ₽\nКоличество: {qty}"
-                photos = p.get('photos', []) if p else []
-                if photos:
-                    try:
-                        msg = await bot.send_photo(chat_id=query.message.chat_id, photo=photos[0], caption=caption)
-                        media_ids.append(msg.message_id)
-                    except Exception:
-                        try:
-                            await bot.send_message(chat_id=query.message.chat_id, text=caption)
-                        except Exception:
-                            pass
-                else:
-                    try:
-                        await bot.send_message(chat_id=query.message.chat_id, text=caption)
-                    except Exception:
-                        pass
-            if media_ids:
-                context.chat_data["last_media_ids"] = media_ids
-                context.chat_data["last_media_chat"] = query.message.chat_id
-            # show order summary with tracking button
-            delivery_text = f"\n🚚 Доставка: {order.get('delivery', '-')}" if order.get('delivery') else ""
-            summary = f"📦 Заказ #{order.get('number')}\n💰 Итого: {order.get('total')} ₽\n📍 Адрес: {order.get('address')}{delivery_text}"
-            kb = []
-            # show tracking link to user only when status implies shipment or processing
-            if order.get('tracking_link') and order.get('status') in ("processing", "done"):
-                kb.append([InlineKeyboardButton("🔎 Отследить заказ", url=order.get('tracking_link'))])
-            kb.append([InlineKeyboardButton("🔙 Назад", callback_data="user_back_to_cats")])
-            await query.message.reply_text(summary, reply_markup=InlineKeyboardMarkup(kb))
-            await safe_edit_message(query, "Информация о заказе:")
+    {"cats": {id: cat}, "children": {parent_id: [cat]}, "products": {category_id: [product]},
+    "by_id": {id: product}}, lists in file order. Shared: do not mutate.
+
+    Both files are replaced atomically by writers, but one may change between reading the other; the
+    pair is re-read until the catalog version is the same before and after, so categories and products
+    always come from one consistent moment. Readers never wait for writers.
+    """
+    global _CATALOG_INDEX
+    ver = _catalog_version()
+    if None in ver or _CATALOG_INDEX[0] != ver:
+        for _ in range(5):
+            cats = _read_json_cached(CATS_FILE, default=[])
+            prods = _read_json_cached(PROD_FILE, default=[])
+            after = _catalog_version()
+            if after == ver:
+                break
+            ver = after
+        children: dict = defaultdict(list)
+        products: dict = defaultdict(list)
+        for c in cats:
+            children[c.get("parent_id")].append(c)
+        for p in prods:
+            products[p.get("category_id")].append(p)
+        by_id = {p.get("id"): p for plist in products.values() for p in plist}
+        _CATALOG_INDEX = (ver, {"cats": {c["id"]: c for c in cats}, "children": dict(children), "products": dict(products), "by_id": by_id})
+    return _CATALOG_INDEX[1]
+
+
+def find_product(prod_id: int) -> dict | None:
+    """Product by id from the catalog index (no file read unless products.json changed). Shared: do not mutate."""
+    return _catalog_index()["by_id"].get(prod_id)
+
+
+_SEARCH_WORD = re.compile(r"\w+")
+_SEARCH_PREFIX_MAX = 16
+
+
+def _search_words(text) -> list[str]:
+    return _SEARCH_WORD.findall(str(text or "").lower().replace("ё", "е"))
+
+
+class _SearchIndex:
+    """Word index over product names and descriptions for inline search.
+
+    Every word prefix (up to _SEARCH_PREFIX_MAX chars) maps to {product_id: weight}, name words
+    weighing more than description words, so "омег" finds "Омега-3" with one dict lookup. Query words
+    that are not a prefix of any word fall back to trigrams, so "флавин" still finds "Цитофлавин".
+    """
+
+    NAME_WEIGHT = 3
+    DESC_WEIGHT = 1
+
+    def __init__(self, products):
+        self.products: dict = {}
+        self.prefixes: dict[str, dict] = defaultdict(dict)
+        self.words: dict[str, dict] = defaultdict(dict)
+        self.trigrams: dict[str, set] = defaultdict(set)
+        for p in products:
+            pid = p.get("id")
+            if pid is None:
+                continue
+            self.products[pid] = p
+            for field, weight in (("description", self.DESC_WEIGHT), ("name", self.NAME_WEIGHT)):
+                for word in _search_words(p.get(field)):
+                    hits = self.words[word]
+                    hits[pid] = max(hits.get(pid, 0), weight)
+        for word, hits in self.words.items():
+            for n in range(1, min(len(word), _SEARCH_PREFIX_MAX) + 1):
+                bucket = self.prefixes[word[:n]]
+                for pid, weight in hits.items():
+                    if bucket.get(pid, 0) < weight:
+                        bucket[pid] = weight
+            for i in range(len(word) - 2):
+                self.trigrams[word[i:i + 3]].add(word)
+
+    def _match_word(self, q: str) -> dict:
+        hits = self.prefixes.get(q) if len(q) <= _SEARCH_PREFIX_MAX else None
+        if hits:
+            return hits
+        if len(q) < 3:
+            return {}
+        # infix: words containing every trigram of q, then confirmed by a substring check
+        words = None
+        for i in range(len(q) - 2):
+            found = self.trigrams.get(q[i:i + 3])
+            if not found:
+                return {}
+            words = set(found) if words is None else words & found
+            if not words:
+                return {}
+        hits: dict = {}
+        for word in words:
+            if q in word:
+                # infix matches rank below prefix matches of the same field
+                scale = 1 if word.startswith(q) else 0.5
+                for pid, weight in self.words[word].items():
+                    w = weight * scale
+                    if hits.get(pid, 0) < w:
+                        hits[pid] = w
+        return hits
+
+    def search(self, text: str, limit: int | None = None) -> list[dict]:
+        """Products matching every word of `text`, in stock first, then by relevance, then catalog order.
+
+        With `limit`, only the best `limit` matches are ranked and returned.
+        """
+        scores: dict | None = None
+        for q in dict.fromkeys(_search_words(text)):
+            hits = self._match_word(q)
+            if scores is None:
+                scores = dict(hits)
+            else:
+                scores = {pid: s + hits[pid] for pid, s in scores.items() if pid in hits}
+            if not scores:
+                return []
+        if scores is None:
+            scores = dict.fromkeys(self.products, 0)
+        order = {pid: i for i, pid in enumerate(self.products)}
+        levels = stock_levels()
+
+        def rank(pid):
+            stock = levels[pid] if pid in levels else int(self.products[pid].get("stock", 0) or 0)
+            in_stock = stock > 0
+            return (not in_stock, -scores[pid], order[pid])
+        best = sorted(scores, key=rank) if limit is None else heapq.nsmallest(limit, scores, key=rank)
+        return [self.products[pid] for pid in best]
+
+
+_SEARCH_INDEX: tuple = (None, None)
+
+
+def product_search_index() -> _SearchIndex:
+    """_SearchIndex over products.json, rebuilt whenever the catalog changes (product added, edited, restocked)."""
+    global _SEARCH_INDEX
+    ver = _catalog_version()
+    if None in ver or _SEARCH_INDEX[0] != ver:
+        _SEARCH_INDEX = (ver, _SearchIndex(_read_json_cached(PROD_FILE, default=[])))
+    return _SEARCH_INDEX[1]
+
+
+_ORDERS_INDEX: tuple = (None, {})
+
+
+def _phone_digits(phone) -> str:
+    return "".join(ch for ch in str(phone or "") if ch.isdigit())
+
+
+def _orders_index() -> dict:
+    """orders.json grouped for lookups, lists in file order:
+
+    {"by_status": {status: [order]}, "by_user": {user_id: [order]}, "by_id": {id: order},
+    "by_number": {number: order}, "by_username": {lowercase username: [order]},
+    "phones": sorted [(reversed phone digits, position)], "created": sorted [(created_at, position)],
+    "orders": [order]}; positions index "orders". Rebuilt only when the file changes. Shared: do not mutate.
+    """
+    global _ORDERS_INDEX
+    ver = _file_version(ORDERS_FILE)
+    if ver is None or _ORDERS_INDEX[0] != ver:
+        by_status: dict = defaultdict(list)
+        by_user: dict = defaultdict(list)
+        by_username: dict = defaultdict(list)
+        orders = _read_json_cached(ORDERS_FILE, default=[])
+        phones = []
+        created = []
+        for pos, o in enumerate(orders):
+            by_status[o.get("status", "new")].append(o)
+            try:
+                by_user[int(o.get("user_id", 0))].append(o)
+            except Exception:
+                pass
+            if o.get("username"):
+                by_username[str(o["username"]).lower()].append(o)
+            digits = _phone_digits((o.get("client") or {}).get("phone"))
+            if digits:
+                phones.append((digits[::-1], pos))
+            try:
+                created.append((float(o.get("created_at") or 0), pos))
+            except (TypeError, ValueError):
+                pass
+        phones.sort()
+        created.sort()
+        _ORDERS_INDEX = (ver, {
+            "by_status": dict(by_status),
+            "by_user": dict(by_user),
+            "by_id": {o.get("id"): o for o in orders},
+            "by_number": {o.get("number"): o for o in orders},
+            "by_username": dict(by_username),
+            "phones": phones,
+            "created": created,
+            "orders": orders,
+        })
+    return _ORDERS_INDEX[1]
+
+
+_ORDER_DATE = r"(\d{1,2})\.(\d{1,2})\.(\d{4})|(\d{4})-(\d{1,2})-(\d{1,2})"
+_ORDER_DATE_RANGE = re.compile(rf"^(?:{_ORDER_DATE})(?:\s*(?:\.\.|-|–|—)\s*(?:{_ORDER_DATE}))?$")
+
+
+def parse_day_range(text: str) -> tuple[date, date] | None:
+    """A day (01.05.2025 or 2025-05-01) or two days joined by "-"/".." -> (first day, last day)."""
+    m = _ORDER_DATE_RANGE.match(text.strip())
+    if not m:
+        return None
+    g = m.groups()
+    days = []
+    for d, mo, y, y2, mo2, d2 in (g[0:6], g[6:12]):
+        if d or y2:
+            try:
+                days.append(date(int(y or y2), int(mo or mo2), int(d or d2)))
+            except ValueError:
+                return None
+    return min(days), max(days)
+
+
+def _order_date_range(query: str) -> tuple[float, float] | None:
+    """parse_day_range as [start, end) timestamps of shop days."""
+    days = parse_day_range(query)
+    if days is None:
+        return None
+    return shop_day_start(days[0]), shop_day_start(days[1] + timedelta(days=1))
+
+
+def search_orders(query: str) -> list[dict] | None:
+    """Orders matching an admin search, newest first; None if the query is not understood.
+
+    "#1020" - order number, "@name" - username, "id 123" - user id, "+7 ... 5453" / "tel 5453" - phone
+    ending with these digits, "01.05.2025" or "01.05.2025-31.05.2025" - created on those days. Bare digits
+    match an order number, a user id or a phone suffix. Every lookup goes through _orders_index.
+    """
+    idx = _orders_index()
+    orders = idx["orders"]
+    q = query.strip()
+    low = q.lower()
+    found: dict = {}
+
+    def add(o):
+        if o is not None:
+            found[id(o)] = o
+
+    def by_phone(digits: str):
+        key = digits[::-1]
+        phones = idx["phones"]
+        i = bisect.bisect_left(phones, (key,))
+        while i < len(phones) and phones[i][0].startswith(key):
+            add(orders[phones[i][1]])
+            i += 1
+
+    date_range = _order_date_range(q)
+    if date_range is not None:
+        created = idx["created"]
+        lo = bisect.bisect_left(created, (date_range[0],))
+        hi = bisect.bisect_left(created, (date_range[1],))
+        for _, pos in created[lo:hi]:
+            add(orders[pos])
+    elif q.startswith("@") and len(q) > 1:
+        for o in idx["by_username"].get(low[1:], []):
+            add(o)
+    elif q.startswith("#") and q[1:].strip().isdigit():
+        add(idx["by_number"].get(int(q[1:].strip())))
+    elif low.split(" ", 1)[0].rstrip(":") in ("id", "uid") and _phone_digits(low):
+        for o in idx["by_user"].get(int(_phone_digits(low)), []):
+            add(o)
+    elif low.split(" ", 1)[0].rstrip(":") in ("tel", "phone", "тел") or q.startswith("+"):
+        digits = _phone_digits(q)
+        if len(digits) < 3:
+            return None
+        by_phone(digits)
+    else:
+        digits = _phone_digits(q)
+        if not digits or digits != q.replace(" ", "").replace("-", ""):
+            return None
+        add(idx["by_number"].get(int(digits)))
+        for o in idx["by_user"].get(int(digits), []):
+            add(o)
+        if len(digits) >= 3:
+            by_phone(digits)
+    return sorted(found.values(), key=lambda o: o.get("created_at") or 0, reverse=True)
+
+
+_JSON_SPACE = re.compile(r"\s*")
+_JSON_ARRAY_GAP = re.compile(r"[\s,]*")
+# what may still follow a decoded number at the end of the buffer ("-1" of "-1.5e3")
+_JSON_NUMBER_TAIL = re.compile(r"[\d.eE+-]*\Z")
+
+
+def iter_json_array(path: Path, chunk_size: int = 65536):
+    """Yield the elements of a top-level JSON array file one by one, reading it in chunk_size pieces.
+
+    Memory stays at about one chunk plus one element however large the file is.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        eof = False
+        started = False
+
+        def more() -> bool:
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            buf = buf[pos:] + chunk
+            pos = 0
+            eof = not chunk
+            return bool(chunk)
+
+        while True:
+            pos = (_JSON_ARRAY_GAP if started else _JSON_SPACE).match(buf, pos).end()
+            if pos >= len(buf):
+                if not more():
+                    if started:
+                        raise ValueError(f"{path.name}: unexpected end of JSON array")
+                    return
+                continue
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError(f"{path.name}: not a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if more():
+                    continue
+                raise
+            if not eof and (end >= len(buf) or (
+                    isinstance(item, (int, float)) and not isinstance(item, bool)
+                    and _JSON_NUMBER_TAIL.match(buf, end))):
+                # a number or literal may continue in the next chunk
+                more()
+                continue
+            pos = end
+            yield item
+
+
+ORDER_EXPORT_FIELDS = (
+    "order_id", "number", "created_at", "status", "user_id", "username", "full_name",
+    "first_name", "last_name", "phone", "delivery", "address", "order_total", "payment_id",
+    "product_id", "item_name", "qty", "price", "item_total",
+)
+
+
+def order_export_rows(orders, since: float | None = None, until: float | None = None, status: str | None = None):
+    """Flatten orders into one row per line item (an order without items gives one row with empty item fields).
+
+    Orders are kept when since <= created_at < until and, if given, their status equals `status`.
+    """
+    for o in orders:
+        created = float(o.get("created_at") or 0)
+        if (since is not None and created < since) or (until is not None and created >= until):
+            continue
+        if status and o.get("status", "new") != status:
+            continue
+        client = o.get("client") or {}
+        head = {
+            "order_id": o.get("id"),
+            "number": o.get("number"),
+            "created_at": datetime.fromtimestamp(created, SHOP_TZ).isoformat(sep=" ", timespec="seconds") if created else "",
+            "status": o.get("status", "new"),
+            "user_id": o.get("user_id"),
+            "username": o.get("username") or "",
+            "full_name": o.get("full_name") or "",
+            "first_name": client.get("first_name") or "",
+            "last_name": client.get("last_name") or "",
+            "phone": client.get("phone") or "",
+            "delivery": o.get("delivery") or "",
+            "address": o.get("address") or "",
+            "order_total": o.get("total", 0),
+            "payment_id": o.get("payment_id") or "",
+        }
+        items = o.get("items") or [{}]
+        for it in items:
+            qty = it.get("qty", "")
+            price = it.get("price", "")
+            try:
+                item_total = float(qty) * float(price)
+            except (TypeError, ValueError):
+                item_total = ""
+            yield {
+                **head,
+                "product_id": it.get("product_id", ""),
+                "item_name": (it.get("name") or "").strip(),
+                "qty": qty,
+                "price": price,
+                "item_total": item_total,
+            }
+
+
+def iter_orders_export(fmt: str = "csv", since: float | None = None, until: float | None = None,
+                       status: str | None = None, batch: int = 200):
+    """orders.json as CSV or JSONL text chunks, produced lazily: the header goes out before any order is read.
+
+    Orders are streamed from the file with iter_json_array, so memory does not grow with the number of orders.
+    """
+    if fmt not in ("csv", "jsonl"):
+        raise ValueError(f"unknown export format {fmt!r}")
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=ORDER_EXPORT_FIELDS) if fmt == "csv" else None
+    if writer is not None:
+        # BOM so Excel opens the UTF-8 file with Cyrillic intact
+        out.write("\ufeff")
+        writer.writeheader()
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if not ORDERS_FILE.exists():
+        return
+    n = 0
+    for row in order_export_rows(iter_json_array(ORDERS_FILE), since, until, status):
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        n += 1
+        if n % batch == 0:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+
+# Long lists (products of a catalog, orders, broadcast history) are shown KEYBOARD_PAGE_SIZE buttons at a time
+KEYBOARD_PAGE_SIZE = max(1, int(os.getenv("KEYBOARD_PAGE_SIZE", "20")))
+
+
+def page_slice(items: list, view: str, cursor: int = 0, page_size: int | None = None) -> tuple[list, list]:
+    """The page of items starting at cursor, plus the navigation row ([] if everything fits on one page).
+
+    cursor is an offset into items; the ◀️/▶️ buttons send page:<view>:<cursor>, see paged_view.
+    """
+    size = page_size or KEYBOARD_PAGE_SIZE
+    total = len(items)
+    if total <= size:
+        return items, []
+    cursor = max(0, min(int(cursor), total - 1))
+    cursor -= cursor % size
+    nav = []
+    if cursor > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"page:{view}:{cursor - size}"))
+    nav.append(InlineKeyboardButton(f"{cursor // size + 1}/{(total + size - 1) // size}", callback_data="noop"))
+    if cursor + size < total:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"page:{view}:{cursor + size}"))
+    return items[cursor:cursor + size], [nav]
+
+
+class CallbackRouter:
+    """Dispatches callback_data by its prefix (text before the first ":") with one dict lookup.
+
+    Handlers are `async def handler(query, context, arg)`, where `arg` is everything after
+    the first ":" ("" if there is none). Routes with role="admin" are ignored for non-admins,
+    or handed to `denied` when one is given. Every call is timed into METRICS as
+    `callback.<prefix>`.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self._routes: dict[str, tuple] = {}
+        self._metrics = metrics
+
+    def route(self, *prefixes: str, role: str = "any", denied=None):
+        def register(handler):
+            for prefix in prefixes:
+                if prefix in self._routes:
+                    raise ValueError(f"callback prefix {prefix!r} is already routed")
+                self._routes[prefix] = (handler, role, denied)
+            return handler
+        return register
+
+    async def dispatch(self, query, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        prefix, _, arg = (query.data or "").partition(":")
+        entry = self._routes.get(prefix)
+        if entry is None:
+            self._metrics.inc("callback.unknown")
+            log.info("unknown callback", extra={"user_id": query.from_user.id, "data": query.data})
+            return False
+        handler, role, denied = entry
+        if role == "admin" and not is_admin(query.from_user.id):
+            if denied is None:
+                self._metrics.inc(f"callback.{prefix}.denied")
+                return True
+            handler = denied
+        started = time.perf_counter()
+        failed = False
+        try:
+            await handler(query, context, arg)
+        except Exception:
+            failed = True
+            self._metrics.inc(f"callback.{prefix}.errors")
+            raise
+        finally:
+            self._metrics.observe(f"callback.{prefix}", time.perf_counter() - started)
+            _log_update(f"callback.{prefix}", query.from_user.id, started, failed)
+        return True
+
+
+callbacks = CallbackRouter(METRICS)
+
+
+async def _cb_back_to_main_menu(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # Admin-style back buttons pressed by a non-admin user lead to the main menu
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await safe_edit_message(query, "Главное меню", reply_markup=user_main_keyboard())
+
+
+@callbacks.route("noop")
+async def _cb_noop(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # display-only buttons; the query is already answered
+    pass
+
+
+_PAGED_VIEWS: dict[str, tuple[str, object]] = {}
+
+
+def paged_view(name: str, role: str = "any"):
+    """Register the renderer behind page:<name>[.<param>]:<cursor> buttons.
+
+    The renderer is called as fn(query, param, cursor) and returns (text, markup) or None when the
+    list became empty. Admin views are refused to everyone else, like admin callback routes.
+    """
+    def decorator(fn):
+        if name in _PAGED_VIEWS:
+            raise ValueError(f"paged view {name!r} is already registered")
+        _PAGED_VIEWS[name] = (role, fn)
+        return fn
+    return decorator
+
+
+@callbacks.route("page")
+async def _cb_page(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    view, _, cursor = arg.rpartition(":")
+    name, _, param = view.partition(".")
+    role, render = _PAGED_VIEWS.get(name, (None, None))
+    if render is None or (role == "admin" and not is_admin(query.from_user.id)):
+        METRICS.inc("callback.page.denied")
+        return
+    result = render(query, param, int(cursor or 0))
+    if result is None:
+        await safe_edit_message(query, "Список пуст.")
+        return
+    text, markup = result
+    await safe_edit_message(query, text, reply_markup=markup)
+
+
+@callbacks.route("back", role="admin", denied=_cb_back_to_main_menu)
+async def _cb_back(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # no admin screen uses a plain "back" button
+    pass
+
+
+@callbacks.route("user_cat")
+async def _cb_user_cat(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    # If this came from a product card's back button, delete the product message to avoid duplicate category messages
+    try:
+        lp_id = context.chat_data.get("last_product_msg_id")
+        lp_chat = context.chat_data.get("last_product_chat")
+        if lp_id and lp_chat and lp_id == query.message.message_id and lp_chat == query.message.chat_id:
+            # leaving a product card -> reset per-product quantity selections
+            context.user_data.pop("qty_map", None)
+            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+            context.chat_data.pop("last_product_msg_id", None)
+            context.chat_data.pop("last_product_chat", None)
+            return
+    except Exception:
+        pass
+    text, markup = get_user_category_markup(cat_id)
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
+    except Exception:
+        pass
+    await safe_edit_message(query, text, reply_markup=markup)
+    try:
+        context.chat_data["last_category_msg_id"] = query.message.message_id
+        context.chat_data["last_category_chat"] = query.message.chat_id
+    except Exception:
+        pass
+
+
+@callbacks.route("user_back_to_cats")
+async def _cb_user_back_to_cats(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # clear transient state when user goes back
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    context.user_data.pop("qty_map", None)  # Clear quantity selections
+    text, markup = get_user_categories_markup()
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
+    except Exception:
+        pass
+    await safe_edit_message(query, text, reply_markup=markup)
+
+
+@callbacks.route("user_back_to_menu")
+async def _cb_user_back_to_menu(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    user_id = query.from_user.id
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
+    except Exception:
+        pass
+    if is_admin(user_id):
+        await safe_edit_message(query, "Главное меню", reply_markup=admin_keyboard())
+    else:
+        await safe_edit_message(query, "Главное меню", reply_markup=user_main_keyboard())
+
+
+@callbacks.route("user_order")
+async def _cb_user_order(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    user_id = query.from_user.id
+    oid = int(arg)
+    order = find_order(oid)
+    if not order or int(order.get('user_id',0)) != int(user_id):
+        await safe_edit_message(query, "Заказ не найден")
+        return
+    # send product cards for each item (photo + caption) and track media IDs for cleanup
+    prods = read_json(PROD_FILE)
+    bot = context.bot
+    media_ids = []
+    for it in order.get('items', []):
+        pid = it.get('product_id')
+        p = next((x for x in prods if x.get('id') == pid), None)
+        title = it.get('name') or (p.get('name') if p else '-')
+        desc = p.get('description','-') if p else it.get('name','-')
+        price = it.get('price', 0)
+        qty = it.get('qty', 1)
+        caption = f"Название: {title}\n\nОписание:\n{desc}\n\nЦена: {price} ₽\nКоличество: {qty}"
+        photos = p.get('photos', []) if p else []
+        if photos:
+            try:
+                msg = await bot.send_photo(chat_id=query.message.chat_id, photo=photos[0], caption=caption)
+                media_ids.append(msg.message_id)
+            except Exception:
+                try:
+                    await bot.send_message(chat_id=query.message.chat_id, text=caption)
+                except Exception:
+                    pass
+        else:
+            try:
+                await bot.send_message(chat_id=query.message.chat_id, text=caption)
+            except Exception:
+                pass
+    if media_ids:
+        context.chat_data["last_media_ids"] = media_ids
+        context.chat_data["last_media_chat"] = query.message.chat_id
+    # show order summary with tracking button
+    delivery_text = f"\n🚚 Доставка: {order.get('delivery', '-')}" if order.get('delivery') else ""
+    summary = f"📦 Заказ #{order.get('number')}\n💰 Итого: {order.get('total')} ₽\n📍 Адрес: {order.get('address')}{delivery_text}"
+    kb = []
+    # show tracking link to user only when status implies shipment or processing
+    if order.get('tracking_link') and order.get('status') in ("processing", "done"):
+        kb.append([InlineKeyboardButton("🔎 Отследить заказ", url=order.get('tracking_link'))])
+    kb.append([InlineKeyboardButton("🔙 Назад", callback_data="user_back_to_cats")])
+    await query.message.reply_text(summary, reply_markup=InlineKeyboardMarkup(kb))
+    await safe_edit_message(query, "Информация о заказе:")
+
+
+@callbacks.route("user_prod")
+async def _cb_user_prod(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    prod = find_product(prod_id)
+    if prod:
+        if query.message is None:
+            # a card shared from inline search: open it in the user's private chat with the bot
+            try:
+                await send_product_card_user(query.from_user.id, context, prod)
+            except Forbidden:
+                log.info("inline card for a user who has not started the bot", extra={"user_id": query.from_user.id, "product_id": prod_id})
             return
+        await send_product_card_user(query.message.chat_id, context, prod)
+    else:
+        await safe_edit_message(query, "Товар не найден")
+
+
+@callbacks.route("notify")
+async def _cb_notify(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    try:
+        prod_id = int(arg)
+    except Exception:
+        await query.answer("Ошибка", show_alert=True)
+        return
+    added = False
+    try:
+        added = subscribe_notify(int(query.from_user.id), int(prod_id))
+    except Exception:
+        added = False
+    try:
+        if added:
+            await query.answer("✅ Вы подписались", show_alert=True)
+        else:
+            await query.answer("ℹ️ Вы уже подписаны", show_alert=True)
+    except Exception:
+        pass
+
+    # UX: replace the notify button to prevent repeated taps
+    try:
+        prod = find_product(int(prod_id))
+        if prod:
+            stock = product_stock(prod)
+            # Only relevant when out of stock
+            if stock <= 0:
+                uid = int(query.from_user.id)
+                in_fav = False
+                try:
+                    in_fav = user_snapshot(context, uid).in_favs(int(prod_id))
+                except Exception:
+                    in_fav = False
+                qty_map = context.user_data.setdefault("qty_map", {})
+                cur_qty = int(qty_map.get(int(prod_id), 1))
+                cur_qty = 1 if cur_qty < 1 else cur_qty
+                keyboard = []
+                keyboard.append([
+                    InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"),
+                    InlineKeyboardButton(str(cur_qty), callback_data="noop"),
+                    InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")
+                ])
+                if not in_fav:
+                    keyboard.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
+                keyboard.append([InlineKeyboardButton("⏳ Ожидаем поступление", callback_data="noop")])
+                keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id')}")])
+                await safe_edit_reply_markup(query, InlineKeyboardMarkup(keyboard))
+    except Exception:
+        pass
+
+
+@callbacks.route("user_add_to_cart")
+async def _cb_user_add_to_cart(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    user = query.from_user.id
+    # enforce stock availability
+    prod_cur = find_product(prod_id)
+    if not prod_cur:
+        await query.answer("Товар не найден", show_alert=True)
+        return
+    stock = product_stock(prod_cur)
+    qty_map = context.user_data.setdefault("qty_map", {})
+    cur_qty = int(qty_map.get(prod_id, 1))
+    if stock <= 0 or cur_qty > stock:
+        await query.answer(f"❌ Доступное количество: {stock}", show_alert=True)
+        return
+    await run_blocking(add_to_cart, user, prod_id, qty=cur_qty, price=prod_cur.get("price", 0))
+    snap = user_snapshot(context, user)
+    snap.invalidate()
+    # build temporary keyboard with confirmation
+    prod = prod_cur
+    kb = []
+    # qty controls stay visible
+    kb.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur_qty), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
+    kb.append([InlineKeyboardButton("✅ Добавлено в корзину", callback_data="noop")])
+    in_fav = snap.in_favs(prod_id)
+    if not in_fav:
+        kb.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
+    kb.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
+    kb.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
+    await safe_edit_reply_markup(query, InlineKeyboardMarkup(kb))
+    async def _revert():
+        await asyncio.sleep(3)
+        final = []
+        # restore qty controls row
+        qty_map2 = context.user_data.setdefault("qty_map", {})
+        cur2 = int(qty_map2.get(prod_id, 1))
+        final.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur2), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
+        # runs after the update is done: take a fresh snapshot
+        in_fav2 = UserSnapshot(user).in_favs(prod_id)
+        if not in_fav2:
+            final.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
+        final.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
+        final.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
+        try:
+            await context.bot.edit_message_reply_markup(chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=InlineKeyboardMarkup(final))
+        except Exception:
+            pass
+    context.application.create_task(_revert())
+
+
+@callbacks.route("user_fav")
+async def _cb_user_fav(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    user = query.from_user.id
+    add_to_fav(user, prod_id)
+    snap = user_snapshot(context, user)
+    snap.invalidate()
+    prod = find_product(prod_id)
+    # keep qty controls row
+    qty_map = context.user_data.setdefault("qty_map", {})
+    cur_qty = int(qty_map.get(prod_id, 1))
+    kb = []
+    kb.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur_qty), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
+    kb.append([InlineKeyboardButton("✅ Добавлено в избранное", callback_data="noop")])
+    in_cart = snap.in_cart(prod_id)
+    if not in_cart:
+        kb.append([InlineKeyboardButton("🛒 В корзину", callback_data=f"user_add_to_cart:{prod_id}")])
+    kb.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
+    kb.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
+    await safe_edit_reply_markup(query, InlineKeyboardMarkup(kb))
+    async def _revert():
+        await asyncio.sleep(3)
+        final = []
+        qty_map2 = context.user_data.setdefault("qty_map", {})
+        cur2 = int(qty_map2.get(prod_id, 1))
+        final.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur2), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
+        in_cart2 = UserSnapshot(user).in_cart(prod_id)
+        if not in_cart2:
+            final.append([InlineKeyboardButton("🛒 В корзину", callback_data=f"user_add_to_cart:{prod_id}")])
+        final.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
+        final.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
+        try:
+            await context.bot.edit_message_reply_markup(chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=InlineKeyboardMarkup(final))
+        except Exception:
+            pass
+    context.application.create_task(_revert())
+
+
+@callbacks.route("user_buy_cart")
+async def _cb_user_buy_cart(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # prepare items from cart and ask for address selection
+    user = query.from_user.id
+    cart_items = get_cart_items(user)
+    if not cart_items:
+        await safe_edit_message(query, "Ваша корзина пуста.")
+        return
+    prods = read_json(PROD_FILE)
+    prods_by_id = {int(p.get("id")): p for p in prods if p.get("id") is not None}
+    items = []
+    # validate product existence + stock for requested qty
+    for ci in cart_items:
+        pid = int(ci.get("product_id"))
+        qty = int(ci.get("qty", 1) or 1)
+        p = prods_by_id.get(pid)
+        if not p:
+            await safe_edit_message(query, "❌ Один из товаров в корзине был удалён")
+            return
+        stock = product_stock(p)
+        if stock <= 0 or qty > stock:
+            name = (p.get("name") or "-").strip()
+            await safe_edit_message(query, f"❌ Недостаточно товара: {name}\nДоступно: {stock}")
+            return
+        price = ci.get("price")
+        if price is None:
+            price = p.get("price", 0)
+        items.append({"product_id": pid, "name": p.get('name'), "qty": qty, "price": price})
+    context.user_data["pending_order"] = {"type": "cart", "items": items}
+    # If profile missing, collect it; otherwise show confirmation screen
+    profiles = read_profiles()
+    uid = str(query.from_user.id)
+    if uid not in profiles:
+        context.user_data["state"] = "profile_first_name"
+        await safe_edit_message(query, "👤 Введите *имя*:")
+        return
+    await show_profile_confirmation(query, context)
+
+
+@callbacks.route("user_buy")
+async def _cb_user_buy(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    prods = read_json(PROD_FILE)
+    p = next((x for x in prods if x.get('id') == prod_id), None)
+    if not p:
+        await safe_edit_message(query, "Товар не найден")
+        return
+    # enforce stock availability for buy
+    stock = product_stock(p)
+    qty_map = context.user_data.setdefault("qty_map", {})
+    qty = int(qty_map.get(prod_id, 1))
+    if qty > stock:
+        await query.answer(f"❌ Доступное количество: {stock}", show_alert=True)
+        return
+    items = [{"product_id": p.get('id'), "name": p.get('name'), "qty": qty, "price": p.get('price',0)}]
+    context.user_data["pending_order"] = {"type": "single", "items": items}
+    # If profile missing, collect it; otherwise show confirmation screen
+    profiles = read_profiles()
+    uid = str(query.from_user.id)
+    if uid not in profiles:
+        context.user_data["state"] = "profile_first_name"
+        await safe_edit_message(query, "👤 Введите *имя*:")
+        return
+    await show_profile_confirmation(query, context)
+
+
+class _KeyboardEditCoalescer:
+    """Coalesce rapid keyboard edits of one message into at most one edit per window.
+
+    The first edit goes out at once; edits submitted while it is in flight or during the following
+    window replace each other and only the latest is sent when the window ends. An edit identical
+    to the keyboard the message already shows is skipped (Telegram would reject it anyway).
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._wanted: dict[tuple, tuple] = {}  # (chat, message) -> (query, markup) not sent yet
+        self._shown: dict[tuple, InlineKeyboardMarkup] = {}  # (chat, message) -> keyboard on screen
+        self._tasks: dict[tuple, asyncio.Task] = {}
+
+    def submit(self, query, markup: InlineKeyboardMarkup) -> None:
+        key = (query.message.chat_id, query.message.message_id)
+        self._wanted[key] = (query, markup)
+        if key in self._tasks:
+            METRICS.inc("qty.edits_coalesced")
+            return
+        # nothing of ours in flight: the tapped message shows what is on screen now
+        if query.message.reply_markup is not None:
+            self._shown[key] = query.message.reply_markup
+        self._tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key: tuple) -> None:
+        try:
+            while key in self._wanted:
+                query, markup = self._wanted.pop(key)
+                if markup == self._shown.get(key):
+                    METRICS.inc("qty.edits_skipped")
+                    continue
+                await safe_edit_reply_markup(query, markup)
+                METRICS.inc("qty.edits_sent")
+                self._shown[key] = markup
+                await asyncio.sleep(self.window)
+        finally:
+            self._tasks.pop(key, None)
+            self._shown.pop(key, None)
+
+
+# ➕/➖ taps update qty_map at once; the product card keyboard follows at most every QTY_EDIT_WINDOW seconds
+_qty_edits = _KeyboardEditCoalescer(float(os.getenv("QTY_EDIT_WINDOW", "0.7")))
+
+
+@callbacks.route("qty_inc", "qty_dec")
+async def _cb_qty(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    # Admin safety: if some admin restock flow mistakenly uses user qty_* callbacks,
+    # interpret them as selecting a product for restock (not user quantity controls).
+    if user_snapshot(context, query.from_user.id).is_admin:
+        try:
+            low = (query.message.text or query.message.caption or "").lower()
+        except Exception:
+            low = ""
+        if "пополн" in low and "выберите" in low:
+            context.user_data["state"] = f"admin_restock_input:{prod_id}"
+            await safe_edit_message(query, "➕ Введите количество для пополнения товара:")
+            return
+    prod = find_product(prod_id)
+    if not prod:
+        return
+    stock = product_stock(prod)
+    qty_map = context.user_data.setdefault("qty_map", {})
+    cur = int(qty_map.get(prod_id, 1))
+    if query.data.startswith("qty_inc:"):
+        if cur >= stock:
+            await query.answer(f"❌ Доступное количество: {stock}", show_alert=True)
+            return
+        cur += 1
+    else:
+        cur = max(1, cur - 1)
+    qty_map[prod_id] = cur
+    snap = user_snapshot(context, query.from_user.id)
+    in_cart = snap.in_cart(prod_id)
+    in_fav = snap.in_favs(prod_id)
+    keyboard = [
+        [InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")]
+    ]
+    if not in_cart and stock > 0:
+        keyboard.append([InlineKeyboardButton("🛒 В корзину", callback_data=f"user_add_to_cart:{prod_id}")])
+    if not in_fav:
+        keyboard.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
+    if stock > 0:
+        keyboard.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id')}")])
+    _qty_edits.submit(query, InlineKeyboardMarkup(keyboard))
+
+
+@callbacks.route("new_address")
+async def _cb_new_address(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "ordering_new_address"
+    await safe_edit_message(query, "✏️ Введите новый адрес:")
+
+
+@callbacks.route("use_address")
+async def _cb_use_address(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # callback contains index
+    idx = int(arg)
+    uid = str(query.from_user.id)
+    addrs = read_addresses()
+    user_addrs = _legacy_addresses(addrs, uid)
+    if idx < 0 or idx >= len(user_addrs):
+        await safe_edit_message(query, "Адрес не найден")
+        return
+    address = user_addrs[idx]
+    pending = context.user_data.get("pending_order")
+    if not pending:
+        await safe_edit_message(query, "Нет ожидаемого заказа.")
+        return
+    # save address to pending order and ask for delivery
+    pending["address"] = address
+    context.user_data["pending_order"] = pending
+    await show_delivery_selection(query, context)
+
+
+@callbacks.route("edit_profile")
+async def _cb_edit_profile(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # allow user to update stored profile during checkout
+    context.user_data["state"] = "profile_first_name"
+    await safe_edit_message(query, "👤 Введите *имя*:")
+
+
+@callbacks.route("profile_ok")
+async def _cb_profile_ok(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # proceed to delivery selection after confirming profile
+    await show_delivery_selection(query, context)
+
+
+@callbacks.route("delivery_select")
+async def _cb_delivery_select(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    delivery = arg
+    pending = context.user_data.get("pending_order")
+    if not pending:
+        await safe_edit_message(query, "Ошибка: заказ не найден")
+        return
+    pending["delivery"] = delivery
+    context.user_data["pending_order"] = pending
+    context.user_data["state"] = f"address_select:{delivery}"
+    await show_pvz_selection(query, context, delivery)
+
+
+@callbacks.route("new_pvz")
+async def _cb_new_pvz(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    delivery = arg
+    context.user_data["state"] = f"pvz_input:{delivery}"
+    await safe_edit_message(query, f"✏️ Введите ближайший ПВЗ *{delivery}*:")
+
+
+@callbacks.route("use_pvz")
+async def _cb_use_pvz(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # format: use_pvz:DeliveryName:index
+    parts = arg.split(":", 1)
+    if len(parts) < 2:
+        await safe_edit_message(query, "Ошибка формата данных")
+        return
+    delivery = parts[0]
+    idx = int(parts[1])
+    uid = str(query.from_user.id)
+    addrs = read_addresses()
+    user_addrs = addrs.get(uid, {})
+    if isinstance(user_addrs, dict):
+        pvz_list = user_addrs.get(delivery, [])
+    else:
+        pvz_list = []
+    if idx < 0 or idx >= len(pvz_list):
+        await safe_edit_message(query, "ПВЗ не найден")
+        return
+    pvz = pvz_list[idx]
+    pending = context.user_data.get("pending_order")
+    if not pending:
+        await safe_edit_message(query, "Нет ожидаемого заказа.")
+        return
+    pending["address"] = pvz
+    pending["delivery"] = delivery
+    context.user_data["pending_order"] = pending
+    context.user_data.pop("state", None)
+    await safe_edit_message(query, f"✅ ПВЗ выбран: {pvz}")
+    await finalize_order(query, context)
+
+
+@callbacks.route("delivery")
+async def _cb_delivery(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    delivery_method = arg
+    pending = context.user_data.get("pending_order")
+    if not pending:
+        await safe_edit_message(query, "Ошибка: заказ не найден")
+        return
+    # Save delivery method and proceed to PVZ selection; order will be created after payment
+    pending["delivery"] = delivery_method
+    context.user_data["pending_order"] = pending
+    context.user_data["state"] = f"address_select:{delivery_method}"
+    await show_pvz_selection(query, context, delivery_method)
+
+
+@callbacks.route("user_clear_cart")
+async def _cb_user_clear_cart(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    user = query.from_user.id
+    await run_blocking(clear_cart, user)
+    context.user_data.pop("qty_map", None)  # Clear quantity selections
+    await safe_edit_message(query, "🗑 Корзина очищена.")
+
+
+@callbacks.route("user_clear_favs")
+async def _cb_user_clear_favs(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    user = query.from_user.id
+    clear_favs(user)
+    await safe_edit_message(query, "🗑 Избранное очищено.")
+
+
+@callbacks.route("admin_restock_select", role="admin")
+async def _cb_admin_restock_select(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    try:
+        prod_id = int(arg)
+    except Exception:
+        await safe_edit_message(query, "Ошибка: товар не найден")
+        return
+    context.user_data["state"] = f"admin_restock_input:{prod_id}"
+    await safe_edit_message(query, f"➕ Введите количество для пополнения товара (ID {prod_id}):")
+
+
+@callbacks.route("admin_manage", role="admin")
+async def _cb_admin_manage(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # show admins list and management buttons
+    admins_list = read_json(ADMINS_FILE)
+    admins_list = [str(x) for x in admins_list]
+    text = "👥 Список админов:\n" + "\n".join(admins_list)
+    keyboard = [
+        [InlineKeyboardButton("➕ Добавить админа", callback_data="admin_add")],
+        [InlineKeyboardButton("❌ Удалить админа", callback_data="admin_remove")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
+    ]
+    await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+@callbacks.route("admin_restock", role="admin")
+async def _cb_admin_restock(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    context.user_data["state"] = f"admin_restock_input:{prod_id}"
+    await safe_edit_message(query, "➕ Введите новое количество товара:")
+
+
+@callbacks.route("admin_add", role="admin")
+async def _cb_admin_add(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "adding_admin"
+    await safe_edit_message(query, "✏️ Введите numeric ID нового админа")
+
+
+@callbacks.route("admin_remove", role="admin")
+async def _cb_admin_remove(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "removing_admin"
+    await safe_edit_message(query, "✏️ Введите numeric ID админа для удаления")
+
+
+@callbacks.route("admin_welcome", role="admin")
+async def _cb_admin_welcome(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    await safe_edit_message(query, "Функция настройки текста приветствия — в разработке.")
+
+
+@callbacks.route("admin_notify", role="admin")
+async def _cb_admin_notify(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    await safe_edit_message(query, "Функция настройки уведомлений — в разработке.")
+
+
+@callbacks.route("broadcast_create", role="admin")
+async def _cb_broadcast_create(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "broadcast_text"
+    context.user_data.pop("broadcast", None)
+    await safe_edit_message(query, "✏️ Введите текст рассылки (поддерживается текст).")
+
+
+@paged_view("broadcasts", role="admin")
+def _broadcast_history_markup(query, param: str, cursor: int):
+    broads = _read_json_cached(BROADS_FILE, default=[])
+    if not broads:
+        return None
+    page, nav = page_slice(broads[::-1], "broadcasts", cursor)
+    keyboard = []
+    for b in page:
+        ts = format_dt(b.get("created_at", 0))
+        keyboard.append([InlineKeyboardButton(f"📢 {ts} — {b.get('type','manual').capitalize()}", callback_data=f"broadcast_item:{b.get('id')}")])
+    keyboard.extend(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
+    return "📊 История рассылок:", InlineKeyboardMarkup(keyboard)
+
+
+@callbacks.route("broadcast_history", role="admin")
+async def _cb_broadcast_history(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    result = _broadcast_history_markup(query, "", 0)
+    if result is None:
+        await safe_edit_message(query, "История рассылок пуста.")
+        return
+    text, markup = result
+    await safe_edit_message(query, text, reply_markup=markup)
+
+
+@callbacks.route("broadcast_item", role="admin")
+async def _cb_broadcast_item(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    bid = int(arg)
+    b = next((x for x in read_broadcasts() if x.get("id") == bid), None)
+    if not b:
+        await safe_edit_message(query, "Рассылка не найдена")
+        return
+    ts = format_dt(b.get("created_at",0))
+    status_line = {"running": "📤 Идёт", "paused": "⏸ На паузе", "cancelled": "⛔ Отменена"}.get(b.get("status"), "✅ Завершена")
+    text = (
+        f"📢 Рассылка от {ts}\n\nТип: {b.get('type','manual').capitalize()}\nСтатус: {status_line}\nПолучателей: {b.get('recipients',0)}\nДоставлено: {b.get('delivered',0)}\n"
+        f"Заблокировали бота: {b.get('blocked',0)}\nПропущено (заблокировали ранее): {b.get('skipped',0)}\n"
+        f"Ошибок: {b.get('failed',0)}\n\nТекст:\n{b.get('text','')}"
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]]
+    await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def _new_product_notifications_view(np: dict) -> tuple[str, InlineKeyboardMarkup]:
+    status_text = "✅ Включено" if np.get("enabled") else "❌ Выключено"
+    text = (
+        f"🔔 Уведомления\n\n"
+        f"📦 Новый товар\nСтатус: {status_text}\n\n"
+        f"✏️ Текст уведомления:\n{np.get('template','')}"
+    )
+    # Toggle button shows current state (Вкл/Выкл) with emoji; pressing keeps this screen
+    keyboard = [
+        [InlineKeyboardButton(status_text, callback_data="notif_toggle_new_product")],
+        [InlineKeyboardButton("✏️ Редактировать текст", callback_data="notif_edit_new_product")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
 
-        if data.startswith("user_prod:"):
-            prod_id = int(data.split(":", 1)[1])
-            prods = read_json(PROD_FILE)
-            prod = next((p for p in prods if p.get("id") == prod_id), None)
-            if prod:
-                await send_product_card_user(query.message.chat_id, context, prod)
-            else:
-                await safe_edit_message(query, "Товар не найден")
-            return
 
-        if data.startswith("notify:"):
-            try:
-                prod_id = int(data.split(":", 1)[1])
-            except Exception:
-                await query.answer("Ошибка", show_alert=True)
-                return
-            added = False
-            try:
-                added = subscribe_notify(int(query.from_user.id), int(prod_id))
-            except Exception:
-                added = False
-            try:
-                if added:
-                    await query.answer("✅ Вы подписались", show_alert=True)
-                else:
-                    await query.answer("ℹ️ Вы уже подписаны", show_alert=True)
-            except Exception:
-                pass
+@callbacks.route("broadcast_notifications", role="admin")
+async def _cb_broadcast_notifications(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cfg = read_notifications()
+    text, markup = _new_product_notifications_view(cfg.get("new_product", {}))
+    await safe_edit_message(query, text, reply_markup=markup)
 
-            # UX: replace the notify button to prevent repeated taps
-            try:
-                prods = read_json(PROD_FILE)
-                prod = next((p for p in prods if int(p.get("id", 0)) == int(prod_id)), None)
-                if prod:
-                    stock = int(prod.get("stock", 0) or 0)
-                    # Only relevant when out of stock
-                    if stock <= 0:
-                        uid = int(query.from_user.id)
-                        in_fav = False
-                        try:
-                            in_fav = int(prod_id) in get_favs(uid)
-                        except Exception:
-                            in_fav = False
-                        qty_map = context.user_data.setdefault("qty_map", {})
-                        cur_qty = int(qty_map.get(int(prod_id), 1))
-                        cur_qty = 1 if cur_qty < 1 else cur_qty
-                        keyboard = []
-                        keyboard.append([
-                            InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"),
-                            InlineKeyboardButton(str(cur_qty), callback_data="noop"),
-                            InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")
-                        ])
-                        if not in_fav:
-                            keyboard.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
-                        keyboard.append([InlineKeyboardButton("⏳ Ожидаем поступление", callback_data="noop")])
-                        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id')}")])
-                        await safe_edit_reply_markup(query, InlineKeyboardMarkup(keyboard))
-            except Exception:
-                pass
-            return
 
-        if data.startswith("user_add_to_cart:"):
-            prod_id = int(data.split(":", 1)[1])
-            user = query.from_user.id
-            # enforce stock availability
-            prods_all = read_json(PROD_FILE)
-            prod_cur = next((p for p in prods_all if p.get("id") == prod_id), None)
-            if not prod_cur:
-                await query.answer("Товар не найден", show_alert=True)
-                return
-            stock = int(prod_cur.get("stock", 0) or 0)
-            qty_map = context.user_data.setdefault("qty_map", {})
-            cur_qty = int(qty_map.get(prod_id, 1))
-            if stock <= 0 or cur_qty > stock:
-                await query.answer(f"❌ Доступное количество: {stock}", show_alert=True)
-                return
-            add_to_cart(user, prod_id, qty=cur_qty, price=prod_cur.get("price", 0))
-            # build temporary keyboard with confirmation
-            prods = read_json(PROD_FILE)
-            prod = next((p for p in prods if p.get("id") == prod_id), None)
-            kb = []
-            # qty controls stay visible
-            kb.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur_qty), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
-            kb.append([InlineKeyboardButton("✅ Добавлено в корзину", callback_data="noop")])
-            in_fav = prod_id in get_favs(user)
-            if not in_fav:
-                kb.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
-            kb.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
-            kb.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
-            await safe_edit_reply_markup(query, InlineKeyboardMarkup(kb))
-            async def _revert():
-                await asyncio.sleep(3)
-                final = []
-                # restore qty controls row
-                qty_map2 = context.user_data.setdefault("qty_map", {})
-                cur2 = int(qty_map2.get(prod_id, 1))
-                final.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur2), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
-                in_fav2 = prod_id in get_favs(user)
-                if not in_fav2:
-                    final.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
-                final.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
-                final.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
-                try:
-                    await context.bot.edit_message_reply_markup(chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=InlineKeyboardMarkup(final))
-                except Exception:
-                    pass
-            context.application.create_task(_revert())
-            return
+@callbacks.route("notif_toggle_new_product", role="admin")
+async def _cb_notif_toggle_new_product(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # Toggle state and re-render the notifications screen without leaving broadcast menu
+    cfg = read_notifications()
+    np = cfg.get("new_product", {})
+    np["enabled"] = not np.get("enabled", False)
+    cfg["new_product"] = np
+    write_notifications(cfg)
+    text, markup = _new_product_notifications_view(np)
+    await safe_edit_message(query, text, reply_markup=markup)
 
-        if data.startswith("user_fav:"):
-            prod_id = int(data.split(":", 1)[1])
-            user = query.from_user.id
-            add_to_fav(user, prod_id)
-            prods = read_json(PROD_FILE)
-            prod = next((p for p in prods if p.get("id") == prod_id), None)
-            # keep qty controls row
-            qty_map = context.user_data.setdefault("qty_map", {})
-            cur_qty = int(qty_map.get(prod_id, 1))
-            kb = []
-            kb.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur_qty), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
-            kb.append([InlineKeyboardButton("✅ Добавлено в избранное", callback_data="noop")])
-            in_cart = is_in_cart(user, prod_id)
-            if not in_cart:
-                kb.append([InlineKeyboardButton("🛒 В корзину", callback_data=f"user_add_to_cart:{prod_id}")])
-            kb.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
-            kb.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
-            await safe_edit_reply_markup(query, InlineKeyboardMarkup(kb))
-            async def _revert():
-                await asyncio.sleep(3)
-                final = []
-                qty_map2 = context.user_data.setdefault("qty_map", {})
-                cur2 = int(qty_map2.get(prod_id, 1))
-                final.append([InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur2), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")])
-                in_cart2 = is_in_cart(user, prod_id)
-                if not in_cart2:
-                    final.append([InlineKeyboardButton("🛒 В корзину", callback_data=f"user_add_to_cart:{prod_id}")])
-                final.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
-                final.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id') if prod else 0}")])
-                try:
-                    await context.bot.edit_message_reply_markup(chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=InlineKeyboardMarkup(final))
-                except Exception:
-                    pass
-            context.application.create_task(_revert())
-            return
-        if data == "noop":
-            await query.answer()
-            return
 
-        if data == "user_buy_cart":
-            # prepare items from cart and ask for address selection
-            user = query.from_user.id
-            cart_items = get_cart_items(user)
-            if not cart_items:
-                await safe_edit_message(query, "Ваша корзина пуста.")
-                return
-            prods = read_json(PROD_FILE)
-            prods_by_id = {int(p.get("id")): p for p in prods if p.get("id") is not None}
-            items = []
-            # validate product existence + stock for requested qty
-            for ci in cart_items:
-                pid = int(ci.get("product_id"))
-                qty = int(ci.get("qty", 1) or 1)
-                p = prods_by_id.get(pid)
-                if not p:
-                    await safe_edit_message(query, "❌ Один из товаров в корзине был удалён")
-                    return
-                stock = int(p.get("stock", 0) or 0)
-                if stock <= 0 or qty > stock:
-                    name = (p.get("name") or "-").strip()
-                    await safe_edit_message(query, f"❌ Недостаточно товара: {name}\nДоступно: {stock}")
-                    return
-                price = ci.get("price")
-                if price is None:
-                    price = p.get("price", 0)
-                items.append({"product_id": pid, "name": p.get('name'), "qty": qty, "price": price})
-            context.user_data["pending_order"] = {"type": "cart", "items": items}
-            # If profile missing, collect it; otherwise show confirmation screen
-            profiles = read_profiles()
-            uid = str(query.from_user.id)
-            if uid not in profiles:
-                context.user_data["state"] = "profile_first_name"
-                await safe_edit_message(query, "👤 Введите *имя*:")
-                return
-            await show_profile_confirmation(query, context)
-            return
+@callbacks.route("notif_edit_new_product", role="admin")
+async def _cb_notif_edit_new_product(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "notif_edit_new_product"
+    await safe_edit_message(query, "✏️ Введите шаблон уведомления для нового товара. Используйте {name} и {price}.")
 
-        if data.startswith("user_buy:"):
-            prod_id = int(data.split(":", 1)[1])
-            prods = read_json(PROD_FILE)
-            p = next((x for x in prods if x.get('id') == prod_id), None)
-            if not p:
-                await safe_edit_message(query, "Товар не найден")
-                return
-            # enforce stock availability for buy
-            stock = int(p.get("stock", 0) or 0)
-            qty_map = context.user_data.setdefault("qty_map", {})
-            qty = int(qty_map.get(prod_id, 1))
-            if qty > stock:
-                await query.answer(f"❌ Доступное количество: {stock}", show_alert=True)
-                return
-            items = [{"product_id": p.get('id'), "name": p.get('name'), "qty": qty, "price": p.get('price',0)}]
-            context.user_data["pending_order"] = {"type": "single", "items": items}
-            # If profile missing, collect it; otherwise show confirmation screen
-            profiles = read_profiles()
-            uid = str(query.from_user.id)
-            if uid not in profiles:
-                context.user_data["state"] = "profile_first_name"
-                await safe_edit_message(query, "👤 Введите *имя*:")
-                return
-            await show_profile_confirmation(query, context)
-            return
 
-        if data.startswith("qty_inc:"):
-            prod_id = int(data.split(":")[1])
-            prods = read_json(PROD_FILE)
-            prod = next((p for p in prods if p["id"] == prod_id), None)
-            if not prod:
-                return
-            stock = int(prod.get("stock", 0) or 0)
-            qty_map = context.user_data.setdefault("qty_map", {})
-            cur = int(qty_map.get(prod_id, 1))
-            if cur >= stock:
-                await query.answer(f"❌ Доступное количество: {stock}", show_alert=True)
-                return
-            cur += 1
-            qty_map[prod_id] = cur
-            in_cart = is_in_cart(query.from_user.id, prod_id)
-            in_fav = prod_id in get_favs(query.from_user.id)
-            keyboard = [
-                [InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")]
-            ]
-            if not in_cart and stock > 0:
-                keyboard.append([InlineKeyboardButton("🛒 В корзину", callback_data=f"user_add_to_cart:{prod_id}")])
-            if not in_fav:
-                keyboard.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
-            if stock > 0:
-                keyboard.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id')}")])
-            await safe_edit_reply_markup(query, InlineKeyboardMarkup(keyboard))
-            return
+@paged_view("orders", role="admin")
+def _orders_status_markup(query, status: str, cursor: int):
+    orders = _orders_index()["by_status"].get(status, [])
+    if not orders:
+        return None
+    page, nav = page_slice(orders, f"orders.{status}", cursor)
+    keyboard = []
+    for o in page:
+        keyboard.append([InlineKeyboardButton(f"🧾 #{o.get('number')} | {len(o.get('items',[]))} товара | {o.get('total',0)} ₽", callback_data=f"order_item:{o.get('id')}")])
+    keyboard.extend(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
+    title_map = {"new": "🟢 Новые заказы", "processing": "🟡 В обработке", "done": "🔵 Завершённые", "cancelled": "❌ Отменённые"}
+    return title_map.get(status, "Заказы"), InlineKeyboardMarkup(keyboard)
+
+
+# page:osearch.<query>:<cursor> must fit Telegram's 64-byte callback_data
+ORDER_SEARCH_MAX_BYTES = 40
+ORDER_SEARCH_HELP = (
+    "🔎 Поиск заказа. Введите одно из:\n"
+    "• #1020 — номер заказа\n"
+    "• @username — заказы пользователя\n"
+    "• id 123456789 — заказы по Telegram ID\n"
+    "• tel 5453 — телефон заканчивается на эти цифры\n"
+    "• 01.05.2025 или 01.05.2025-31.05.2025 — заказы за дни\n"
+    "Просто цифры ищутся и как номер, и как ID, и как телефон."
+)
+
+
+@paged_view("osearch", role="admin")
+def _order_search_markup(query, text: str, cursor: int):
+    orders = search_orders(text)
+    if not orders:
+        return None
+    status_emoji = {"new": "🟢", "processing": "🟡", "done": "🔵", "cancelled": "❌"}
+    page, nav = page_slice(orders, f"osearch.{text}", cursor)
+    keyboard = []
+    for o in page:
+        label = f"{status_emoji.get(o.get('status', 'new'), 'ℹ️')} #{o.get('number')} | {format_dt(o.get('created_at', 0))} | {o.get('total', 0)} ₽"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"order_item:{o.get('id')}")])
+    keyboard.extend(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
+    return f"🔎 {text}: найдено {len(orders)}", InlineKeyboardMarkup(keyboard)
+
+
+async def reply_order_search(message, text: str) -> None:
+    text = " ".join(text.split())
+    if not text or len(text.encode("utf-8")) > ORDER_SEARCH_MAX_BYTES or search_orders(text) is None:
+        await message.reply_text(ORDER_SEARCH_HELP)
+        return
+    result = _order_search_markup(None, text, 0)
+    if result is None:
+        await message.reply_text(f"🔎 {text}: заказов не найдено.")
+        return
+    title, markup = result
+    await message.reply_text(title, reply_markup=markup)
 
-        if data.startswith("qty_dec:"):
-            prod_id = int(data.split(":")[1])
-            prods = read_json(PROD_FILE)
-            prod = next((p for p in prods if p["id"] == prod_id), None)
-            if not prod:
-                return
-            stock = int(prod.get("stock", 0) or 0)
-            qty_map = context.user_data.setdefault("qty_map", {})
-            cur = int(qty_map.get(prod_id, 1))
-            cur = max(1, cur - 1)
-            qty_map[prod_id] = cur
-            in_cart = is_in_cart(query.from_user.id, prod_id)
-            in_fav = prod_id in get_favs(query.from_user.id)
-            keyboard = [
-                [InlineKeyboardButton("➖", callback_data=f"qty_dec:{prod_id}"), InlineKeyboardButton(str(cur), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_inc:{prod_id}")]
-            ]
-            if not in_cart and stock > 0:
-                keyboard.append([InlineKeyboardButton("🛒 В корзину", callback_data=f"user_add_to_cart:{prod_id}")])
-            if not in_fav:
-                keyboard.append([InlineKeyboardButton("⭐ В избранное", callback_data=f"user_fav:{prod_id}")])
-            if stock > 0:
-                keyboard.append([InlineKeyboardButton("💳 Заказать", callback_data=f"user_buy:{prod_id}")])
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"user_cat:{prod.get('category_id')}")])
-            await safe_edit_reply_markup(query, InlineKeyboardMarkup(keyboard))
-            return
-            # If profile missing, collect it; otherwise show confirmation screen
-            profiles = read_profiles()
-            uid = str(query.from_user.id)
-            if uid not in profiles:
-                context.user_data["state"] = "profile_first_name"
-                await safe_edit_message(query, "👤 Введите *имя*:")
-                return
-            await show_profile_confirmation(query, context)
-            return
 
-        if data == "new_address":
-            context.user_data["state"] = "ordering_new_address"
-            await safe_edit_message(query, "✏️ Введите новый адрес:")
-            return
+@callbacks.route("orders_search", role="admin")
+async def _cb_orders_search(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "order_search"
+    await safe_edit_message(query, ORDER_SEARCH_HELP)
 
-        if data.startswith("use_address:"):
-            # callback contains index
-            idx = int(data.split(":",1)[1])
-            uid = str(query.from_user.id)
-            addrs = read_addresses()
-            user_addrs = addrs.get(uid, [])
-            if idx < 0 or idx >= len(user_addrs):
-                await safe_edit_message(query, "Адрес не найден")
-                return
-            address = user_addrs[idx]
-            pending = context.user_data.get("pending_order")
-            if not pending:
-                await safe_edit_message(query, "Нет ожидаемого заказа.")
-                return
-            # save address to pending order and ask for delivery
-            pending["address"] = address
-            context.user_data["pending_order"] = pending
-            await show_delivery_selection(query, context)
-            return
 
-        if data == "edit_profile":
-            # allow user to update stored profile during checkout
-            context.user_data["state"] = "profile_first_name"
-            await safe_edit_message(query, "👤 Введите *имя*:")
-            return
+async def find_order_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/find <query> - admin order search, see search_orders."""
+    if not is_admin(update.effective_user.id):
+        return
+    await reply_order_search(update.message, " ".join(context.args or []))
 
-        if data == "profile_ok":
-            # proceed to delivery selection after confirming profile
-            await show_delivery_selection(query, context)
-            return
 
-        if data.startswith("delivery_select:"):
-            delivery = data.split(":", 1)[1]
-            pending = context.user_data.get("pending_order")
-            if not pending:
-                await safe_edit_message(query, "Ошибка: заказ не найден")
-                return
-            pending["delivery"] = delivery
-            context.user_data["pending_order"] = pending
-            context.user_data["state"] = f"address_select:{delivery}"
-            await show_pvz_selection(query, context, delivery)
-            return
+ORDER_STATUSES = ("new", "processing", "done", "cancelled")
+EXPORT_HELP = (
+    "📤 /export [csv|jsonl] [даты] [статус]\n"
+    "Даты: 01.05.2025 или 01.05.2025-31.05.2025, статус: new, processing, done, cancelled.\n"
+    "Каждая позиция заказа — отдельная строка."
+)
 
-        if data.startswith("new_pvz:"):
-            delivery = data.split(":", 1)[1]
-            context.user_data["state"] = f"pvz_input:{delivery}"
-            await safe_edit_message(query, f"✏️ Введите ближайший ПВЗ *{delivery}*:")
-            return
 
-        if data.startswith("use_pvz:"):
-            # format: use_pvz:DeliveryName:index
-            parts = data.split(":", 2)
-            if len(parts) < 3:
-                await safe_edit_message(query, "Ошибка формата данных")
-                return
-            delivery = parts[1]
-            idx = int(parts[2])
-            uid = str(query.from_user.id)
-            addrs = read_addresses()
-            user_addrs = addrs.get(uid, {})
-            if isinstance(user_addrs, dict):
-                pvz_list = user_addrs.get(delivery, [])
-            else:
-                pvz_list = []
-            if idx < 0 or idx >= len(pvz_list):
-                await safe_edit_message(query, "ПВЗ не найден")
-                return
-            pvz = pvz_list[idx]
-            pending = context.user_data.get("pending_order")
-            if not pending:
-                await safe_edit_message(query, "Нет ожидаемого заказа.")
-                return
-            pending["address"] = pvz
-            pending["delivery"] = delivery
-            context.user_data["pending_order"] = pending
-            context.user_data.pop("state", None)
-            await safe_edit_message(query, f"✅ ПВЗ выбран: {pvz}")
-            await finalize_order(query, context)
-            return
+def _write_orders_export(fmt: str, since, until, status):
+    f = tempfile.TemporaryFile()
+    for chunk in iter_orders_export(fmt, since, until, status):
+        f.write(chunk.encode("utf-8"))
+    f.seek(0)
+    return f
 
-        if data.startswith("delivery:"):
-            _, delivery_method = data.split(":", 1)
-            pending = context.user_data.get("pending_order")
-            if not pending:
-                await safe_edit_message(query, "Ошибка: заказ не найден")
-                return
-            # Save delivery method and proceed to PVZ selection; order will be created after payment
-            pending["delivery"] = delivery_method
-            context.user_data["pending_order"] = pending
-            context.user_data["state"] = f"address_select:{delivery_method}"
-            await show_pvz_selection(query, context, delivery_method)
-            return
-            # (legacy follow-ups removed; order creation deferred to payment webhook)
-            return
 
-        if data == "user_clear_cart":
-            user = query.from_user.id
-            clear_cart(user)
-            context.user_data.pop("qty_map", None)  # Clear quantity selections
-            await safe_edit_message(query, "🗑 Корзина очищена.")
+async def export_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/export [csv|jsonl] [dates] [status] - orders.json flattened to line items, sent as a document (admins only)."""
+    if not is_admin(update.effective_user.id):
+        return
+    fmt, status, rest = "csv", None, []
+    for arg in context.args or []:
+        if arg.lower() in ("csv", "jsonl"):
+            fmt = arg.lower()
+        elif arg.lower() in ORDER_STATUSES:
+            status = arg.lower()
+        else:
+            rest.append(arg)
+    since = until = None
+    if rest:
+        date_range = _order_date_range(" ".join(rest))
+        if date_range is None:
+            await update.message.reply_text(EXPORT_HELP)
             return
+        since, until = date_range
+    # the file is produced off the event loop; the bot keeps answering meanwhile
+    f = await asyncio.to_thread(_write_orders_export, fmt, since, until, status)
+    try:
+        name = "orders" + (f"_{status}" if status else "") + f"_{time.strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        await update.message.reply_document(document=f, filename=name)
+    finally:
+        f.close()
+
+
+@callbacks.route("orders_new", "orders_processing", "orders_done", "orders_cancelled", role="admin")
+async def _cb_orders_by_status(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    status_map = {"orders_new": "new", "orders_processing": "processing", "orders_done": "done", "orders_cancelled": "cancelled"}
+    result = _orders_status_markup(query, status_map.get(query.data), 0)
+    if result is None:
+        await safe_edit_message(query, "Список заказов пуст.")
+        return
+    text, markup = result
+    await safe_edit_message(query, text, reply_markup=markup)
 
-        if data == "user_clear_favs":
-            user = query.from_user.id
-            clear_favs(user)
-            await safe_edit_message(query, "🗑 Избранное очищено.")
-            return
 
-        # handled above or unknown user callback -> return to avoid falling into admin handlers
+@callbacks.route("order_item", role="admin")
+async def _cb_order_item(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    oid = int(arg)
+    order = find_order(oid)
+    if not order:
+        await safe_edit_message(query, "Заказ не найден")
         return
+    # build order card
+    lines = []
+    for it in order.get("items", []):
+        lines.append(f"• {(it.get('name') or '-').strip()} — {it.get('qty',1)} шт — {it.get('price',0)} ₽")
+    items_text = "\n".join(lines)
+    created = format_dt(order.get("created_at",0))
+    delivery_text = f"\n🚚 Доставка: {order.get('delivery', '-')}" if order.get('delivery') else ""
+    client = order.get('client', {})
+    name_line = (client.get('first_name') or '') + ((' ' + client.get('last_name')) if client.get('last_name') else '')
+    name_line = name_line.strip() or order.get('full_name')
+    phone_line = client.get('phone') or '-'
+    text = f"🧾 Заказ #{order.get('number')}\nСтатус: {('🟢 Новый' if order.get('status')=='new' else '🟡 В обработке' if order.get('status')=='processing' else '🔵 Завершён' if order.get('status')=='done' else '❌ Отменён')}\n\n👤 Клиент:\nИмя: {name_line}\nТелефон: {phone_line}\nTelegram: @{order.get('username')}\nID: {order.get('user_id')}\n\n📦 Товары:\n{items_text}\n\n💰 Итого: {order.get('total')} ₽\n\n📍 Адрес / способ получения:\n{order.get('address')}{delivery_text}\n\n🕒 Дата: {created}"
+    # buttons by status
+    keyboard = []
+    st = order.get('status')
+    if st == 'new':
+        keyboard.append([InlineKeyboardButton("🟡 Взять в обработку", callback_data=f"order_take:{oid}"), InlineKeyboardButton("❌ Отменить заказ", callback_data=f"order_cancel:{oid}")])
+    elif st == 'processing':
+        keyboard.append([InlineKeyboardButton("🔵 Завершить заказ", callback_data=f"order_complete:{oid}"), InlineKeyboardButton("❌ Отменить заказ", callback_data=f"order_cancel:{oid}")])
+    else:
+        # done or cancelled — only back
+        pass
+    # allow admin to add or change tracking link
+    if order.get('tracking_link'):
+        keyboard.append([InlineKeyboardButton("✏️ Изменить ссылку отслеживания", callback_data=f"order_add_tracking:{oid}")])
+    else:
+        keyboard.append([InlineKeyboardButton("🔗 Добавить ссылку отслеживания", callback_data=f"order_add_tracking:{oid}")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
+    await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
-    # Admin-only callbacks
-    if data.startswith("admin_restock_select:") and is_admin(user_id):
-        try:
-            prod_id = int(data.split(":", 1)[1])
-        except Exception:
-            await safe_edit_message(query, "Ошибка: товар не найден")
-            return
-        context.user_data["state"] = f"admin_restock_input:{prod_id}"
-        await safe_edit_message(query, f"➕ Введите количество для пополнения товара (ID {prod_id}):")
-        return
 
-    if data == "admin_manage":
-        # show admins list and management buttons
-        admins_list = read_json(ADMINS_FILE)
-        admins_list = [str(x) for x in admins_list]
-        text = "👥 Список админов:\n" + "\n".join(admins_list)
-        keyboard = [
-            [InlineKeyboardButton("➕ Добавить админа", callback_data="admin_add")],
-            [InlineKeyboardButton("❌ Удалить админа", callback_data="admin_remove")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
-        ]
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+@callbacks.route("order_add_tracking", role="admin")
+async def _cb_order_add_tracking(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    oid = int(arg)
+    context.user_data["state"] = f"admin_adding_tracking:{oid}"
+    await safe_edit_message(query, "✏️ Введите ссылку для отслеживания (URL) для этого заказа:")
 
-    if data.startswith("admin_restock:"):
-        prod_id = int(data.split(":")[1])
-        context.user_data["state"] = f"admin_restock_input:{prod_id}"
-        await safe_edit_message(query, "➕ Введите новое количество товара:")
-        return
 
-    if data == "admin_add":
-        context.user_data["state"] = "adding_admin"
-        await safe_edit_message(query, "✏️ Введите numeric ID нового админа")
+@callbacks.route("order_take", role="admin")
+async def _cb_order_take(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    oid = int(arg)
+    order = find_order(oid)
+    if not order:
+        await safe_edit_message(query, "Заказ не найден")
         return
+    order['status'] = 'processing'
+    from time import time
+    order['updated_at'] = time()
+    await run_blocking(update_order, order)
+    await safe_edit_message(query, f"✅ Заказ #{order.get('number')} взят в обработку")
+    # notify customer
+    try:
+        await context.bot.send_message(int(order.get('user_id')), f"🔔 Ваш заказ #{order.get('number')} взят в обработку")
+    except Exception:
+        pass
 
-    if data == "admin_remove":
-        context.user_data["state"] = "removing_admin"
-        await safe_edit_message(query, "✏️ Введите numeric ID админа для удаления")
-        return
 
-    if data == "admin_welcome":
-        await safe_edit_message(query, "Функция настройки текста приветствия — в разработке.")
+@callbacks.route("order_complete", role="admin")
+async def _cb_order_complete(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    oid = int(arg)
+    order = find_order(oid)
+    if not order:
+        await safe_edit_message(query, "Заказ не найден")
         return
+    order['status'] = 'done'
+    from time import time
+    order['completed_at'] = time()
+    order['updated_at'] = order['completed_at']
+    await run_blocking(update_order, order)
+    await safe_edit_message(query, f"✅ Заказ #{order.get('number')} отмечен как завершённый")
+    try:
+        await context.bot.send_message(int(order.get('user_id')), f"🔔 Ваш заказ #{order.get('number')} успешно завершён")
+    except Exception:
+        pass
 
-    if data == "admin_notify":
-        await safe_edit_message(query, "Функция настройки уведомлений — в разработке.")
-        return
 
-    # Broadcasts admin
-    if data == "broadcast_create":
-        context.user_data["state"] = "broadcast_text"
-        context.user_data.pop("broadcast", None)
-        await safe_edit_message(query, "✏️ Введите текст рассылки (поддерживается текст).")
+@callbacks.route("order_cancel", role="admin")
+async def _cb_order_cancel(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    oid = int(arg)
+    order = find_order(oid)
+    if not order:
+        await safe_edit_message(query, "Заказ не найден")
         return
+    order['status'] = 'cancelled'
+    from time import time
+    order['updated_at'] = time()
+    await run_blocking(update_order, order)
+    await safe_edit_message(query, f"❌ Заказ #{order.get('number')} отменён")
+    try:
+        await context.bot.send_message(int(order.get('user_id')), f"🔔 Ваш заказ #{order.get('number')} был отменён")
+    except Exception:
+        pass
 
-    if data == "broadcast_history":
-        broads = read_broadcasts()
-        if not broads:
-            await safe_edit_message(query, "История рассылок пуста.")
-            return
-        keyboard = []
-        for b in broads[::-1]:
-            ts = format_dt(b.get("created_at", 0))
-            keyboard.append([InlineKeyboardButton(f"📢 {ts} — {b.get('type','manual').capitalize()}", callback_data=f"broadcast_item:{b.get('id')}")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
-        await safe_edit_message(query, "📊 История рассылок:", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
-
-    if data.startswith("broadcast_item:"):
-        bid = int(data.split(":",1)[1])
-        b = next((x for x in read_broadcasts() if x.get("id") == bid), None)
-        if not b:
-            await safe_edit_message(query, "Рассылка не найдена")
-            return
-        ts = format_dt(b.get("created_at",0))
-        text = f"📢 Рассылка от {ts}\n\nТип: {b.get('type','manual').capitalize()}\nПолучателей: {b.get('recipients',0)}\nДоставлено: {b.get('delivered',0)}\n\nТекст:\n{b.get('text','')}"
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]]
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return
 
-    if data == "broadcast_notifications":
-        cfg = read_notifications()
-        np = cfg.get("new_product", {})
-        status_text = "✅ Включено" if np.get("enabled") else "❌ Выключено"
-        text = (
-            f"🔔 Уведомления\n\n"
-            f"📦 Новый товар\nСтатус: {status_text}\n\n"
-            f"✏️ Текст уведомления:\n{np.get('template','')}"
-        )
-        # Toggle button shows current state (Вкл/Выкл) with emoji; pressing keeps this screen
-        toggle_label = status_text
-        keyboard = [
-            [InlineKeyboardButton(toggle_label, callback_data="notif_toggle_new_product")],
-            [InlineKeyboardButton("✏️ Редактировать текст", callback_data="notif_edit_new_product")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
-        ]
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+@callbacks.route("stats_more", role="admin")
+async def _cb_stats_more(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    det = stats_details()
+    if not det:
+        await safe_edit_message(query, "Статистика пуста.")
         return
+    total_orders = int(det.get('total_orders', 0))
+    avg_check = int(det.get('avg_check') or 0)
+    first = det.get('first') or "-"
+    last = det.get('last') or "-"
+    clients = int(det.get('clients', 0))
+    text = (
+        f"📊 Подробная статистика\n\n"
+        f"📦 Всего заказов: {total_orders}\n"
+        f"💰 Средний чек: {avg_check} ₽\n\n"
+        f"📆 Первый заказ: {first}\n"
+        f"📆 Последний заказ: {last}\n\n"
+        f"👤 Клиентов всего: {clients}"
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]]
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
+    except Exception:
+        pass
+    await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
-    if data == "notif_toggle_new_product":
-        # Toggle state and re-render the notifications screen without leaving broadcast menu
-        cfg = read_notifications()
-        np = cfg.get("new_product", {})
-        np["enabled"] = not np.get("enabled", False)
-        cfg["new_product"] = np
-        write_notifications(cfg)
-        status_text = "✅ Включено" if np.get("enabled") else "❌ Выключено"
-        text = (
-            f"🔔 Уведомления\n\n"
-            f"📦 Новый товар\nСтатус: {status_text}\n\n"
-            f"✏️ Текст уведомления:\n{np.get('template','')}"
-        )
-        toggle_label = status_text
-        keyboard = [
-            [InlineKeyboardButton(toggle_label, callback_data="notif_toggle_new_product")],
-            [InlineKeyboardButton("✏️ Редактировать текст", callback_data="notif_edit_new_product")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
-        ]
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return
 
-    if data == "notif_edit_new_product":
-        context.user_data["state"] = "notif_edit_new_product"
-        await safe_edit_message(query, "✏️ Введите шаблон уведомления для нового товара. Используйте {name} и {price}.")
-        return
+def _revenue_period(name: str) -> tuple[date, date] | None:
+    """Day range for a rev:<name> button: week, prevweek, month or prevmonth (weeks start on Monday)."""
+    today = shop_today()
+    if name == "week":
+        return today - timedelta(days=today.weekday()), today
+    if name == "prevweek":
+        end = today - timedelta(days=today.weekday() + 1)
+        return end - timedelta(days=6), end
+    if name == "month":
+        return today.replace(day=1), today
+    if name == "prevmonth":
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end
+    return None
+
+
+def _revenue_menu_rows() -> list:
+    return [
+        [InlineKeyboardButton("Эта неделя", callback_data="rev:week"), InlineKeyboardButton("Прошлая неделя", callback_data="rev:prevweek")],
+        [InlineKeyboardButton("Этот месяц", callback_data="rev:month"), InlineKeyboardButton("Прошлый месяц", callback_data="rev:prevmonth")],
+        [InlineKeyboardButton("📅 Свой период", callback_data="rev:custom")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
+    ]
 
-    # Admin orders filters
-    if data in ("orders_new", "orders_processing", "orders_done", "orders_cancelled"):
-        status_map = {"orders_new": "new", "orders_processing": "processing", "orders_done": "done", "orders_cancelled": "cancelled"}
-        status = status_map.get(data)
-        orders = [o for o in read_orders() if o.get("status") == status]
-        if not orders:
-            await safe_edit_message(query, "Список заказов пуст.")
-            return
-        keyboard = []
-        for o in orders:
-            keyboard.append([InlineKeyboardButton(f"🧾 #{o.get('number')} | {len(o.get('items',[]))} товара | {o.get('total',0)} ₽", callback_data=f"order_item:{o.get('id')}")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
-        title_map = {"new": "🟢 Новые заказы", "processing": "🟡 В обработке", "done": "🔵 Завершённые", "cancelled": "❌ Отменённые"}
-        await safe_edit_message(query, title_map.get(status, "Заказы"), reply_markup=InlineKeyboardMarkup(keyboard))
-        return
 
-    if data.startswith("order_item:"):
-        oid = int(data.split(":",1)[1])
-        order = find_order(oid)
-        if not order:
-            await safe_edit_message(query, "Заказ не найден")
-            return
-        # build order card
-        lines = []
-        for it in order.get("items", []):
-            lines.append(f"• {(it.get('name') or '-').strip()} — {it.get('qty',1)} шт — {it.get('price',0)} ₽")
-        items_text = "\n".join(lines)
-        created = format_dt(order.get("created_at",0))
-        delivery_text = f"\n🚚 Доставка: {order.get('delivery', '-')}" if order.get('delivery') else ""
-        client = order.get('client', {})
-        name_line = (client.get('first_name') or '') + ((' ' + client.get('last_name')) if client.get('last_name') else '')
-        name_line = name_line.strip() or order.get('full_name')
-        phone_line = client.get('phone') or '-'
-        text = f"🧾 Заказ #{order.get('number')}\nСтатус: {('🟢 Новый' if order.get('status')=='new' else '🟡 В обработке' if order.get('status')=='processing' else '🔵 Завершён' if order.get('status')=='done' else '❌ Отменён')}\n\n👤 Клиент:\nИмя: {name_line}\nТелефон: {phone_line}\nTelegram: @{order.get('username')}\nID: {order.get('user_id')}\n\n📦 Товары:\n{items_text}\n\n💰 Итого: {order.get('total')} ₽\n\n📍 Адрес / способ получения:\n{order.get('address')}{delivery_text}\n\n🕒 Дата: {created}"
-        # buttons by status
-        keyboard = []
-        st = order.get('status')
-        if st == 'new':
-            keyboard.append([InlineKeyboardButton("🟡 Взять в обработку", callback_data=f"order_take:{oid}"), InlineKeyboardButton("❌ Отменить заказ", callback_data=f"order_cancel:{oid}")])
-        elif st == 'processing':
-            keyboard.append([InlineKeyboardButton("🔵 Завершить заказ", callback_data=f"order_complete:{oid}"), InlineKeyboardButton("❌ Отменить заказ", callback_data=f"order_cancel:{oid}")])
-        else:
-            # done or cancelled — only back
-            pass
-        # allow admin to add or change tracking link
-        if order.get('tracking_link'):
-            keyboard.append([InlineKeyboardButton("✏️ Изменить ссылку отслеживания", callback_data=f"order_add_tracking:{oid}")])
-        else:
-            keyboard.append([InlineKeyboardButton("🔗 Добавить ссылку отслеживания", callback_data=f"order_add_tracking:{oid}")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+def revenue_report_text(start: date, end: date, limit: int = 10) -> str:
+    rep = revenue_report(start, end)
+    revenue, orders = rep["revenue"], rep["orders"]
+    avg = int(revenue / orders) if orders else 0
+    lines = [
+        f"📈 Выручка {start:%d.%m.%Y} — {end:%d.%m.%Y}",
+        "",
+        f"💰 {int(revenue)} ₽ · заказов: {orders} · средний чек: {avg} ₽",
+    ]
+    if rep["categories"]:
+        lines += ["", "📂 По каталогам:"]
+        for cat_id, rev in rep["categories"][:limit]:
+            name = get_cat_name(cat_id) if cat_id is not None else "Без каталога"
+            lines.append(f"• {name[:40]} — {int(rev)} ₽")
+    if rep["products"]:
+        lines += ["", f"💊 Товары (топ {min(limit, len(rep['products']))}):"]
+        for _, name, qty, rev in rep["products"][:limit]:
+            lines.append(f"• {name[:40]} — {qty} шт — {int(rev)} ₽")
+    return "\n".join(lines)
+
+
+@callbacks.route("rev", role="admin")
+async def _cb_revenue(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    if not arg:
+        await safe_edit_message(query, "📈 Выручка за период", reply_markup=InlineKeyboardMarkup(_revenue_menu_rows()))
         return
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+    if arg == "custom":
+        context.user_data["state"] = "revenue_range"
+        await safe_edit_message(query, "📅 Введите период: 01.05.2025-31.05.2025 (или один день: 01.05.2025)")
         return
-
-    if data.startswith("order_add_tracking:"):
-        oid = int(data.split(":",1)[1])
-        context.user_data["state"] = f"admin_adding_tracking:{oid}"
-        await safe_edit_message(query, "✏️ Введите ссылку для отслеживания (URL) для этого заказа:")
+    period = _revenue_period(arg)
+    if period is None:
         return
+    await safe_edit_message(query, revenue_report_text(*period), reply_markup=InlineKeyboardMarkup(_revenue_menu_rows()))
 
-    if data.startswith("order_take:"):
-        oid = int(data.split(":",1)[1])
-        order = find_order(oid)
-        if not order:
-            await safe_edit_message(query, "Заказ не найден")
-            return
-        order['status'] = 'processing'
-        from time import time
-        order['updated_at'] = time()
-        update_order(order)
-        await safe_edit_message(query, f"✅ Заказ #{order.get('number')} взят в обработку")
-        # notify customer
-        try:
-            await context.bot.send_message(int(order.get('user_id')), f"🔔 Ваш заказ #{order.get('number')} взят в обработку")
-        except Exception:
-            pass
-        return
 
-    if data.startswith("order_complete:"):
-        oid = int(data.split(":",1)[1])
-        order = find_order(oid)
-        if not order:
-            await safe_edit_message(query, "Заказ не найден")
-            return
-        order['status'] = 'done'
-        from time import time
-        order['completed_at'] = time()
-        order['updated_at'] = order['completed_at']
-        update_order(order)
-        await safe_edit_message(query, f"✅ Заказ #{order.get('number')} отмечен как завершённый")
-        try:
-            await context.bot.send_message(int(order.get('user_id')), f"🔔 Ваш заказ #{order.get('number')} успешно завершён")
-        except Exception:
-            pass
+@callbacks.route("stats_top", role="admin")
+async def _cb_stats_top(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    top = top_products(10)
+    if not top:
+        await safe_edit_message(query, "Топ товаров пуст.")
         return
+    lines = []
+    medals = ["🥇","🥈","🥉"]
+    for i, (name, cnt) in enumerate(top[:10]):
+        medal = medals[i] if i < 3 else f"#{i+1}"
+        lines.append(f"{medal} {name} — {cnt} продаж")
+    text = "🏆 Топ товаров\n\n" + "\n".join(lines)
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]]
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
+    except Exception:
+        pass
+    await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
-    if data.startswith("order_cancel:"):
-        oid = int(data.split(":",1)[1])
-        order = find_order(oid)
-        if not order:
-            await safe_edit_message(query, "Заказ не найден")
-            return
-        order['status'] = 'cancelled'
-        from time import time
-        order['updated_at'] = time()
-        update_order(order)
-        await safe_edit_message(query, f"❌ Заказ #{order.get('number')} отменён")
-        try:
-            await context.bot.send_message(int(order.get('user_id')), f"🔔 Ваш заказ #{order.get('number')} был отменён")
-        except Exception:
-            pass
-        return
 
-    if data == "stats_more":
-        det = stats_details()
-        if not det:
-            await safe_edit_message(query, "Статистика пуста.")
-            return
-        total_orders = int(det.get('total_orders', 0))
-        avg_check = int(det.get('avg_check') or 0)
-        first = det.get('first') or "-"
-        last = det.get('last') or "-"
-        clients = int(det.get('clients', 0))
-        text = (
-            f"📊 Подробная статистика\n\n"
-            f"📦 Всего заказов: {total_orders}\n"
-            f"💰 Средний чек: {avg_check} ₽\n\n"
-            f"📆 Первый заказ: {first}\n"
-            f"📆 Последний заказ: {last}\n\n"
-            f"👤 Клиентов всего: {clients}"
-        )
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]]
-        try:
-            await _cleanup_last_media(context, query.message.chat_id)
-        except Exception:
-            pass
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+@callbacks.route("add_category", role="admin")
+async def _cb_add_category(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "adding_category"
+    await safe_edit_message(query, "✏️ Введите название нового каталога")
 
-    if data == "stats_top":
-        top = top_products(10)
-        if not top:
-            await safe_edit_message(query, "Топ товаров пуст.")
-            return
-        lines = []
-        medals = ["🥇","🥈","🥉"]
-        for i, (name, cnt) in enumerate(top[:10]):
-            medal = medals[i] if i < 3 else f"#{i+1}"
-            lines.append(f"{medal} {name} — {cnt} продаж")
-        text = "🏆 Топ товаров\n\n" + "\n".join(lines)
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]]
-        try:
-            await _cleanup_last_media(context, query.message.chat_id)
-        except Exception:
-            pass
-        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return
 
-    if data == "add_category":
-        context.user_data["state"] = "adding_category"
-        await safe_edit_message(query, "✏️ Введите название нового каталога")
-        return
+@callbacks.route("add_subcat", role="admin")
+async def _cb_add_subcat(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # treat as add category (no nesting implemented) but show prompt
+    parent_id = int(arg)
+    context.user_data["state"] = "adding_category"
+    context.user_data["parent_cat"] = parent_id
+    await safe_edit_message(query, "✏️ Введите название нового каталога (будет создан как основной)")
 
 
-    if data.startswith("add_subcat:"):
-        # treat as add category (no nesting implemented) but show prompt
-        parent_id = int(data.split(":", 1)[1])
-        context.user_data["state"] = "adding_category"
-        context.user_data["parent_cat"] = parent_id
-        await safe_edit_message(query, "✏️ Введите название нового каталога (будет создан как основной)")
-        return
+@callbacks.route("back_admin", role="admin", denied=_cb_back_to_main_menu)
+async def _cb_back_admin(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # clear transient state when returning to admin menu
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await safe_edit_message(query, "Вернулись в админ-меню.")
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
+    except Exception:
+        pass
+    await query.message.reply_text("Выберите раздел:", reply_markup=admin_menu_keyboard())
 
-    if data == "back_admin":
-        # clear transient state when returning to admin menu
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        await safe_edit_message(query, "Вернулись в админ-меню.")
-        try:
-            await _cleanup_last_media(context, query.message.chat_id)
-        except Exception:
-            pass
-        await query.message.reply_text("Выберите раздел:", reply_markup=admin_menu_keyboard())
-        return
 
-    if data.startswith("cat:"):
-        cat_id = int(data.split(":", 1)[1])
-        # replace the categories message with the category view
-        text, markup = get_category_markup(cat_id)
-        try:
-            await _cleanup_last_media(context, query.message.chat_id)
-        except Exception:
-            pass
-        await safe_edit_message(query, text, reply_markup=markup)
-        return
+@callbacks.route("cat", role="admin")
+async def _cb_cat(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    # replace the categories message with the category view
+    text, markup = get_category_markup(cat_id)
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
+    except Exception:
+        pass
+    await safe_edit_message(query, text, reply_markup=markup)
 
-    if data == "back_to_cats":
-        # clear transient state when returning to categories
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        text, markup = get_categories_markup()
-        try:
-            await _cleanup_last_media(context, query.message.chat_id)
-            
-        except Exception:
-            pass
-        await safe_edit_message(query, text, reply_markup=markup)
-        return
-
-    if data.startswith("rename_cat:"):
-        cat_id = int(data.split(":", 1)[1])
-        context.user_data["state"] = f"renaming_cat:{cat_id}"
-        await safe_edit_message(query, f"✏️ Введите новое название каталога «{get_cat_name(cat_id)}»")
-        return
-
-    if data.startswith("delcat_confirm:"):
-        cat_id = int(data.split(":", 1)[1])
-        # delete category and all its subcategories recursively
-        def delete_cat_recursive(cid):
-            cats_all = read_json(CATS_FILE)
-            # find children
-            children = [c for c in cats_all if c.get("parent_id") == cid]
-            for ch in children:
-                delete_cat_recursive(ch["id"])
-            # remove this category
-            cats_remaining = [c for c in cats_all if c["id"] != cid]
-            write_json(CATS_FILE, cats_remaining)
-            # remove products in this category
-            prods_all = read_json(PROD_FILE)
-            prods_remaining = [p for p in prods_all if p.get("category_id") != cid]
-            write_json(PROD_FILE, prods_remaining)
-
-        delete_cat_recursive(cat_id)
-        # update original message to show refreshed categories list
-        text, markup = get_categories_markup()
-        await safe_edit_message(query, "🗑 Каталог удалён")
-        await query.message.reply_text("Обновлён список:")
-        await query.message.reply_text(text, reply_markup=markup)
-        return
-
-    if data.startswith("delcat:"):
-        cat_id = int(data.split(":", 1)[1])
-        keyboard = [
-            [InlineKeyboardButton("✅ Да, удалить", callback_data=f"delcat_confirm:{cat_id}"), InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-        ]
-        await safe_edit_message(query, f"⚠️ Вы уверены, что хотите удалить каталог «{get_cat_name(cat_id)}»?\nВсе товары внутри будут удалены.", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
 
-    if data == "cancel":
-        # clear any in-progress state when user cancels
-        context.user_data.pop("state", None)
-        context.user_data.pop("pending_order", None)
-        await safe_edit_message(query, "Отмена")
-        return
+@callbacks.route("back_to_cats", role="admin", denied=_cb_back_to_main_menu)
+async def _cb_back_to_cats(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # clear transient state when returning to categories
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    text, markup = get_categories_markup()
+    try:
+        await _cleanup_last_media(context, query.message.chat_id)
 
-    if data == "broadcast_add_photo":
-        context.user_data["state"] = "broadcast_photo_wait"
-        await safe_edit_message(query, "📸 Пришлите фото для рассылки (опционально).")
-        return
+    except Exception:
+        pass
+    await safe_edit_message(query, text, reply_markup=markup)
 
-    if data == "broadcast_cancel":
-        context.user_data.pop("broadcast", None)
-        context.user_data.pop("state", None)
-        await safe_edit_message(query, "Отмена рассылки")
-        return
 
-    if data == "broadcast_send":
-        b = context.user_data.get("broadcast") or {}
-        text_b = b.get("text","")
-        photo = b.get("photo")
-        recipients = get_recipients_list()
-        cnt = len(recipients)
-        # perform sending (async)
-        delivered = await do_send_broadcast(context, text_b, photo, recipients)
-        from time import time
-        entry = {
-            "id": get_next_id(read_broadcasts()),
-            "type": "manual",
-            "text": text_b,
-            "photo": photo,
-            "recipients": cnt,
-            "delivered": delivered,
-            "created_at": time(),
-        }
-        save_broadcast_record(entry)
-        context.user_data.pop("broadcast", None)
-        context.user_data.pop("state", None)
-        await safe_edit_message(query, f"✅ Рассылка отправлена. Доставлено: {delivered} из {cnt}")
+@callbacks.route("rename_cat", role="admin")
+async def _cb_rename_cat(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    context.user_data["state"] = f"renaming_cat:{cat_id}"
+    await safe_edit_message(query, f"✏️ Введите новое название каталога «{get_cat_name(cat_id)}»")
+
+
+@callbacks.route("delcat_confirm", role="admin")
+async def _cb_delcat_confirm(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    # delete category and all its subcategories recursively
+    await run_blocking(delete_category_tree, cat_id)
+    # update original message to show refreshed categories list
+    text, markup = get_categories_markup()
+    await safe_edit_message(query, "🗑 Каталог удалён")
+    await query.message.reply_text("Обновлён список:")
+    await query.message.reply_text(text, reply_markup=markup)
+
+
+@callbacks.route("delcat", role="admin")
+async def _cb_delcat(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    keyboard = [
+        [InlineKeyboardButton("✅ Да, удалить", callback_data=f"delcat_confirm:{cat_id}"), InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+    ]
+    await safe_edit_message(query, f"⚠️ Вы уверены, что хотите удалить каталог «{get_cat_name(cat_id)}»?\nВсе товары внутри будут удалены.", reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+@callbacks.route("cancel", role="admin")
+async def _cb_cancel(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    # clear any in-progress state when user cancels
+    context.user_data.pop("state", None)
+    context.user_data.pop("pending_order", None)
+    await safe_edit_message(query, "Отмена")
+
+
+@callbacks.route("broadcast_add_photo", role="admin")
+async def _cb_broadcast_add_photo(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data["state"] = "broadcast_photo_wait"
+    await safe_edit_message(query, "📸 Пришлите фото для рассылки (опционально).")
+
+
+@callbacks.route("broadcast_cancel", role="admin")
+async def _cb_broadcast_cancel(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    context.user_data.pop("broadcast", None)
+    context.user_data.pop("state", None)
+    await safe_edit_message(query, "Отмена рассылки")
+
+
+@callbacks.route("broadcast_send", role="admin")
+async def _cb_broadcast_send(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    b = context.user_data.get("broadcast") or {}
+    text_b = b.get("text","")
+    photo = b.get("photo")
+    if not text_b and not photo:
+        # a second tap after the job was created: the draft is gone, never send an empty job.
+        # Reply instead of editing: this message may already be the running job's progress view.
+        await query.message.reply_text("Черновик рассылки не найден")
+        return
+    recipients = get_recipients_list()
+    # persist as a resumable job and send it in the background; this message becomes the progress view
+    job = await run_blocking(create_broadcast_job, text_b, photo, recipients)
+    context.user_data.pop("broadcast", None)
+    context.user_data.pop("state", None)
+    text, markup = _broadcast_progress_view(job)
+    await safe_edit_message(query, text, reply_markup=markup)
+    job = await run_blocking(
+        update_broadcast_job, job["id"], progress_chat=query.message.chat_id, progress_msg=query.message.message_id
+    ) or job
+    start_broadcast_job(context.bot, job["id"])
+
+
+@callbacks.route("bcast_pause", "bcast_resume", "bcast_cancel", role="admin")
+async def _cb_broadcast_control(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    action = query.data.partition(":")[0]
+    jid = int(arg)
+    job = find_broadcast_job(jid)
+    if not job or job.get("status") in ("done", "cancelled"):
         return
+    control = _BROADCAST_CONTROLS.get(jid)
+    running_here = jid in _BROADCAST_TASKS
+    if action == "bcast_pause" and control:
+        control.resume.clear()
+    elif action == "bcast_resume":
+        if control:
+            control.resume.set()
+        if not running_here:
+            # paused before a restart: nothing is sending it yet
+            await run_blocking(update_broadcast_job, jid, status="running")
+            start_broadcast_job(context.bot, jid)
+    elif action == "bcast_cancel":
+        if control and running_here:
+            control.cancelled = True
+            control.resume.set()
+        else:
+            job = await run_blocking(update_broadcast_job, jid, status="cancelled", finished_at=time.time()) or job
+            try:
+                _broadcast_job_path(jid).unlink()
+            except FileNotFoundError:
+                pass
+            text, markup = _broadcast_progress_view(job)
+            await safe_edit_message(query, text, reply_markup=markup)
+
+
+@callbacks.route("show_prod_add", role="admin")
+async def _cb_show_prod_add(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    context.user_data["state"] = f"addprod_photos:{cat_id}"
+    # initialize product storage
+    context.user_data["new_product"] = {"photos": [], "category_id": cat_id}
+    await safe_edit_message(query, "📸 Прикрепите фото товара (не больше двух). После фото введите название или пришлите ещё фото.")
+
+
+@callbacks.route("list_edit_products", role="admin")
+async def _cb_list_edit_products(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    await list_products_for_edit(query, context, cat_id)
+
+
+@callbacks.route("list_del_products", role="admin")
+async def _cb_list_del_products(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    cat_id = int(arg)
+    await list_products_for_delete(query, context, cat_id)
+
+
+@callbacks.route("prod", "prod_edit", role="admin")
+async def _cb_prod(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    await show_product_actions(query, context, prod_id)
+
+
+@callbacks.route("prod_editmenu", role="admin")
+async def _cb_prod_editmenu(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    # show edit options menu
+    keyboard = [
+        [InlineKeyboardButton("✏️ Изменить название", callback_data=f"editprod:name:{prod_id}"), InlineKeyboardButton("✏️ Изменить описание", callback_data=f"editprod:desc:{prod_id}")],
+        [InlineKeyboardButton("✏️ Изменить цену", callback_data=f"editprod:price:{prod_id}"), InlineKeyboardButton("✏️ Изменить фото", callback_data=f"editprodphoto:{prod_id}")],
+        [InlineKeyboardButton("🔙 Назад", callback_data=f"prod:{prod_id}")],
+    ]
+    await safe_edit_message(query, "Выберите, что изменить:", reply_markup=InlineKeyboardMarkup(keyboard))
 
-    if data.startswith("show_prod_add:"):
-        cat_id = int(data.split(":", 1)[1])
-        context.user_data["state"] = f"addprod_photos:{cat_id}"
-        # initialize product storage
-        context.user_data["new_product"] = {"photos": [], "category_id": cat_id}
-        await safe_edit_message(query, "📸 Прикрепите фото товара (не больше двух). После фото введите название или пришлите ещё фото.")
-        return
 
-    if data.startswith("list_edit_products:"):
-        cat_id = int(data.split(":", 1)[1])
-        await list_products_for_edit(query, context, cat_id)
+@callbacks.route("editprod", role="admin")
+async def _cb_editprod(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    action, prod_id = arg.split(":")
+    prod_id = int(prod_id)
+    try:
+        prods = read_json(PROD_FILE)
+        prod = next((p for p in prods if p.get("id") == prod_id), None)
+    except Exception:
+        prod = None
+    if not prod:
+        await safe_edit_message(query, "❌ Товар не найден")
         return
-
-    if data.startswith("list_del_products:"):
-        cat_id = int(data.split(":", 1)[1])
-        await list_products_for_delete(query, context, cat_id)
+    if action == "name":
+        context.user_data["state"] = f"editprod_name:{prod_id}"
+        current = prod.get("name", "-")
+        await safe_edit_message(query, f"✏️ Текущее название:\n{current}\n\nВведите новое название")
         return
-
-    if data.startswith("prod:"):
-        prod_id = int(data.split(":", 1)[1])
-        await show_product_actions(query, context, prod_id)
+    if action == "desc":
+        context.user_data["state"] = f"editprod_desc:{prod_id}"
+        current = prod.get("description", "-")
+        await safe_edit_message(query, f"✏️ Текущее описание:\n{current}\n\nВведите новое описание")
         return
+    if action == "price":
+        context.user_data["state"] = f"editprod_price:{prod_id}"
+        current = prod.get("price", "-")
+        await safe_edit_message(query, f"💲 Текущая цена: {current} ₽\n\nВведите новую цену")
+
+
+@callbacks.route("editprodphoto", role="admin")
+async def _cb_editprodphoto(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    context.user_data["state"] = f"editprod_photos:{prod_id}"
+    # temporary storage for incoming photos
+    context.user_data["edit_photos"] = []
+    await safe_edit_message(query, "📸 Пришлите новые фото товара (не больше двух). После этого фото будут применены и карточка обновится.")
+
+
+@callbacks.route("delprod_confirm", role="admin")
+async def _cb_delprod_confirm(query, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    prod_id = int(arg)
+    prod = await run_blocking(delete_product, prod_id)
+    if prod:
+        cat_id = prod["category_id"]
+        await safe_edit_message(query, "🗑 Товар удалён")
+        await show_category(query.message, context, cat_id)
+    else:
+        await safe_edit_message(query, "Товар не найден")
 
-    if data.startswith("prod_edit:"):
-        prod_id = int(data.split(":", 1)[1])
-        await show_product_actions(query, context, prod_id)
-        return
 
-    if data.startswith("prod_editmenu:"):
-        prod_id = int(data.split(":", 1)[1])
-        # show edit options menu
-        keyboard = [
-            [InlineKeyboardButton("✏️ Изменить название", callback_data=f"editprod:name:{prod_id}"), InlineKeyboardButton("✏️ Изменить описание", callback_data=f"editprod:desc:{prod_id}")],
-            [InlineKeyboardButton("✏️ Изменить цену", callback_data=f"editprod:price:{prod_id}"), InlineKeyboardButton("✏️ Изменить фото", callback_data=f"editprodphoto:{prod_id}")],
-            [InlineKeyboardButton("🔙 Назад", callback_data=f"prod:{prod_id}")],
-        ]
-        await safe_edit_message(query, "Выберите, что изменить:", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await callbacks.dispatch(query, context)
 
-    if data.startswith("editprod:"):
-        _, action, prod_id = data.split(":")
-        prod_id = int(prod_id)
-        try:
-            prods = read_json(PROD_FILE)
-            prod = next((p for p in prods if p.get("id") == prod_id), None)
-        except Exception:
-            prod = None
-        if not prod:
-            await safe_edit_message(query, "❌ Товар не найден")
-            return
-        if action == "name":
-            context.user_data["state"] = f"editprod_name:{prod_id}"
-            current = prod.get("name", "-")
-            await safe_edit_message(query, f"✏️ Текущее название:\n{current}\n\nВведите новое название")
-            return
-        if action == "desc":
-            context.user_data["state"] = f"editprod_desc:{prod_id}"
-            current = prod.get("description", "-")
-            await safe_edit_message(query, f"✏️ Текущее описание:\n{current}\n\nВведите новое описание")
-            return
-        if action == "price":
-            context.user_data["state"] = f"editprod_price:{prod_id}"
-            current = prod.get("price", "-")
-            await safe_edit_message(query, f"💲 Текущая цена: {current} ₽\n\nВведите новую цену")
-            return
 
-    if data.startswith("editprodphoto:"):
-        prod_id = int(data.split(":", 1)[1])
-        context.user_data["state"] = f"editprod_photos:{prod_id}"
-        # temporary storage for incoming photos
-        context.user_data["edit_photos"] = []
-        await safe_edit_message(query, "📸 Пришлите новые фото товара (не больше двух). После этого фото будут применены и карточка обновится.")
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/metrics [prefix] - per-route call counts and latencies of this process (admins only)."""
+    if not is_admin(update.effective_user.id):
         return
+    prefix = context.args[0] if context.args else ""
+    report = METRICS.render(prefix) or "Метрик пока нет."
+    # Telegram caps messages at 4096 chars
+    for i in range(0, len(report), 4000):
+        await update.message.reply_text(report[i:i + 4000])
+
+
+INLINE_PAGE_SIZE = 20
+
+
+def _inline_product_result(prod: dict) -> InlineQueryResultArticle:
+    name = (str(prod.get("name") or "Товар").strip().splitlines() or ["Товар"])[0][:100]
+    price = prod.get("price", "-")
+    stock = product_stock(prod)
+    availability = f"📦 В наличии: {stock} шт" if stock > 0 else "⛔ Нет в наличии"
+    return InlineQueryResultArticle(
+        id=str(prod.get("id")),
+        title=name,
+        description=f"💰 {price} ₽ · {availability}",
+        input_message_content=InputTextMessageContent(f"{name}\n💰 Цена: {price} ₽"),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Открыть в боте", callback_data=f"user_prod:{prod.get('id')}")]]),
+    )
 
-    if data.startswith("delprod_confirm:"):
-        prod_id = int(data.split(":", 1)[1])
-        prods = read_json(PROD_FILE)
-        prod = next((p for p in prods if p["id"] == prod_id), None)
-        if prod:
-            cat_id = prod["category_id"]
-            prods = [p for p in prods if p["id"] != prod_id]
-            write_json(PROD_FILE, prods)
-            await safe_edit_message(query, "🗑 Товар удалён")
-            await show_category(query.message, context, cat_id)
-        else:
-            await safe_edit_message(query, "Товар не найден")
-        return
 
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """@bot <text>: products whose name or description words start with (or contain) the typed words."""
+    inline_query = update.inline_query
+    started = time.perf_counter()
+    failed = False
+    try:
+        try:
+            offset = max(0, int(inline_query.offset or 0))
+        except ValueError:
+            offset = 0
+        # one extra result tells whether there is a next page
+        found = product_search_index().search(inline_query.query, limit=offset + INLINE_PAGE_SIZE + 1)
+        METRICS.observe("inline.search", time.perf_counter() - started)
+        page = found[offset:offset + INLINE_PAGE_SIZE]
+        next_offset = str(offset + INLINE_PAGE_SIZE) if len(found) > offset + INLINE_PAGE_SIZE else ""
+        await inline_query.answer(
+            [_inline_product_result(p) for p in page],
+            cache_time=10,
+            next_offset=next_offset,
+            button=InlineQueryResultsButton(text="Открыть магазин", start_parameter="search") if offset == 0 else None,
+        )
+    except Exception:
+        failed = True
+        METRICS.inc("inline.errors")
+        raise
+    finally:
+        METRICS.observe("inline", time.perf_counter() - started)
+        _log_update("inline", inline_query.from_user.id, started, failed)
 
 
 async def show_category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int) -> None:
@@ -2759,6 +5090,7 @@ async def show_orders_admin(update: Update, context: ContextTypes.DEFAULT_TYPE)
         [InlineKeyboardButton(f"🟡 В обработке ({counts.get('processing',0)})", callback_data="orders_processing")],
         [InlineKeyboardButton(f"🔵 Завершённые ({counts.get('done',0)})", callback_data="orders_done")],
         [InlineKeyboardButton(f"❌ Отменённые ({counts.get('cancelled',0)})", callback_data="orders_cancelled")],
+        [InlineKeyboardButton("🔎 Поиск", callback_data="orders_search")],
         [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
     ]
     try:
@@ -2791,6 +5123,7 @@ async def show_stats_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     keyboard = [
         [InlineKeyboardButton("📊 Подробнее", callback_data="stats_more")],
         [InlineKeyboardButton("🏆 Топ товаров", callback_data="stats_top")],
+        [InlineKeyboardButton("📈 Выручка за период", callback_data="rev")],
         [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")],
     ]
     try:
@@ -2831,31 +5164,38 @@ async def show_broadcast_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-def get_category_markup(cat_id: int):
-    cats = read_json(CATS_FILE)
-    prods = [p for p in read_json(PROD_FILE) if p.get("category_id") == cat_id]
+@catalog_view("admin_cat")
+def get_category_markup(cat_id: int, cursor: int = 0):
+    idx = _catalog_index()
+    prods = idx["products"].get(cat_id, [])
     # count products in this category
     prod_count = len(prods)
     text = f"📂 Каталог: {get_cat_name(cat_id)}\nТовары: {prod_count}"
     keyboard = []
     # children categories
-    children = [c for c in cats if c.get("parent_id") == cat_id]
-    for ch in children:
+    for ch in idx["children"].get(cat_id, []):
         keyboard.append([InlineKeyboardButton(f"🗂 {ch['name']}", callback_data=f"cat:{ch['id']}")])
     # main actions
     keyboard.append([InlineKeyboardButton("➕ Добавить товар", callback_data=f"show_prod_add:{cat_id}" )])
-    # list products as buttons with their names (open product actions)
-    for p in prods:
+    # list products as buttons with their names (open product actions), one page at a time
+    page, nav = page_slice(prods, f"cat.{cat_id}", cursor)
+    for p in page:
         keyboard.append([InlineKeyboardButton(f"{(p.get('name') or '-').strip()}", callback_data=f"prod:{p['id']}")])
+    keyboard.extend(nav)
     keyboard.append([InlineKeyboardButton("✏️ Изменить каталог", callback_data=f"rename_cat:{cat_id}"), InlineKeyboardButton("❌ Удалить каталог", callback_data=f"delcat:{cat_id}")])
     # allow adding sub-catalog only if current is root (no parent)
-    current = next((c for c in cats if c["id"] == cat_id), {})
+    current = idx["cats"].get(cat_id, {})
     if current.get("parent_id") is None:
         keyboard.append([InlineKeyboardButton("➕ Добавить каталог", callback_data=f"add_subcat:{cat_id}")])
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_cats")])
     return text, InlineKeyboardMarkup(keyboard)
 
 
+@paged_view("cat", role="admin")
+def _page_category(query, param: str, cursor: int):
+    return get_category_markup(int(param), cursor)
+
+
 async def _cleanup_last_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     """Delete last media messages saved in chat_data for this chat to avoid thumbnail previews."""
     last = context.chat_data.pop("last_media_ids", None)
@@ -2871,36 +5211,80 @@ async def _cleanup_last_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
             pass
 
 
+# (chat_id, message_id) -> "text" | "media" for messages the bot sent or edited recently
+_MESSAGE_KINDS: OrderedDict = OrderedDict()
+_MESSAGE_KINDS_MAX = 4096
+
+
+def _infer_message_kind(message) -> str | None:
+    if getattr(message, "text", None) is not None:
+        return "text"
+    if any(getattr(message, a, None) for a in ("photo", "video", "animation", "document", "audio")):
+        return "media"
+    return None
+
+
+def remember_message_kind(message, kind: str | None = None) -> None:
+    """Record whether a message is text or media with a caption, so edits call the right method first."""
+    kind = kind or _infer_message_kind(message)
+    if message is None or kind is None:
+        return
+    key = (message.chat_id, message.message_id)
+    _MESSAGE_KINDS[key] = kind
+    _MESSAGE_KINDS.move_to_end(key)
+    if len(_MESSAGE_KINDS) > _MESSAGE_KINDS_MAX:
+        _MESSAGE_KINDS.popitem(last=False)
+
+
+def _message_kind(query) -> str | None:
+    msg = getattr(query, "message", None)
+    if msg is None:
+        return None
+    return _MESSAGE_KINDS.get((msg.chat_id, msg.message_id)) or _infer_message_kind(msg)
+
+
+def _is_not_modified(err: Exception) -> bool:
+    return "not modified" in str(err).lower()
+
+
 async def safe_edit_message(query, text: str, reply_markup: InlineKeyboardMarkup = None):
-    """Try to edit message text; if original message has no text (e.g. it's a media group), try edit_message_caption.
-    If both fail, send a new message in the chat as a fallback.
+    """Edit the message text, or the caption if it is a photo card; send a new message if neither works.
+
+    The message kind (remembered when the bot sent it, else read from the callback's message)
+    decides which edit method is called first, so a photo card costs one round trip instead of a
+    failed edit_message_text first. If Telegram answers that the message has no text (or no
+    caption), the other method is tried once and the kind it proves is remembered. A new message is
+    sent only when the message is gone or both methods fail. Calls that fail and new messages sent
+    instead are counted in /metrics (edit.wasted_calls, edit.fallback_sends).
     """
-    try:
-        if reply_markup is not None:
-            await query.edit_message_text(text, reply_markup=reply_markup)
-        else:
-            await query.edit_message_text(text)
-        return
-    except BadRequest as e:
-        msg = str(e).lower()
-        if "no text" in msg or "there is no text" in msg or "message to edit" in msg:
-            # try edit caption (works if message has media with caption)
-            try:
-                if reply_markup is not None:
-                    await query.edit_message_caption(text, reply_markup=reply_markup)
-                else:
-                    await query.edit_message_caption(text)
+    markup_kw = {"reply_markup": reply_markup} if reply_markup is not None else {}
+    attempts = ("caption", "text") if _message_kind(query) == "media" else ("text", "caption")
+    for attempt in attempts:
+        try:
+            if attempt == "text":
+                await query.edit_message_text(text, **markup_kw)
+            else:
+                await query.edit_message_caption(text, **markup_kw)
+            METRICS.inc(f"edit.{attempt}")
+            if query.message is not None:
+                remember_message_kind(query.message, "text" if attempt == "text" else "media")
+            return
+        except BadRequest as e:
+            if _is_not_modified(e):
+                METRICS.inc("edit.not_modified")
                 return
-            except Exception:
-                pass
-        # fallback: reply in chat
+            METRICS.inc("edit.wasted_calls")
+            msg = str(e).lower()
+            # "there is no text in the message to edit" / "... no caption ...": the other method fits
+            if "no text" not in msg and "no caption" not in msg:
+                break
+    # fallback: reply in chat
     try:
         chat_id = query.message.chat_id
         bot = query._bot
-        if reply_markup is not None:
-            await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-        else:
-            await bot.send_message(chat_id=chat_id, text=text)
+        sent = await bot.send_message(chat_id=chat_id, text=text, **markup_kw)
+        METRICS.inc("edit.fallback_sends")
+        remember_message_kind(sent, "text")
     except Exception:
         # last-resort: ignore
         return
@@ -2911,7 +5295,11 @@ async def safe_edit_reply_markup(query, reply_markup: InlineKeyboardMarkup):
     try:
         await query.edit_message_reply_markup(reply_markup=reply_markup)
         return
-    except Exception:
+    except Exception as e:
+        if isinstance(e, BadRequest) and _is_not_modified(e):
+            METRICS.inc("edit.not_modified")
+            return
+        METRICS.inc("edit.wasted_calls")
         try:
             chat_id = query.message.chat_id
             msg_id = query.message.message_id
@@ -2921,16 +5309,28 @@ async def safe_edit_reply_markup(query, reply_markup: InlineKeyboardMarkup):
             return
 
 
-async def list_products_for_edit(query, context, cat_id: int) -> None:
-    prods = [p for p in read_json(PROD_FILE) if p.get("category_id") == cat_id]
+@paged_view("edit", role="admin")
+def _edit_products_markup(query, param: str, cursor: int):
+    cat_id = int(param)
+    prods = _catalog_index()["products"].get(cat_id, [])
     if not prods:
-        await safe_edit_message(query, "Список товаров пуст.")
-        return
+        return None
+    page, nav = page_slice(prods, f"edit.{cat_id}", cursor)
     keyboard = []
-    for p in prods:
+    for p in page:
         keyboard.append([InlineKeyboardButton(f"{(p.get('name') or '-').strip()}", callback_data=f"prod:{p['id']}")])
+    keyboard.extend(nav)
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"cat:{cat_id}")])
-    await safe_edit_message(query, "Выберите товар для редактирования:", reply_markup=InlineKeyboardMarkup(keyboard))
+    return "Выберите товар для редактирования:", InlineKeyboardMarkup(keyboard)
+
+
+async def list_products_for_edit(query, context, cat_id: int) -> None:
+    result = _edit_products_markup(query, str(cat_id), 0)
+    if result is None:
+        await safe_edit_message(query, "Список товаров пуст.")
+        return
+    text, markup = result
+    await safe_edit_message(query, text, reply_markup=markup)
 
 
 async def finalize_order(source, context: ContextTypes.DEFAULT_TYPE):
@@ -2939,7 +5339,8 @@ async def finalize_order(source, context: ContextTypes.DEFAULT_TYPE):
     pending_ctx = context.user_data.pop("pending_order", None)
     if not pending_ctx:
         return
-    pending = create_pending_order(
+    pending = await run_blocking(
+        create_pending_order,
         user,
         pending_ctx.get("items", []),
         pending_ctx.get("address", ""),
@@ -2948,13 +5349,10 @@ async def finalize_order(source, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Reserve stock immediately to prevent concurrent purchases of the last items.
-    ok, err = _reserve_stock_for_pending(pending)
+    ok, err = await run_blocking(_reserve_stock_for_pending, pending)
     if not ok:
         try:
-            # remove pending
-            pend_all = read_pending_orders()
-            pend_all = [p for p in pend_all if int(p.get("id", 0)) != int(pending.get("id", 0))]
-            write_pending_orders(pend_all)
+            await run_blocking(remove_pending_order, pending.get("id"))
         except Exception:
             pass
         await context.bot.send_message(chat_id=user.id, text=f"❌ Не удалось оформить заказ: {err or 'нет в наличии'}")
@@ -2962,37 +5360,25 @@ async def finalize_order(source, context: ContextTypes.DEFAULT_TYPE):
 
     # Persist reservation flags
     try:
-        pend_all = read_pending_orders()
-        for po in pend_all:
-            if int(po.get("id", 0)) == int(pending.get("id", 0)):
-                po["reserved"] = True
-                po["reserved_at"] = pending.get("reserved_at")
-                break
-        write_pending_orders(pend_all)
+        await run_blocking(update_pending_order, pending.get("id"), reserved=True, reserved_at=pending.get("reserved_at"))
     except Exception:
         pass
     try:
-        pay_url, payment_id = create_yookassa_payment(pending)
+        # the SDK is blocking (requests); keep it off the event loop
+        pay_url, payment_id = await asyncio.to_thread(create_yookassa_payment, pending)
     except Exception as e:
         # Release reserved stock if payment creation failed
         try:
-            _release_stock_for_pending(pending)
+            await run_blocking(_release_stock_for_pending, pending)
         except Exception:
             pass
         try:
-            pend_all = read_pending_orders()
-            pend_all = [p for p in pend_all if int(p.get("id", 0)) != int(pending.get("id", 0))]
-            write_pending_orders(pend_all)
+            await run_blocking(remove_pending_order, pending.get("id"))
         except Exception:
             pass
         await context.bot.send_message(chat_id=user.id, text=f"❌ Ошибка создания оплаты: {e}")
         return
-    pend_all = read_pending_orders()
-    for po in pend_all:
-        if po.get("id") == pending.get("id"):
-            po["payment_id"] = payment_id
-            break
-    write_pending_orders(pend_all)
+    await run_blocking(update_pending_order, pending.get("id"), payment_id=payment_id)
     try:
         await context.bot.send_message(
             chat_id=user.id,
@@ -3087,20 +5473,10 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             await update.message.reply_text("✅ Фото получено")
 
         # update product immediately with collected photos
-        prods = read_json(PROD_FILE)
-        updated = False
-        for p in prods:
-            if p.get("id") == prod_id:
-                p["photos"] = photos.copy()
-                updated = True
-                cat_id = p.get("category_id")
-                break
-        if updated:
-            write_json(PROD_FILE, prods)
+        prod = await run_blocking(update_product, prod_id, photos=photos.copy())
+        if prod:
             await update.message.reply_text("✅ Фото товара обновлены")
-            prod = next((p for p in prods if p.get("id") == prod_id), None)
-            if prod:
-                await send_product_card(update.message.chat_id, context, prod)
+            await send_product_card(update.message.chat_id, context, prod)
         context.user_data.pop("state", None)
         context.user_data.pop("edit_photos", None)
         return
@@ -3152,7 +5528,7 @@ async def send_product_card(chat_id: int, context: ContextTypes.DEFAULT_TYPE, pr
     title = prod.get('name','-')
     desc = prod.get('description','-')
     price = prod.get('price','-')
-    stock = int(prod.get('stock', 0) or 0)
+    stock = product_stock(prod)
     text = (
         f"Название: {title}\n\n"
         f"Описание:\n{desc}\n\n"
@@ -3167,6 +5543,7 @@ async def send_product_card(chat_id: int, context: ContextTypes.DEFAULT_TYPE, pr
     if photos:
         try:
             msg = await bot.send_photo(chat_id=chat_id, photo=photos[0], caption=text, reply_markup=InlineKeyboardMarkup(keyboard))
+            remember_message_kind(msg, "media")
             # track media for cleanup when navigating to non-photo screens
             try:
                 context.chat_data["last_media_ids"] = [msg.message_id]
@@ -3203,12 +5580,11 @@ async def poll_payment_and_finalize(
     while attempt < max_attempts:
         attempt += 1
         try:
-            payment = Payment.find_one(payment_id)
+            payment = await asyncio.to_thread(Payment.find_one, payment_id)
             status = getattr(payment, "status", None)
             if status == "succeeded":
                 # Read pending order by ID
-                pend_all = read_pending_orders()
-                pending = next((p for p in pend_all if int(p.get("id", 0)) == int(pending_id)), None)
+                pending = find_pending_order(pending_id)
                 if not pending:
                     # Already processed (maybe via webhook)
                     try:
@@ -3231,7 +5607,8 @@ async def poll_payment_and_finalize(
                 delivery = pending.get("delivery")
 
                 # Create real order (preserve pending number so it matches payment description)
-                order = create_order(
+                order, created = await run_blocking(
+                    create_order_once,
                     user_obj,
                     items,
                     address,
@@ -3240,79 +5617,11 @@ async def poll_payment_and_finalize(
                     payment_id=pending.get("payment_id"),
                     created_at=pending.get("created_at"),
                 )
-
-                # Decrease stock and alert admins if low/out-of-stock (skip if already reserved)
-                try:
-                    if pending.get("reserved"):
-                        # stock was already decreased at payment creation
-                        prods_all = read_json(PROD_FILE)
-                        prods_by_id = {int(p.get("id")): p for p in prods_all if p.get("id") is not None}
-                        events = []
-                        seen = set()
-                        for it in order.get("items", []):
-                            try:
-                                pid = int(it.get("product_id", 0))
-                            except Exception:
-                                continue
-                            if pid in seen:
-                                continue
-                            seen.add(pid)
-                            p = prods_by_id.get(pid)
-                            if not p:
-                                continue
-                            new_stock = int(p.get("stock", 0) or 0)
-                            if new_stock == 0:
-                                events.append(("out", p.copy()))
-                            elif new_stock <= 3:
-                                events.append(("low", p.copy()))
-                    else:
-                        prods_all = read_json(PROD_FILE)
-                        events = []
-                        for it in order.get("items", []):
-                            for p in prods_all:
-                                if int(p.get("id", 0)) == int(it.get("product_id", 0)):
-                                    old_stock = int(p.get("stock", 0) or 0)
-                                    p["stock"] = max(0, old_stock - int(it.get("qty", 1)))
-                                    new_stock = int(p.get("stock", 0) or 0)
-                                    if new_stock == 0:
-                                        events.append(("out", p.copy()))
-                                    elif new_stock <= 3 and old_stock > 3:
-                                        events.append(("low", p.copy()))
-                                    break
-                        write_json(PROD_FILE, prods_all)
-
-                    admins = read_json(ADMINS_FILE)
-                    for kind, prod_event in events:
-                        for aid in admins:
-                            try:
-                                if kind == "out":
-                                    await context.bot.send_message(chat_id=aid, text=(
-                                        "⛔ Товар закончился\n\n"
-                                        f"💊 {prod_event.get('name','-')}\n"
-                                        f"🆔 ID: {prod_event.get('id')}"
-                                    ))
-                                else:
-                                    await context.bot.send_message(chat_id=aid, text=(
-                                        "⚠️ Мало товара\n\n"
-                                        f"💊 {prod_event.get('name','-')}\n"
-                                        f"📦 Осталось: {prod_event.get('stock', 0)} шт\n"
-                                        f"🆔 ID: {prod_event.get('id')}"
-                                    ))
-                            except Exception:
-                                pass
-                except Exception:
-                    pass
-
-                # Clear cart if checkout was from cart
-                try:
-                    if pending.get("type") == "cart":
-                        clear_cart(user_id)
-                except Exception:
-                    pass
-
-                # Remove from pending
-                pend_all = [p for p in pend_all if int(p.get("id", 0)) != int(pending_id)]
-                write_pending_orders(pend_all)
+                # Stock, cart, then the pending entry; if that raises, the next poll settles it again
+                events = await run_blocking(settle_paid_order, order, pending)
+                if not created:
+                    # Finalized concurrently (webhook/reconcile); nothing left to do here
+                    return
 
                 # Notify user
                 try:
@@ -3328,22 +5637,16 @@ async def poll_payment_and_finalize(
                 except Exception:
                     pass
 
-                # Notify admins
-                try:
-                    await notify_admin_new_order(context, order)
-                except Exception:
-                    pass
+                # One digest per admin with the order and its stock alerts, off the finalize path
+                dispatch_admin_order_alerts(context.bot, order, events)
                 return
 
             elif status in ("canceled", "expired"):  # optional handling
                 # Release reserved stock and remove pending
                 try:
-                    pend_all = read_pending_orders()
-                    pending = next((p for p in pend_all if int(p.get("id", 0)) == int(pending_id)), None)
-                    if pending:
-                        _release_stock_for_pending(pending)
-                        pend_all = [p for p in pend_all if int(p.get("id", 0)) != int(pending_id)]
-                        write_pending_orders(pend_all)
+                    pending = find_pending_order(pending_id)
+                    if pending and await run_blocking(remove_pending_order, pending_id):
+                        await run_blocking(_release_stock_for_pending, pending)
                 except Exception:
                     pass
                 try:
@@ -3362,9 +5665,9 @@ async def poll_payment_and_finalize(
             pass
 
 
+@catalog_view("user_cats")
 def get_user_categories_markup():
-    cats = read_json(CATS_FILE)
-    root_cats = [c for c in cats if c.get("parent_id") is None]
+    root_cats = _catalog_index()["children"].get(None, [])
     text = "📂 Каталоги\nВыберите каталог"
     keyboard = []
     for c in root_cats:
@@ -3372,28 +5675,35 @@ def get_user_categories_markup():
     return text, InlineKeyboardMarkup(keyboard)
 
 
-def get_user_category_markup(cat_id: int):
-    cats = read_json(CATS_FILE)
-    prods = [p for p in read_json(PROD_FILE) if p.get("category_id") == cat_id]
+@catalog_view("user_cat")
+def get_user_category_markup(cat_id: int, cursor: int = 0):
+    idx = _catalog_index()
+    prods = idx["products"].get(cat_id, [])
     prod_count = len(prods)
     text = f"📂 Каталог: {get_cat_name(cat_id)}\nТовары: {prod_count}"
     keyboard = []
     # children categories
-    children = [c for c in cats if c.get("parent_id") == cat_id]
-    for ch in children:
+    for ch in idx["children"].get(cat_id, []):
         keyboard.append([InlineKeyboardButton(f"🗂 {ch['name']}", callback_data=f"user_cat:{ch['id']}")])
-    # products
-    for p in prods:
+    # products, one page at a time
+    page, nav = page_slice(prods, f"ucat.{cat_id}", cursor)
+    for p in page:
         keyboard.append([InlineKeyboardButton(f"{(p.get('name') or '-').strip()}", callback_data=f"user_prod:{p['id']}")])
+    keyboard.extend(nav)
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="user_back_to_cats")])
     return text, InlineKeyboardMarkup(keyboard)
 
 
+@paged_view("ucat")
+def _page_user_category(query, param: str, cursor: int):
+    return get_user_category_markup(int(param), cursor)
+
+
 async def show_address_selection(query, context: ContextTypes.DEFAULT_TYPE):
     """Show saved addresses for user and option to add new."""
     uid = str(query.from_user.id)
     addrs = read_addresses()
-    user_addrs = addrs.get(uid, [])
+    user_addrs = _legacy_addresses(addrs, uid)
     keyboard = []
     for i, a in enumerate(user_addrs):
         label = f"Адрес: {a if len(a) <= 30 else a[:27] + '...'}"
@@ -3412,7 +5722,7 @@ async def show_address_selection_from_context(update: Update, context: ContextTy
     """Show saved addresses using a normal message (not editing a callback message)."""
     uid = str(update.effective_user.id)
     addrs = read_addresses()
-    user_addrs = addrs.get(uid, [])
+    user_addrs = _legacy_addresses(addrs, uid)
     keyboard = []
     for i, a in enumerate(user_addrs):
         label = f"Адрес: {a if len(a) <= 30 else a[:27] + '...'}"
@@ -3479,8 +5789,8 @@ async def show_user_category(update_obj, context: ContextTypes.DEFAULT_TYPE, cat
 async def show_user_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show the user's orders with status and navigation."""
     user_id = update.effective_user.id
-    orders = [o for o in read_orders() if int(o.get('user_id', 0)) == int(user_id)]
-    if not orders:
+    result = _user_orders_markup(user_id, 0)
+    if result is None:
         keyboard = [[InlineKeyboardButton("📂 Перейти в каталог", callback_data="user_back_to_cats")]]
         try:
             await _cleanup_last_media(context, update.message.chat_id)
@@ -3488,19 +5798,35 @@ async def show_user_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             pass
         await update.message.reply_text("📦 У вас ещё нет заказов.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
+    text, markup = result
+    try:
+        await _cleanup_last_media(context, update.message.chat_id)
+    except Exception:
+        pass
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+def _user_orders_markup(user_id: int, cursor: int):
+    orders = _orders_index()["by_user"].get(int(user_id), [])
+    if not orders:
+        return None
+    page, nav = page_slice(orders, "my", cursor)
     keyboard = []
     emoji_map = {"new": "🔴", "processing": "🟡", "done": "🟢", "cancelled": "🔴"}
-    for o in orders:
+    for o in page:
         st = o.get('status', 'new')
         emoji = emoji_map.get(st, "ℹ️")
         label = f"{emoji} Заказ #{o.get('number')} — {st}"
         keyboard.append([InlineKeyboardButton(label, callback_data=f"user_order:{o.get('id')}")])
+    keyboard.extend(nav)
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="user_back_to_cats")])
-    try:
-        await _cleanup_last_media(context, update.message.chat_id)
-    except Exception:
-        pass
-    await update.message.reply_text("📦 Ваши заказы:", reply_markup=InlineKeyboardMarkup(keyboard))
+    return "📦 Ваши заказы:", InlineKeyboardMarkup(keyboard)
+
+
+@paged_view("my")
+def _page_user_orders(query, param: str, cursor: int):
+    # always the caller's own orders, whatever the button says
+    return _user_orders_markup(query.from_user.id, cursor)
 
 
 async def show_delivery_selection(query, context: ContextTypes.DEFAULT_TYPE):
@@ -3546,7 +5872,7 @@ async def send_product_card_user(chat_id: int, context: ContextTypes.DEFAULT_TYP
     title = prod.get('name','-')
     desc = prod.get('description','-')
     price = prod.get('price','-')
-    stock = int(prod.get('stock', 0) or 0)
+    stock = product_stock(prod)
     availability_line = f"📦 В наличии: {stock} шт" if stock > 0 else "⛔ Нет в наличии"
     text = (
         f"{title}\n\n"
@@ -3563,13 +5889,15 @@ async def send_product_card_user(chat_id: int, context: ContextTypes.DEFAULT_TYP
 
     in_cart = False
     in_fav = False
+    snap = None
     if user_id is not None:
+        snap = user_snapshot(context, user_id)
         try:
-            in_cart = is_in_cart(user_id, prod.get('id'))
+            in_cart = snap.in_cart(prod.get('id'))
         except Exception:
             in_cart = False
         try:
-            in_fav = prod.get('id') in get_favs(user_id)
+            in_fav = snap.in_favs(prod.get('id'))
         except Exception:
             in_fav = False
 
@@ -3598,7 +5926,7 @@ async def send_product_card_user(chat_id: int, context: ContextTypes.DEFAULT_TYP
     else:
         # Role split: admins should get restock, users should get notify
         try:
-            if user_id is not None and is_admin(int(user_id)):
+            if snap is not None and snap.is_admin:
                 keyboard.append([InlineKeyboardButton("➕ Пополнить товар", callback_data=f"admin_restock:{prod['id']}")])
             else:
                 keyboard.append([InlineKeyboardButton("🔔 Уведомить о поступлении", callback_data=f"notify:{prod['id']}")])
@@ -3622,6 +5950,7 @@ async def send_product_card_user(chat_id: int, context: ContextTypes.DEFAULT_TYP
             caption = short
         try:
             msg = await bot.send_photo(chat_id=chat_id, photo=photos[0], caption=caption, reply_markup=InlineKeyboardMarkup(keyboard))
+            remember_message_kind(msg, "media")
             context.chat_data["last_media_ids"] = [msg.message_id]
             context.chat_data["last_media_chat"] = chat_id
             # track last product message to avoid duplicate category on back
@@ -3637,6 +5966,7 @@ async def send_product_card_user(chat_id: int, context: ContextTypes.DEFAULT_TYP
             pass
 
     msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+    remember_message_kind(msg, "text")
     try:
         context.chat_data["last_product_msg_id"] = msg.message_id
         context.chat_data["last_product_chat"] = chat_id
@@ -3702,10 +6032,7 @@ async def show_user_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text("❌ Ошибка загрузки корзины")
         except Exception:
             pass
-        try:
-            print(e)
-        except Exception:
-            pass
+        log.error("show_user_cart failed", exc_info=e, extra={"user_id": update.effective_user.id})
 
 
 async def show_user_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -3750,18 +6077,247 @@ async def show_user_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ Ошибка загрузки избранного")
         except Exception:
             pass
-        try:
-            print(e)
-        except Exception:
-            pass
+        log.error("show_user_favorites failed", exc_info=e, extra={"user_id": update.effective_user.id})
 
 
 def register_handlers(app):
+    # one handler runs per group, so the log binding gets a group of its own ahead of revive_handler
+    app.add_handler(TypeHandler(Update, bind_update_log), group=-2)
+    app.add_handler(TypeHandler(Update, revive_handler), group=-1)
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("metrics", metrics_command))
+    app.add_handler(CommandHandler("find", find_order_command))
+    app.add_handler(CommandHandler("export", export_orders_command))
     app.add_handler(MessageHandler(filters.PHOTO, photo_handler))
     app.add_handler(MessageHandler(filters.CONTACT, contact_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
     app.add_handler(CallbackQueryHandler(callback_handler))
+    app.add_handler(InlineQueryHandler(inline_search))
+
+
+class _SessionStore:
+    """One kind of session data (user_data or chat_data): one JSON file per id, loaded on first use."""
+
+    def __init__(self, directory: Path, restore=None):
+        self.directory = directory
+        self.restore = restore
+        self.live: dict[int, dict] = {}  # id -> the dict PTB hands to handlers
+        self.seen: dict[int, float] = {}  # id -> monotonic time of the last update
+        self.written: dict[int, str] = {}  # id -> JSON as last loaded/written, to skip unchanged saves
+        self.evicting: set[int] = set()  # dropped from PTB's memory, not meant to be deleted from disk
+
+    def path(self, key: int) -> Path:
+        return self.directory / f"{key}.json"
+
+    @staticmethod
+    def _dump(data: dict) -> str | None:
+        try:
+            return json.dumps(data, ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            log.warning("session data is not JSON-serializable, not saved: %s", e)
+            return None
+
+    def load(self, key: int, data: dict) -> None:
+        self.seen[key] = time.monotonic()
+        if key in self.live:
+            return
+        stored = read_json(self.path(key), default={})
+        if isinstance(stored, dict) and stored:
+            if self.restore:
+                stored = self.restore(stored)
+            for k, v in stored.items():
+                data.setdefault(k, v)
+            METRICS.inc("session.loads")
+        self.live[key] = data
+        self.written[key] = self._dump(data) or ""
+
+    async def save(self, key: int, data: dict) -> None:
+        if key not in self.live:
+            # evicted while a handler was still running; the next update reloads it from disk
+            return
+        text = self._dump(data)
+        if text is None or text == self.written.get(key):
+            return
+        self.written[key] = text
+        path = self.path(key)
+        if data:
+            await asyncio.to_thread(write_json, path, data)
+        else:
+            await asyncio.to_thread(path.unlink, missing_ok=True)
+        METRICS.inc("session.writes")
+
+    async def drop(self, key: int) -> None:
+        if key in self.evicting:
+            self.evicting.discard(key)
+            live = self.live.get(key)
+            if live is not None:
+                # came back between eviction and this flush, and PTB skips ids it is deleting
+                await self.save(key, copy.deepcopy(live))
+            return
+        self.live.pop(key, None)
+        self.seen.pop(key, None)
+        self.written.pop(key, None)
+        await asyncio.to_thread(self.path(key).unlink, missing_ok=True)
+
+    def evict(self, idle_before: float) -> list[int]:
+        keys = [k for k, t in self.seen.items() if t < idle_before]
+        for key in keys:
+            self.live.pop(key, None)
+            self.seen.pop(key, None)
+            self.written.pop(key, None)
+            self.evicting.add(key)
+        METRICS.inc("session.evictions", len(keys))
+        return keys
+
+
+def _restore_user_session(data: dict) -> dict:
+    # JSON object keys are strings; handlers look up qty_map by int product id
+    qty_map = data.get("qty_map")
+    if isinstance(qty_map, dict):
+        data["qty_map"] = {int(k) if str(k).isdigit() else k: v for k, v in qty_map.items()}
+    return data
+
+
+class JsonSessionPersistence(BasePersistence):
+    """user_data/chat_data survive restarts: one JSON file per user/chat under data/sessions.
+
+    Nothing is read at startup; an entry is loaded on the first update from that user/chat.
+    PTB passes the entries touched since its last run to update_*_data every update_interval
+    seconds and only those whose JSON changed are written. evict_idle drops users/chats idle
+    for a while from memory, so it stays bounded by the number of recently active users.
+    """
+
+    def __init__(self, directory: Path, update_interval: float = 10):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False), update_interval=update_interval)
+        self.users = _SessionStore(directory / "users", restore=_restore_user_session)
+        self.chats = _SessionStore(directory / "chats")
+        self.users.directory.mkdir(parents=True, exist_ok=True)
+        self.chats.directory.mkdir(parents=True, exist_ok=True)
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self.users.load(user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        self.chats.load(chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self.users.save(user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self.chats.save(chat_id, data)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.users.drop(user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self.chats.drop(chat_id)
+
+    async def flush(self) -> None:
+        # update_*_data write through, there is nothing buffered here
+        pass
+
+    async def evict_idle(self, application, idle_seconds: float) -> int:
+        """Write pending changes, then drop users/chats without updates for idle_seconds from memory."""
+        await application.update_persistence()
+        # no await from here on: an update arriving now is either flushed above or reloaded later
+        idle_before = time.monotonic() - idle_seconds
+        users = self.users.evict(idle_before)
+        chats = self.chats.evict(idle_before)
+        for user_id in users:
+            application.drop_user_data(user_id)
+        for chat_id in chats:
+            application.drop_chat_data(chat_id)
+        return len(users) + len(chats)
+
+
+async def evict_idle_sessions_loop(application) -> None:
+    """Background loop keeping only recently active users'/chats' session data in memory."""
+    idle = max(60.0, float(os.getenv("SESSION_IDLE_TTL", "1800")))
+    while True:
+        await asyncio.sleep(min(idle, 300))
+        try:
+            await application.persistence.evict_idle(application, idle)
+        except Exception:
+            log.exception("session eviction failed")
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, but one at a time per chat (per user for chat-less updates).
+
+    PTB holds its own semaphore around do_process_update, so that one only bounds how many
+    updates may be in flight (waiting included). The per-chat lock is taken first and the
+    execution cap second: a user flooding one chat queues behind their own lock without
+    occupying execution slots other users need.
+    """
+
+    def __init__(self, max_concurrent: int, max_pending: int | None = None):
+        self.max_concurrent = max(1, int(max_concurrent))
+        super().__init__(max(self.max_concurrent, int(max_pending or self.max_concurrent * 32)))
+        self._running = asyncio.Semaphore(self.max_concurrent)
+        # chat key -> [lock, number of updates holding or waiting for it]
+        self._chat_locks: dict[int, list] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._chat_locks.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 def _ensure_yookassa_configured() -> bool:
@@ -3797,8 +6353,8 @@ async def _finalize_paid_pending(context: ContextTypes.DEFAULT_TYPE, pending: di
                     )
                 except Exception:
                     pass
-                pend_all = [p for p in read_pending_orders() if str(p.get("payment_id")) != str(payment_id)]
-                write_pending_orders(pend_all)
+                # an earlier attempt may have stopped before the stock step: settling is idempotent
+                await run_blocking(settle_paid_order, o, pending)
                 return True
 
     # Build a minimal telegram-like user object
@@ -3816,7 +6372,8 @@ async def _finalize_paid_pending(context: ContextTypes.DEFAULT_TYPE, pending: di
         (pending.get("client") or {}).get("last_name"),
     )
 
-    order = create_order(
+    order, created = await run_blocking(
+        create_order_once,
         user_obj,
         pending.get("items", []),
         pending.get("address", ""),
@@ -3825,67 +6382,11 @@ async def _finalize_paid_pending(context: ContextTypes.DEFAULT_TYPE, pending: di
         payment_id=pending.get("payment_id"),
         created_at=pending.get("created_at"),
     )
-
-    # Decrease stock and notify admins (skip decrement if already reserved)
-    try:
-        events = []
-        if pending.get("reserved"):
-            prods_all = read_json(PROD_FILE)
-            prods_by_id = {int(p.get("id")): p for p in prods_all if p.get("id") is not None}
-            seen = set()
-            for it in order.get("items", []):
-                try:
-                    pid = int(it.get("product_id", 0))
-                except Exception:
-                    continue
-                if pid in seen:
-                    continue
-                seen.add(pid)
-                p = prods_by_id.get(pid)
-                if not p:
-                    continue
-                new_stock = int(p.get("stock", 0) or 0)
-                if new_stock == 0:
-                    events.append(("out", p.copy()))
-                elif new_stock <= 3:
-                    events.append(("low", p.copy()))
-        else:
-            prods_all = read_json(PROD_FILE)
-            for it in order.get("items", []):
-                for p in prods_all:
-                    if int(p.get("id", 0)) == int(it.get("product_id", 0)):
-                        old_stock = int(p.get("stock", 0) or 0)
-                        p["stock"] = max(0, old_stock - int(it.get("qty", 1)))
-                        new_stock = int(p.get("stock", 0) or 0)
-                        if new_stock == 0:
-                            events.append(("out", p.copy()))
-                        elif new_stock <= 3 and old_stock > 3:
-                            events.append(("low", p.copy()))
-                        break
-            write_json(PROD_FILE, prods_all)
-
-        for kind, prod_event in events:
-            if kind == "out":
-                await notify_admin_out_of_stock(context, prod_event)
-            else:
-                await notify_admin_low_stock(context, prod_event)
-    except Exception:
-        pass
-
-    # Clear cart if checkout was from cart
-    try:
-        if pending.get("type") == "cart":
-            clear_cart(user_id)
-    except Exception:
-        pass
-
-    # Remove pending
-    try:
-        pend_all = read_pending_orders()
-        pend_all = [p for p in pend_all if int(p.get("id", 0)) != int(pending.get("id", 0))]
-        write_pending_orders(pend_all)
-    except Exception:
-        pass
+    # Stock, cart, then the pending entry; if that raises (LockTimeout) the pending stays for the next run
+    events = await run_blocking(settle_paid_order, order, pending)
+    if not created:
+        # Another process (e.g. an api.py worker) finalized it first
+        return True
 
     # Notify user
     try:
@@ -3901,11 +6402,8 @@ async def _finalize_paid_pending(context: ContextTypes.DEFAULT_TYPE, pending: di
     except Exception:
         pass
 
-    # Notify admins
-    try:
-        await notify_admin_new_order(context, order)
-    except Exception:
-        pass
+    # One digest per admin with the order and its stock alerts, off the finalize path
+    dispatch_admin_order_alerts(context.bot, order, events)
 
     return True
 
@@ -3937,7 +6435,7 @@ async def reconcile_pending_payments_once(app) -> None:
             if not pid:
                 continue
             try:
-                payment = Payment.find_one(str(pid))
+                payment = await asyncio.to_thread(Payment.find_one, str(pid))
                 status = getattr(payment, "status", None)
             except Exception:
                 continue
@@ -3946,7 +6444,11 @@ async def reconcile_pending_payments_once(app) -> None:
                     def __init__(self, bot):
                         self.bot = bot
                         self.application = app
-                await _finalize_paid_pending(Ctx(app.bot), pending)
+                try:
+                    await _finalize_paid_pending(Ctx(app.bot), pending)
+                except Exception:
+                    # the pending entry is kept; the next run settles it
+                    log.exception("finalizing a paid order failed", extra={"order": pending.get("number")})
             elif status in ("canceled", "expired"):
                 try:
                     uid = int(pending.get("user_id"))
@@ -3954,47 +6456,98 @@ async def reconcile_pending_payments_once(app) -> None:
                 except Exception:
                     pass
                 try:
-                    _release_stock_for_pending(pending)
-                except Exception:
-                    pass
-                try:
-                    pend_now = read_pending_orders()
-                    pend_now = [p for p in pend_now if str(p.get("payment_id")) != str(pid)]
-                    write_pending_orders(pend_now)
+                    # Only the process that actually removes the pending entry releases its stock
+                    if await run_blocking(remove_pending_order, payment_id=pid):
+                        await run_blocking(_release_stock_for_pending, pending)
                 except Exception:
                     pass
     except Exception:
         return
 
 
-def main() -> None:
-    if not TOKEN:
-        print("ERROR: TOKEN not set. Put your bot token into a .env file or set TOKEN env var.")
-        return
-
-    ensure_data_files()
+async def _post_init(application):
+    # Run one-shot reconciliation on startup, then keep reconciling in background.
+    try:
+        await reconcile_pending_payments_once(application)
+    except Exception:
+        pass
+    try:
+        asyncio.create_task(reconcile_pending_payments_loop(application))
+    except Exception:
+        pass
+    # Pick up broadcasts interrupted by the previous shutdown
+    try:
+        await resume_broadcast_jobs(application)
+    except Exception:
+        pass
+    if isinstance(application.persistence, JsonSessionPersistence):
+        asyncio.create_task(evict_idle_sessions_loop(application))
+    # build the search index now rather than on the first inline query
+    try:
+        product_search_index()
+    except Exception as e:
+        log.warning("search index build failed: %s", e)
 
-    async def _post_init(application):
-        # Run one-shot reconciliation on startup, then keep reconciling in background.
-        try:
-            await reconcile_pending_payments_once(application)
-        except Exception:
-            pass
-        try:
-            asyncio.create_task(reconcile_pending_payments_loop(application))
-        except Exception:
-            pass
 
+def build_application(token: str | None = None):
+    """The bot Application with all handlers and startup hooks, shared by polling, webhook and api.py modes."""
+    token = token or TOKEN
+    # Different chats are handled in parallel (up to BOT_CONCURRENCY at once), each chat in order
+    concurrency = int(os.getenv("BOT_CONCURRENCY", "16"))
+    processor = ChatOrderedUpdateProcessor(concurrency)
+    # Checkout state and admin drafts survive restarts; changed entries are written every SESSION_FLUSH_INTERVAL seconds
+    persistence = JsonSessionPersistence(SESSIONS_DIR, update_interval=float(os.getenv("SESSION_FLUSH_INTERVAL", "10")))
     # Increase request timeouts to avoid startup failures on slow networks (getMe timeout)
     try:
         from telegram.request import HTTPXRequest
-        req = HTTPXRequest(connect_timeout=30, read_timeout=30, write_timeout=30, pool_timeout=30)
-        app = ApplicationBuilder().token(TOKEN).request(req).post_init(_post_init).build()
+        # one connection per concurrent handler plus the broadcast senders, otherwise requests queue on the pool
+        pool_size = concurrency + int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+        req = HTTPXRequest(connection_pool_size=pool_size, connect_timeout=30, read_timeout=30, write_timeout=30, pool_timeout=30)
+        app = ApplicationBuilder().token(token).request(req).persistence(persistence).post_init(_post_init).concurrent_updates(processor).build()
     except Exception:
-        app = ApplicationBuilder().token(TOKEN).post_init(_post_init).build()
+        app = ApplicationBuilder().token(token).persistence(persistence).post_init(_post_init).concurrent_updates(processor).build()
     register_handlers(app)
+    return app
+
+
+def updates_mode() -> str:
+    """How Telegram updates reach the bot: polling (default), webhook (bot.py's own server) or api (api.py endpoint)."""
+    mode = (os.getenv("BOT_UPDATES_MODE") or "polling").strip().lower()
+    return mode if mode in ("polling", "webhook", "api") else "polling"
+
+
+def main() -> None:
+    setup_logging()
+    if not TOKEN:
+        log.error("TOKEN not set. Put your bot token into a .env file or set TOKEN env var.")
+        return
+
+    ensure_data_files()
+    run_migrations()
+
+    mode = updates_mode()
+    if mode == "api":
+        log.error("BOT_UPDATES_MODE=api: updates are received by api.py (POST /telegram/webhook); run uvicorn api:app instead.")
+        return
+
+    app = build_application()
+    if mode == "webhook":
+        webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL")
+        if not webhook_url:
+            log.error("BOT_UPDATES_MODE=webhook needs TELEGRAM_WEBHOOK_URL (public https URL of this server).")
+            return
+        from urllib.parse import urlparse
+        log.info("Bot is running in webhook mode (press Ctrl-C to stop)")
+        app.run_webhook(
+            listen=os.getenv("TELEGRAM_WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8443")),
+            url_path=urlparse(webhook_url).path.lstrip("/"),
+            webhook_url=webhook_url,
+            secret_token=os.getenv("TELEGRAM_WEBHOOK_SECRET") or None,
+        )
+        return
 
-    print("Bot is running (press Ctrl-C to stop)")
+    log.info("Bot is running (press Ctrl-C to stop)")
     app.run_polling()
 
 
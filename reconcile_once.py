@@ -48,7 +48,12 @@ async def main() -> int:
 
         print(f"{pid}: status={status}")
         if status == "succeeded":
-            ok = await botmod._finalize_paid_pending(ctx, pending)
+            try:
+                ok = await botmod._finalize_paid_pending(ctx, pending)
+            except Exception as e:
+                # the pending entry is kept, so running this again finishes it
+                print(f"{pid}: NOT FINALIZED {type(e).__name__}: {e}")
+                continue
             if ok:
                 succeeded += 1
 
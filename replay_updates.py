@@ -0,0 +1,103 @@
+"""Replay recorded Telegram updates against the api.py webhook endpoint (BOT_UPDATES_MODE=api).
+
+Updates are read from a JSON array or a JSON-lines file, e.g. one recorded by running api.py
+with TELEGRAM_RECORD_UPDATES=updates.jsonl. Without a file, --chat-id/--text build simple
+text-message updates, so a flow can be driven from the command line:
+
+    python replay_updates.py updates.jsonl
+    python replay_updates.py --chat-id 123456789 --text "📂 Каталоги" --text "🛒 Корзина"
+
+The handlers answer through the real Bot API, so replay updates from your own chat.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+
+BASE_DIR = Path(__file__).resolve().parent
+load_dotenv(dotenv_path=BASE_DIR / ".env")
+
+
+def _load(path: Path) -> list[dict]:
+    raw = path.read_text(encoding="utf-8").strip()
+    if raw.startswith("["):
+        return json.loads(raw)
+    return [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+
+def _text_updates(chat_id: int, texts: list[str]) -> list[dict]:
+    base = int(time.time() * 1000) % 1_000_000_000
+    updates = []
+    for i, text in enumerate(texts):
+        updates.append({
+            "update_id": base + i,
+            "message": {
+                "message_id": base + i,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "replay"},
+                "text": text,
+                **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
+                   if text.startswith("/") else {}),
+            },
+        })
+    return updates
+
+
+async def _replay(url: str, secret: str, updates: list[dict], concurrency: int, delay: float) -> tuple[int, int, float]:
+    sem = asyncio.Semaphore(concurrency)
+    ok = 0
+    failed = 0
+
+    async def one(client, update):
+        nonlocal ok, failed
+        async with sem:
+            r = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+            if r.status_code == 200:
+                ok += 1
+            else:
+                failed += 1
+                print(f"update {update.get('update_id')}: HTTP {r.status_code} {r.text}")
+            if delay:
+                await asyncio.sleep(delay)
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=30) as client:
+        if concurrency == 1:
+            # keep the recorded order
+            for update in updates:
+                await one(client, update)
+        else:
+            await asyncio.gather(*(one(client, u) for u in updates))
+    return ok, failed, time.perf_counter() - started
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("file", nargs="?", type=Path, help="recorded updates (JSON array or JSON lines)")
+    ap.add_argument("--url", default="http://127.0.0.1:8000/telegram/webhook")
+    ap.add_argument("--secret", default=os.getenv("TELEGRAM_WEBHOOK_SECRET", ""))
+    ap.add_argument("--chat-id", type=int, help="build text updates from this chat instead of reading a file")
+    ap.add_argument("--text", action="append", default=[], help="message text (repeatable, used with --chat-id)")
+    ap.add_argument("--concurrency", type=int, default=1, help="parallel requests; 1 keeps the recorded order")
+    ap.add_argument("--delay", type=float, default=0.0, help="pause after each update, seconds")
+    args = ap.parse_args()
+
+    if args.file:
+        updates = _load(args.file)
+    elif args.chat_id and args.text:
+        updates = _text_updates(args.chat_id, args.text)
+    else:
+        ap.error("pass a recorded updates file or --chat-id with at least one --text")
+    ok, failed, elapsed = asyncio.run(_replay(args.url, args.secret, updates, max(1, args.concurrency), args.delay))
+    print(f"updates={len(updates)} ok={ok} failed={failed} elapsed={elapsed:.2f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
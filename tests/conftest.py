@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# bot.py reads BOT_DATA_DIR at import time: point it at a scratch directory, never at data/
+os.environ["BOT_DATA_DIR"] = tempfile.mkdtemp(prefix="bot_tests_")
+os.environ.setdefault("TOKEN", "")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,27 @@
+import logging
+
+import bot
+
+
+def debug_record() -> logging.LogRecord:
+    return logging.LogRecord("bot.updates", logging.DEBUG, __file__, 1, "update", None, None)
+
+
+def test_an_update_keeps_all_or_none_of_its_debug_lines():
+    sampler = bot._DebugSampler(0.3)
+    kept_updates = 0
+    for update_id in range(1000, 3000):
+        token = bot._LOG_UPDATE_ID.set(update_id)
+        try:
+            decisions = {sampler.filter(debug_record()) for _ in range(5)}
+        finally:
+            bot._LOG_UPDATE_ID.reset(token)
+        assert len(decisions) == 1
+        kept_updates += decisions.pop()
+    assert 0.25 < kept_updates / 2000 < 0.35
+
+
+def test_other_levels_always_pass():
+    sampler = bot._DebugSampler(0.0)
+    record = logging.LogRecord("bot", logging.INFO, __file__, 1, "x", None, None)
+    assert sampler.filter(record)
@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+from bot import iter_json_array
+
+ITEMS = [-1.5e3, 12345678, {"id": 1, "items": [1, 2]}, "a,]b", True, None, 0.25, -7, [3.5e-2]]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 64])
+def test_small_chunks_match_json_load(tmp_path, chunk_size):
+    path = tmp_path / "items.json"
+    path.write_text(json.dumps(ITEMS, indent=1), encoding="utf-8")
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == ITEMS
+
+
+def test_compact_numbers_split_at_every_offset(tmp_path):
+    path = tmp_path / "nums.json"
+    path.write_text("[-1.5e3,10,2E+2]", encoding="utf-8")
+    for chunk_size in range(1, 17):
+        assert list(iter_json_array(path, chunk_size=chunk_size)) == [-1500.0, 10, 200.0]
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from contextlib import ExitStack, contextmanager
+from types import SimpleNamespace
+
+from telegram.error import Forbidden
+
+import bot
+
+
+@contextmanager
+def held(*lock_paths, seconds=0.2):
+    """Hold the locks from another thread for a moment, so whoever asks for them has to wait."""
+    taken = threading.Event()
+
+    def holder():
+        with ExitStack() as stack:
+            for path in lock_paths:
+                stack.enter_context(bot._interprocess_lock(path))
+            taken.set()
+            threading.Event().wait(seconds)
+
+    t = threading.Thread(target=holder)
+    t.start()
+    taken.wait()
+    try:
+        yield
+    finally:
+        t.join()
+
+
+def loop_waits() -> int:
+    return sum(v for k, v in bot.METRICS.counters.items() if k.endswith(".loop_waits"))
+
+
+class FakeBot:
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if chat_id in self.blocked:
+            raise Forbidden("bot was blocked by the user")
+        self.sent.append(chat_id)
+
+
+def test_broadcast_job_takes_locks_in_worker_threads():
+    job = bot.create_broadcast_job("hi", None, [501, 502, 503])
+    fake = FakeBot(blocked={502})
+    before = loop_waits()
+
+    async def run():
+        with held(bot._broadcasts_lock_path(), bot._dead_lock_path()):
+            return await bot.run_broadcast_job(fake, job["id"])
+
+    done = asyncio.run(run())
+    assert done["status"] == "done" and done["delivered"] == 2 and done["blocked"] == 1
+    assert "502" in bot.get_dead_recipients()
+    assert loop_waits() == before
+
+
+def test_revive_handler_takes_locks_in_worker_threads():
+    user = SimpleNamespace(id=777)
+    kicked = SimpleNamespace(
+        chat=SimpleNamespace(type="private"), new_chat_member=SimpleNamespace(status="kicked"))
+    before = loop_waits()
+
+    async def run():
+        with held(bot._dead_lock_path()):
+            await bot.revive_handler(SimpleNamespace(effective_user=user, my_chat_member=kicked), None)
+        assert "777" in bot.get_dead_recipients()
+        with held(bot._dead_lock_path()):
+            await bot.revive_handler(SimpleNamespace(effective_user=user, my_chat_member=None), None)
+
+    asyncio.run(run())
+    assert "777" not in bot.get_dead_recipients()
+    assert loop_waits() == before
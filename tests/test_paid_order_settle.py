@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+import api
+import bot
+
+
+@pytest.fixture
+def paid_pending():
+    bot.write_json(bot.PROD_FILE, [{"id": 7, "category_id": 1, "name": "Tea", "price": 10, "stock": 10}])
+    bot.drop_stock(7)
+    bot.write_json(bot.ORDERS_FILE, [])
+    user = SimpleNamespace(id=4242, username="buyer", first_name=None, last_name=None)
+    pending = bot.create_pending_order(user, [{"product_id": 7, "name": "Tea", "qty": 3, "price": 10}], "-", "Яндекс", "single")
+    yield pending
+    bot.remove_pending_order(pending["id"])
+    bot.drop_stock(7)
+
+
+def stock() -> int:
+    return bot.product_stock(bot.find_product(7))
+
+
+def test_lock_timeout_keeps_pending_and_redelivery_takes_stock_once(paid_pending, monkeypatch):
+    real = bot.adjust_stock
+
+    def busy(*args, **kwargs):
+        raise bot.LockTimeout("busy")
+
+    monkeypatch.setattr(bot, "adjust_stock", busy)
+    with pytest.raises(bot.LockTimeout):
+        api._complete_paid_order(paid_pending["id"], 4242)
+    monkeypatch.setattr(bot, "adjust_stock", real)
+    # the order exists, but the pending entry stays so a redelivered webhook can finish the job
+    assert bot.find_pending_order(paid_pending["id"]) is not None
+    assert stock() == 10
+
+    assert api._complete_paid_order(paid_pending["id"], 4242) == (None, [])
+    assert bot.find_pending_order(paid_pending["id"]) is None
+    assert stock() == 7
+    assert len(bot.read_orders()) == 1
+
+
+def test_settling_twice_takes_stock_once(paid_pending):
+    order, events = api._complete_paid_order(paid_pending["id"], 4242)
+    assert order["number"] == paid_pending["number"]
+    bot.settle_paid_order(order, paid_pending)
+    assert stock() == 7
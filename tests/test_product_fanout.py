@@ -0,0 +1,52 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeBot:
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kw):
+        if chat_id != 1:
+            await self.release.wait()
+        self.sent.append((chat_id, text))
+
+
+def test_new_product_fanout_runs_in_background_and_reports_counts(monkeypatch):
+    bot.write_json(bot.NOTIF_FILE, {"new_product": {"enabled": True, "template": "{name} {price}"}})
+    bot.write_json(bot.USERS_FILE, [10, 11, 12])
+    bot.write_json(bot.ADMINS_FILE, [1])
+    cards = []
+
+    async def fake_card(chat_id, context, prod):
+        cards.append(prod["name"])
+
+    monkeypatch.setattr(bot, "send_product_card", fake_card)
+
+    async def run():
+        fake = FakeBot()
+        replies = []
+
+        async def reply_text(text, **kw):
+            replies.append(text)
+
+        update = SimpleNamespace(message=SimpleNamespace(text="5", chat_id=1, reply_text=reply_text))
+        context = SimpleNamespace(
+            bot=fake, user_data={"new_product": {"category_id": 1, "name": "Fresh", "price": 9}, "state": "x"})
+        # the handler must answer the admin while every user send is still blocked
+        await asyncio.wait_for(bot._st_addprod_stock(update, context, "5", ""), timeout=2)
+        assert replies == ["✅ Товар добавлен"] and cards == ["Fresh"]
+        assert bot._FANOUT_TASKS
+
+        fake.release.set()
+        await asyncio.wait_for(asyncio.gather(*bot._FANOUT_TASKS), timeout=10)
+        return fake.sent
+
+    sent = asyncio.run(run())
+    users = {chat_id for chat_id, _ in sent if chat_id != 1}
+    assert {10, 11, 12} <= users
+    reports = [text for chat_id, text in sent if chat_id == 1]
+    assert any("Доставлено" in text and "Fresh" in text for text in reports)
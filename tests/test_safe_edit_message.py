@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+import bot
+
+
+class FakeQuery:
+    """Callback query over a message that is either a text or a photo card, or already deleted."""
+
+    def __init__(self, message_id, actual):
+        self.actual = actual
+        self.calls = []
+        self.message = SimpleNamespace(chat_id=1, message_id=message_id, text=None, photo=None)
+        self._bot = SimpleNamespace(send_message=self._send)
+
+    async def edit_message_text(self, text, **kw):
+        self.calls.append("text")
+        self._check("text", "There is no text in the message to edit")
+
+    async def edit_message_caption(self, caption, **kw):
+        self.calls.append("caption")
+        self._check("media", "There is no caption in the message to edit")
+
+    def _check(self, kind, error):
+        if self.actual == "gone":
+            raise BadRequest("Message to edit not found")
+        if self.actual != kind:
+            raise BadRequest(error)
+
+    async def _send(self, chat_id, text, **kw):
+        self.calls.append("send")
+        return SimpleNamespace(chat_id=chat_id, message_id=999, text=text)
+
+
+def edit(query):
+    asyncio.run(bot.safe_edit_message(query, "hello"))
+    return query.calls
+
+
+def test_wrong_remembered_kind_falls_back_to_the_other_method_and_learns():
+    q = FakeQuery(101, actual="media")
+    bot.remember_message_kind(q.message, "text")
+    assert edit(q) == ["text", "caption"]
+    assert edit(FakeQuery(101, actual="media")) == ["caption"]
+
+    q = FakeQuery(102, actual="text")
+    bot.remember_message_kind(q.message, "media")
+    assert edit(q) == ["caption", "text"]
+    assert edit(FakeQuery(102, actual="text")) == ["text"]
+
+
+def test_deleted_message_sends_a_new_one_without_guessing_its_kind():
+    q = FakeQuery(103, actual="gone")
+    assert edit(q) == ["text", "send"]
+    assert (1, 103) not in bot._MESSAGE_KINDS
@@ -0,0 +1,20 @@
+import asyncio
+import time
+
+from bot import _TokenBucket
+
+
+def test_pause_does_not_refill_a_burst():
+    async def run():
+        bucket = _TokenBucket(rate=20, capacity=20)
+        bucket.pause(0.3)
+        started = time.monotonic()
+        handed = 0
+        while time.monotonic() - started < 0.8:
+            await asyncio.wait_for(bucket.acquire(), timeout=1)
+            handed += 1
+        return handed
+
+    handed = asyncio.run(run())
+    # 0.5s of sending after the pause at 20/s is ~10 tokens; a refilled bucket would add a burst of 20
+    assert 6 <= handed <= 14
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def products():
+    bot.write_json(bot.PROD_FILE, [
+        {"id": 1, "category_id": 1, "name": "A", "price": 10, "stock": 5},
+        {"id": 2, "category_id": 1, "name": "B", "price": 10, "stock": 5},
+        {"id": 3, "category_id": 1, "name": "C", "price": 10, "stock": 1},
+    ])
+    for pid in (1, 2, 3):
+        bot.drop_stock(pid)
+    yield
+    for pid in (1, 2, 3):
+        bot.drop_stock(pid)
+
+
+def levels():
+    return {pid: bot.product_stock(bot.find_product(pid)) for pid in (1, 2, 3)}
+
+
+def pending(number, *items):
+    return {"id": number, "number": number, "items": [{"product_id": p, "qty": q} for p, q in items]}
+
+
+def test_shortfall_rolls_back_taken_items(products):
+    ok, err = bot._reserve_stock_for_pending(pending(11, (1, 2), (2, 1), (3, 2)))
+    assert not ok and "C" in err
+    assert levels() == {1: 5, 2: 5, 3: 1}
+
+
+def test_failure_midway_rolls_back_taken_items(products, monkeypatch):
+    real = bot.adjust_stock
+
+    def flaky(pid, delta, reason, *args, **kwargs):
+        if pid == 2 and reason == "reserve":
+            raise bot.LockTimeout("busy")
+        return real(pid, delta, reason, *args, **kwargs)
+
+    monkeypatch.setattr(bot, "adjust_stock", flaky)
+    ok, _ = bot._reserve_stock_for_pending(pending(12, (1, 2), (2, 1)))
+    assert not ok
+    assert levels() == {1: 5, 2: 5, 3: 1}
+
+
+def test_release_returns_only_what_was_reserved_and_only_once(products, monkeypatch):
+    real = bot.adjust_stock
+    calls = []
+
+    def crash_after_first(pid, delta, reason, *args, **kwargs):
+        if reason == "reserve" and calls:
+            raise SystemExit  # the process dies: no rollback runs
+        calls.append(pid)
+        return real(pid, delta, reason, *args, **kwargs)
+
+    half = pending(13, (1, 2), (2, 3))
+    monkeypatch.setattr(bot, "adjust_stock", crash_after_first)
+    with pytest.raises(SystemExit):
+        bot._reserve_stock_for_pending(half)
+    monkeypatch.setattr(bot, "adjust_stock", real)
+    assert levels() == {1: 3, 2: 5, 3: 1}
+
+    bot._release_stock_for_pending(half)
+    bot._release_stock_for_pending(half)
+    assert levels() == {1: 5, 2: 5, 3: 1}
+
+
+def test_repeated_reservation_counts_once_and_ledger_names_it(products):
+    p = pending(14, (1, 2), (2, 1))
+    assert bot._reserve_stock_for_pending(p) == (True, None)
+    assert bot._reserve_stock_for_pending(dict(p)) == (True, None)
+    assert levels() == {1: 3, 2: 4, 3: 1}
+    lines = [json.loads(line) for line in bot.STOCK_LEDGER_FILE.read_text(encoding="utf-8").splitlines()]
+    assert [(e["product_id"], e["delta"]) for e in lines if e["reason"] == "reserve" and e["ref"] == 14] == [(1, -2), (2, -1)]